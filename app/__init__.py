@@ -1,23 +1,136 @@
-import logging
-import os
+import random
+import time
+from contextlib import contextmanager
 
-import rq
-
-from logging.handlers import SMTPHandler, RotatingFileHandler
-from flask import Flask, request, current_app
-from flask_sqlalchemy import SQLAlchemy
+from flask import Flask, request, current_app, has_request_context, \
+    session as flask_session
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
 from flask_migrate import Migrate
 from flask_login import LoginManager
 from flask_mail import Mail
 from flask_bootstrap import Bootstrap
 from flask_moment import Moment
 from flask_babel import Babel, lazy_gettext as _l
-from elasticsearch import Elasticsearch
-from redis import Redis
-
+from sqlalchemy import event, orm
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.expression import CompoundSelect, Select
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+from app.instrumentation import InstrumentedRedis
+from app.log import configure_logging
+from app.search import ElasticsearchConnection
 from config import Config
 
-db = SQLAlchemy()
+READ_METHODS = ("GET", "HEAD")
+
+
+class RoutingSession(SignallingSession):
+    """Sends SELECTs issued while serving GET requests to a read replica.
+
+    Everything else goes to the primary: writes and flushes, any read made
+    after this session has flushed, and every read by a user who committed
+    a write in the last REPLICA_STICKY_SECONDS, so users always see their
+    own writes.
+    """
+
+    def __init__(self, db, **options):
+        self.pinned = False
+        self._primary_blocks = 0
+        self._db = db
+        self._replica = None
+        SignallingSession.__init__(self, db, **options)
+
+    @contextmanager
+    def primary(self):
+        """Read from the primary inside the block, for values that outlive
+        the request and so must not come from a lagging replica."""
+        self._primary_blocks += 1
+        try:
+            yield
+        finally:
+            self._primary_blocks -= 1
+
+    def _use_replica(self, clause):
+        if not self.app.replica_binds or self.pinned or self._primary_blocks \
+                or self._flushing:
+            return False
+        if not isinstance(clause, (Select, CompoundSelect)):
+            return False
+        if not has_request_context() or request.method not in READ_METHODS:
+            return False
+        return flask_session.get("primary_until", 0) < time.time()
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._use_replica(clause):
+            if self._replica is None:
+                # One replica per session keeps a request's reads consistent.
+                self._replica = self._db.get_engine(
+                    self.app, bind=random.choice(self.app.replica_binds))
+            return self._replica
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+def set_sqlite_pragmas(pragmas):
+    def connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+    return connect
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        """Pool settings from the config, per database type.
+
+        File based SQLite databases get a small pool of connections shared
+        across threads, each set up once with SQLITE_PRAGMAS, instead of
+        Flask-SQLAlchemy's default of a new connection per checkout.
+        """
+        if sa_url.drivername.startswith("sqlite"):
+            in_memory = sa_url.database in (None, "", ":memory:")
+            if not in_memory:
+                options.setdefault("pool_size", app.config["SQLITE_POOL_SIZE"])
+            SQLAlchemy.apply_driver_hacks(self, app, sa_url, options)
+            if not in_memory:
+                if options["pool_size"]:
+                    options["poolclass"] = QueuePool
+                    options.setdefault("connect_args", {})["check_same_thread"] = False
+                else:
+                    del options["pool_size"]
+            options["sqlite_pragmas"] = app.config["SQLITE_PRAGMAS"]
+            return
+        options.setdefault("pool_size", app.config["DATABASE_POOL_SIZE"])
+        options.setdefault("max_overflow", app.config["DATABASE_MAX_OVERFLOW"])
+        options.setdefault("pool_recycle", app.config["DATABASE_POOL_RECYCLE"])
+        options.setdefault("pool_pre_ping", app.config["DATABASE_POOL_PRE_PING"])
+        SQLAlchemy.apply_driver_hacks(self, app, sa_url, options)
+
+    def create_engine(self, sa_url, engine_opts):
+        pragmas = engine_opts.pop("sqlite_pragmas", None)
+        engine = SQLAlchemy.create_engine(self, sa_url, engine_opts)
+        if pragmas:
+            event.listen(engine, "connect", set_sqlite_pragmas(pragmas))
+        return engine
+
+
+def pin_to_primary(session, flush_context):
+    session.pinned = True
+
+
+def stick_to_primary(session):
+    if session.app.replica_binds and has_request_context() \
+            and request.method not in READ_METHODS:
+        flask_session["primary_until"] = \
+            time.time() + session.app.config["REPLICA_STICKY_SECONDS"]
+
+
+db = RoutingSQLAlchemy()
+db.event.listen(db.session, "after_flush", pin_to_primary)
+db.event.listen(db.session, "after_commit", stick_to_primary)
 migrate = Migrate()
 login = LoginManager()
 login.login_view = 'auth.login'
@@ -28,24 +141,56 @@ moment = Moment()
 babel = Babel()
 
 
-def create_app(config_class=Config):
+def _create_base_app(config_class):
     app = Flask(__name__)
     app.config.from_object(config_class)
 
+    binds = dict(app.config.get("SQLALCHEMY_BINDS") or {})
+    app.replica_binds = []
+    for i, uri in enumerate(app.config["SQLALCHEMY_REPLICA_URIS"]):
+        binds[f"replica_{i}"] = uri
+        app.replica_binds.append(f"replica_{i}")
+    app.config["SQLALCHEMY_BINDS"] = binds or None
+
+    from app import slowlog
     db.init_app(app)
+    slowlog.init_app(app)
+    mail.init_app(app)
+    # Neither client touches the network until it is first used.
+    app.redis = InstrumentedRedis.from_url(app.config["REDIS_URL"])
+    app.extensions["elasticsearch"] = ElasticsearchConnection(
+        app.config["ELASTICSEARCH_URL"],
+        timeout=app.config["ELASTICSEARCH_TIMEOUT"],
+        retry_interval=app.config["ELASTICSEARCH_RETRY_INTERVAL"])
+
+    from app import cache
+    cache.init_app(app)
+
+    if not app.debug and not app.testing:
+        configure_logging(app)
+    return app
+
+
+def create_app(config_class=Config):
+    app = _create_base_app(config_class)
     migrate.init_app(app, db)
     login.init_app(app)
-    mail.init_app(app)
     bootstrap.init_app(app)
     moment.init_app(app)
     babel.init_app(app)
-    app.redis = Redis.from_url(app.config["REDIS_URL"])
-    app.job_queue = rq.Queue("microtasks", connection=app.redis)
-
-    if app.config["ELASTICSEARCH_URL"]:
-        app.elasticsearch = Elasticsearch([app.config["ELASTICSEARCH_URL"]])
-        if not app.elasticsearch.indices.exists("task"):
-            app.elasticsearch.indices.create("task")
+    if app.config["TRUSTED_PROXIES"]:
+        app.wsgi_app = ProxyFix(app.wsgi_app,
+                                x_for=app.config["TRUSTED_PROXIES"],
+                                x_proto=app.config["TRUSTED_PROXIES"])
+
+    from app import assets, compression, instrumentation, log, profiling, \
+        ratelimit
+    assets.init_app(app)
+    compression.init_app(app)
+    instrumentation.init_app(app)
+    log.init_app(app)
+    profiling.init_app(app)
+    ratelimit.init_app(app)
 
     from app.errors import bp as errors_bp
     app.register_blueprint(errors_bp)
@@ -56,47 +201,27 @@ def create_app(config_class=Config):
     from app.main import bp as main_bp
     app.register_blueprint(main_bp)
 
+    from app.api import bp as api_bp
+    app.register_blueprint(api_bp, url_prefix='/api')
+
     if not app.debug and not app.testing:
-        if app.config['MAIL_SERVER']:
-            auth = None
-            if app.config['MAIL_USERNAME'] or app.config['MAIL_PASSWORD']:
-                auth = (app.config['MAIL_USERNAME'],
-                        app.config['MAIL_PASSWORD'])
-            secure = None
-            if app.config['MAIL_USE_TLS']:
-                secure = ()
-            mail_handler = SMTPHandler(
-                mailhost=(app.config['MAIL_SERVER'], app.config['MAIL_PORT']),
-                fromaddr='no-reply@' + app.config['MAIL_SERVER'],
-                toaddrs=app.config['ADMINS'], subject='Microblog Failure',
-                credentials=auth, secure=secure)
-            mail_handler.setLevel(logging.ERROR)
-            app.logger.addHandler(mail_handler)
-
-        if app.config['LOG_TO_STDOUT']:
-            stream_handler = logging.StreamHandler()
-            stream_handler.setLevel(logging.INFO)
-            app.logger.addHandler(stream_handler)
-        else:
-            if not os.path.exists('logs'):
-                os.mkdir('logs')
-            file_handler = RotatingFileHandler('logs/microblog.log',
-                                               maxBytes=10240, backupCount=10)
-            file_handler.setFormatter(logging.Formatter(
-                '%(asctime)s %(levelname)s: %(message)s '
-                '[in %(pathname)s:%(lineno)d]'))
-            file_handler.setLevel(logging.INFO)
-            app.logger.addHandler(file_handler)
-
-        app.logger.setLevel(logging.INFO)
         app.logger.info('Microblog startup')
 
     return app
 
 
+def create_worker_app(config_class=Config):
+    """A trimmed application for RQ jobs.
+
+    Jobs need the database, mail, Redis and search, but none of the
+    blueprints, request hooks or template extensions of the web app.
+    """
+    return _create_base_app(config_class)
+
+
 @babel.localeselector
 def get_locale():
     return request.accept_languages.best_match(current_app.config['LANGUAGES'])
 
 
-from app import models
+from app import models, feeds
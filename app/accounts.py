@@ -0,0 +1,170 @@
+import time
+
+import redis
+from flask import current_app
+
+from app import cache, db
+from app.broadcast import replace_unread_notifications
+from app.feeds import rebuild_explore
+from app.models import ArchivedTask, Conversation, FollowSuggestion, Job, \
+    Message, Notification, Participant, Task, User, followers
+from app.search import remove_many_from_index
+
+
+def _chunked(query_ids, delete, after=None, progress=None):
+    """Apply `delete` to ids from `query_ids` a chunk at a time, each chunk
+    in its own short transaction, then `after` to the same ids.
+
+    `delete` must take the rows out of what `query_ids` selects.
+    """
+    chunk_size = current_app.config["ACCOUNT_DELETE_CHUNK_SIZE"]
+    pause = current_app.config["ACCOUNT_DELETE_PAUSE"]
+    total = 0
+    while True:
+        ids = [row[0] for row in query_ids().limit(chunk_size)]
+        if not ids:
+            return total
+        delete(ids)
+        db.session.commit()
+        if after is not None:
+            after(ids)
+        total += len(ids)
+        if progress is not None:
+            progress(len(ids))
+        time.sleep(pause)
+
+
+def _steps(user_id):
+    """(name, query_ids, delete, after) for each kind of row that refers to
+    the user, children before parents."""
+    threads = db.session.query(Participant.conversation_id) \
+        .filter(Participant.user_id == user_id)
+
+    def unindex(ids):
+        remove_many_from_index(Task.__tablename__, ids)
+
+    def delete_threads(ids):
+        # Both sides of each thread go, so the other participants' unread
+        # badges are recomputed once it has.
+        others[:] = [row[0] for row in db.session.query(Participant.user_id)
+                     .filter(Participant.conversation_id.in_(ids),
+                             Participant.user_id != user_id,
+                             Participant.unread_count > 0)]
+        for model in (Message, Participant):
+            model.query.filter(model.conversation_id.in_(ids)) \
+                .delete(synchronize_session=False)
+        Conversation.query.filter(Conversation.id.in_(ids)) \
+            .delete(synchronize_session=False)
+
+    def fix_unread(ids):
+        if others:
+            replace_unread_notifications(others)
+            db.session.commit()
+
+    def unfollowed(ids):
+        # Their two-hop neighbourhood ran through this user.
+        User.query.filter(User.id.in_(ids)) \
+            .update({"suggestions_stale": True}, synchronize_session=False)
+        db.session.commit()
+        cache.publish({"follows": ids})
+
+    others = []
+    return [
+        ("tasks",
+         lambda: db.session.query(Task.id).filter(Task.user_id == user_id),
+         lambda ids: Task.query.filter(Task.id.in_(ids))
+         .delete(synchronize_session=False),
+         unindex),
+        ("archived_tasks",
+         lambda: db.session.query(ArchivedTask.id)
+         .filter(ArchivedTask.user_id == user_id),
+         lambda ids: ArchivedTask.query.filter(ArchivedTask.id.in_(ids))
+         .delete(synchronize_session=False),
+         unindex),
+        ("messages",
+         lambda: db.session.query(Message.id).filter(
+             Message.conversation_id.in_(threads.subquery())),
+         lambda ids: Message.query.filter(Message.id.in_(ids))
+         .delete(synchronize_session=False),
+         None),
+        # Messages from before conversations existed.
+        ("messages",
+         lambda: db.session.query(Message.id).filter(
+             Message.conversation_id.is_(None),
+             db.or_(Message.sender_id == user_id,
+                    Message.recipient_id == user_id)),
+         lambda ids: Message.query.filter(Message.id.in_(ids))
+         .delete(synchronize_session=False),
+         None),
+        ("conversations",
+         lambda: threads.distinct(),
+         delete_threads,
+         fix_unread),
+        ("suggestions",
+         lambda: db.session.query(FollowSuggestion.user_id).filter(
+             FollowSuggestion.suggested_id == user_id),
+         lambda ids: FollowSuggestion.query.filter(
+             FollowSuggestion.suggested_id == user_id,
+             FollowSuggestion.user_id.in_(ids)).delete(synchronize_session=False),
+         None),
+        ("followers",
+         lambda: db.session.query(followers.c.follower_id)
+         .filter(followers.c.followed_id == user_id),
+         lambda ids: db.session.execute(followers.delete().where(db.and_(
+             followers.c.followed_id == user_id,
+             followers.c.follower_id.in_(ids)))),
+         unfollowed),
+        ("followed",
+         lambda: db.session.query(followers.c.followed_id)
+         .filter(followers.c.follower_id == user_id),
+         lambda ids: db.session.execute(followers.delete().where(db.and_(
+             followers.c.follower_id == user_id,
+             followers.c.followed_id.in_(ids)))),
+         lambda ids: cache.publish({"follows": ids})),
+    ]
+
+
+def delete_account(user, progress=None):
+    """Delete `user` and every row that refers to them.
+
+    Rows go ACCOUNT_DELETE_CHUNK_SIZE at a time, each chunk in its own
+    transaction, so no table stays locked for long however much the user
+    had. The user row goes last, in one final transaction with the rows
+    there are only ever a few of: their notifications, which are one per
+    name, their own suggestions and their jobs. `progress`, if given, is
+    called with the number of rows deleted and the total after each chunk.
+
+    The user should be marked deleted first, so they can't add rows while
+    this runs. A failed run can simply be repeated.
+    """
+    user_id = user.id
+    steps = _steps(user_id)
+    total = sum(query_ids().count() for _, query_ids, _, _ in steps)
+    done = 0
+
+    def advance(n):
+        nonlocal done
+        done += n
+        if progress is not None:
+            progress(done, total)
+
+    counts = {}
+    for name, query_ids, delete, after in steps:
+        counts[name] = counts.get(name, 0) + \
+            _chunked(query_ids, delete, after, advance)
+    if counts["tasks"] or counts["archived_tasks"]:
+        try:
+            rebuild_explore()
+        except redis.exceptions.RedisError as e:
+            current_app.logger.warning("Could not rebuild explore cache: %s", e)
+
+    # Jobs last, as this may be running as one of them, reporting progress
+    # through notifications.
+    for model in (Notification, Job, FollowSuggestion):
+        model.query.filter(model.user_id == user_id) \
+            .delete(synchronize_session=False)
+    User.query.filter_by(id=user_id).delete(synchronize_session=False)
+    db.session.commit()
+    db.session.expunge(user)
+    cache.publish({"follows": [user_id]})
+    return counts
@@ -0,0 +1,6 @@
+from flask import Blueprint
+
+bp = Blueprint("api", __name__)
+
+# Avoid circular dependencies.
+from app.api import errors, tokens, tasks, messages, follows
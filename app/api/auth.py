@@ -0,0 +1,46 @@
+from functools import wraps
+
+from flask import _request_ctx_stack, g, request
+
+from app.api.errors import error_response
+from app.models import User
+
+
+def basic_auth_required(f):
+    """Authenticate with a username and password, used to issue tokens."""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        auth = request.authorization
+        user = User.query.filter_by(username=auth.username).first() \
+            if auth and auth.username else None
+        if user is None or user.deleted_at is not None \
+                or not user.check_password(auth.password or ""):
+            return error_response(401)
+        g.current_user = user
+        return f(*args, **kwargs)
+    return decorated
+
+
+def token_user():
+    """The user of the request's bearer token, or None if there is no valid
+    one. Looked up once per request, as rate limiting needs it too, and
+    kept on the request context like Flask-Login's user, since `g` may
+    outlive the request."""
+    ctx = _request_ctx_stack.top
+    if not hasattr(ctx, "token_user"):
+        scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+        ctx.token_user = User.check_token(token.strip()) \
+            if scheme.lower() == "bearer" and token.strip() else None
+    return ctx.token_user
+
+
+def token_auth_required(f):
+    """Authenticate with an `Authorization: Bearer <token>` header."""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        user = token_user()
+        if user is None:
+            return error_response(401)
+        g.current_user = user
+        return f(*args, **kwargs)
+    return decorated
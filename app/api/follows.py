@@ -0,0 +1,35 @@
+from flask import current_app, g, request
+
+from app import db
+from app.api import bp
+from app.api.auth import token_auth_required
+from app.api.errors import bad_request
+from app.api.serializers import json_response
+
+
+def _user_ids():
+    data = request.get_json(silent=True) or {}
+    user_ids = data.get("user_ids")
+    if not isinstance(user_ids, list) or \
+            not all(isinstance(i, int) for i in user_ids):
+        return None
+    return user_ids
+
+
+@bp.route("/follows", methods=["POST", "DELETE"])
+@token_auth_required
+def follows():
+    """Follow (POST) or unfollow (DELETE) the users in the JSON body's
+    `user_ids`, up to FOLLOW_MANY_MAX at once."""
+    user_ids = _user_ids()
+    if user_ids is None:
+        return bad_request("user_ids must be a list of user ids")
+    if len(user_ids) > current_app.config["FOLLOW_MANY_MAX"]:
+        return bad_request(f"At most {current_app.config['FOLLOW_MANY_MAX']} "
+                           f"user ids at once")
+    if request.method == "POST":
+        result = {"followed": g.current_user.follow_many(user_ids)}
+    else:
+        result = {"unfollowed": g.current_user.unfollow_many(user_ids)}
+    db.session.commit()
+    return json_response(result)
@@ -0,0 +1,28 @@
+from flask import g
+
+from app.api import bp
+from app.api.auth import token_auth_required
+from app.api.pagination import keyset_page, page_size
+from app.api.serializers import Serializer, json_response
+from app.models import Message, User
+
+message_serializer = Serializer(
+    id="id",
+    body="body",
+    timestamp="timestamp",
+    sender_id="sender_id",
+    recipient_id="recipient_id",
+    sender="author.username",
+)
+
+
+@bp.route("/messages", methods=["GET"])
+@token_auth_required
+def messages():
+    fields = message_serializer.requested_fields()
+    items, next_cursor = keyset_page(g.current_user.messages_received,
+                                     Message, page_size())
+    if "sender" in fields and items:
+        User.query.filter(User.id.in_({m.sender_id for m in items})).all()
+    return json_response({"items": message_serializer.many(items, fields),
+                          "next_cursor": next_cursor})
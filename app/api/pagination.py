@@ -0,0 +1,48 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime
+
+from flask import abort, current_app, request
+
+from app import db
+
+
+def encode_cursor(obj):
+    raw = f"{obj.timestamp.isoformat()}|{obj.id}"
+    return urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    raw = urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("utf-8")
+    timestamp, _, _id = raw.partition("|")
+    return datetime.fromisoformat(timestamp), int(_id)
+
+
+def page_size():
+    limit = request.args.get("limit", current_app.config["TASKS_PER_PAGE"], type=int)
+    return max(1, min(limit, current_app.config["API_MAX_PAGE_SIZE"]))
+
+
+def keyset_page(query, model, limit):
+    """Return one page of `query` ordered newest first, plus the next cursor.
+
+    Pages are addressed by the (timestamp, id) of the last row seen rather
+    than an OFFSET, so fetching a deep page costs the same as the first.
+    An invalid cursor is a 400, as JSON for the API.
+    """
+    cursor = request.args.get("cursor")
+    if cursor:
+        try:
+            timestamp, _id = decode_cursor(cursor)
+        except (ValueError, UnicodeDecodeError):
+            if request.blueprint != "api":
+                abort(400)
+            from app.api.errors import bad_request
+            abort(bad_request("Invalid cursor"))
+        query = query.filter(db.or_(
+            model.timestamp < timestamp,
+            db.and_(model.timestamp == timestamp, model.id < _id)))
+    items = query.order_by(None) \
+        .order_by(model.timestamp.desc(), model.id.desc()) \
+        .limit(limit + 1).all()
+    next_cursor = encode_cursor(items[limit - 1]) if len(items) > limit else None
+    return items[:limit], next_cursor
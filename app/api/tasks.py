@@ -0,0 +1,125 @@
+import os
+import uuid
+
+from flask import abort, current_app, g, request
+
+from app import db
+from app.api import bp
+from app.api.auth import token_auth_required
+from app.api.errors import bad_request, error_response
+from app.api.pagination import keyset_page, page_size
+from app.api.serializers import Serializer, json_response
+from app.importer import FORMATS, guess_format
+from app.models import Task, User
+from app.queues import JobLimitExceeded
+
+task_serializer = Serializer(
+    id="id",
+    body="body",
+    done="done",
+    timestamp="timestamp",
+    language="language",
+    user_id="user_id",
+    author="author.username",
+)
+
+
+def _load_authors(tasks, fields):
+    # Pull every author on the page into the identity map with one query, so
+    # the `author.username` getter never lazy loads row by row.
+    if "author" in fields and tasks:
+        User.query.filter(User.id.in_({t.user_id for t in tasks})).all()
+
+
+def task_page(query):
+    fields = task_serializer.requested_fields()
+    tasks, next_cursor = keyset_page(query, Task, page_size())
+    _load_authors(tasks, fields)
+    return json_response({"items": task_serializer.many(tasks, fields),
+                          "next_cursor": next_cursor})
+
+
+@bp.route("/feed", methods=["GET"])
+@token_auth_required
+def feed():
+    return task_page(g.current_user.followed_tasks())
+
+
+@bp.route("/explore", methods=["GET"])
+@token_auth_required
+def explore():
+    return task_page(Task.query)
+
+
+@bp.route("/users/<username>/tasks", methods=["GET"])
+@token_auth_required
+def user_tasks(username):
+    user = User.query.filter_by(username=username).first_or_404()
+    return task_page(user.tasks)
+
+
+@bp.route("/search", methods=["GET"])
+@token_auth_required
+def search():
+    q = request.args.get("q", "").strip()
+    if not q:
+        return bad_request("Missing query parameter q")
+    # Search results are ranked by Elasticsearch, so the cursor is simply
+    # the next page number.
+    cursor = request.args.get("cursor", "1")
+    if not cursor.isdigit() or int(cursor) < 1:
+        abort(bad_request("Invalid cursor"))
+    page, per_page = int(cursor), page_size()
+    fields = task_serializer.requested_fields()
+    tasks, total = Task.search(q, page, per_page)
+    _load_authors(tasks, fields)
+    return json_response({
+        "items": task_serializer.many(tasks, fields),
+        "total": total,
+        "next_cursor": str(page + 1) if total > page * per_page else None,
+    })
+
+
+@bp.route("/tasks/import", methods=["POST"])
+@token_auth_required
+def import_tasks():
+    """Queue a bulk import of a JSON Lines or CSV file of tasks.
+
+    The file is sent either as the `file` field of a multipart form or as
+    the raw request body, and is streamed to IMPORT_FOLDER for a worker to
+    pick up. Files over IMPORT_MAX_BYTES are refused with a 413.
+    """
+    limit = current_app.config["IMPORT_MAX_BYTES"]
+    too_large = error_response(413, f"Imports are limited to {limit} bytes")
+    # Checked before the form is parsed, which spools the file to disk.
+    if request.content_length is not None and request.content_length > limit:
+        return too_large
+    upload = request.files.get("file")
+    fmt = request.args.get("format") or \
+        (guess_format(upload.filename) if upload else None) or \
+        ("csv" if request.mimetype == "text/csv" else "jsonl")
+    if fmt not in FORMATS:
+        return bad_request(f"format must be one of {', '.join(FORMATS)}")
+    folder = current_app.config["IMPORT_FOLDER"]
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, f"{uuid.uuid4().hex}.{fmt}")
+    stream = upload.stream if upload else request.stream
+    size = 0
+    with open(path, "wb") as f:
+        # Chunked uploads carry no Content-Length to check up front.
+        for chunk in iter(lambda: stream.read(64 * 1024), b""):
+            size += len(chunk)
+            if size > limit:
+                break
+            f.write(chunk)
+    if size > limit:
+        os.remove(path)
+        return too_large
+    try:
+        job = g.current_user.launch_job("import_tasks", "Importing tasks...",
+                                        path, fmt)
+    except JobLimitExceeded as e:
+        os.remove(path)
+        return error_response(429, str(e))
+    db.session.commit()
+    return json_response({"job_id": job.id}, status=202)
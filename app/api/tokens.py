@@ -0,0 +1,23 @@
+from flask import g
+
+from app import db
+from app.api import bp
+from app.api.auth import basic_auth_required, token_auth_required
+from app.api.serializers import json_response
+
+
+@bp.route("/tokens", methods=["POST"])
+@basic_auth_required
+def get_token():
+    token = g.current_user.get_token()
+    db.session.commit()
+    return json_response({"token": token,
+                          "expiration": g.current_user.token_expiration})
+
+
+@bp.route("/tokens", methods=["DELETE"])
+@token_auth_required
+def revoke_token():
+    g.current_user.revoke_token()
+    db.session.commit()
+    return "", 204
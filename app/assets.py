@@ -0,0 +1,131 @@
+import hashlib
+import json
+import mimetypes
+import os
+
+from flask import safe_join, send_from_directory
+
+from app import compression
+
+MANIFEST = "manifest.json"
+# Fingerprinted files never change, so clients may keep them for a year.
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+
+def fingerprint(name, data):
+    """"js/app.js" -> "js/app.<first 12 hex digits of its SHA-256>.js"."""
+    root, ext = os.path.splitext(name)
+    return f"{root}.{hashlib.sha256(data).hexdigest()[:12]}{ext}"
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "wb") as f:
+        f.write(data)
+    os.replace(path + ".tmp", path)
+
+
+def build(static_folder, output_dir, compress_mimetypes, min_size=0, clean=False):
+    """Copy every file of `static_folder` to its fingerprinted name under
+    `output_dir`, a subfolder of it, with .gz and (with the brotli package)
+    .br siblings for compressible types, and write the manifest that maps
+    the original names to them.
+
+    Outputs are only written when their content changed. Older outputs are
+    kept for pages still referring to them unless `clean` is set.
+    """
+    output = os.path.join(static_folder, output_dir)
+    manifest = {}
+    stats = {"files": 0, "written": 0, "bytes": 0, "gzip_bytes": 0, "br_bytes": 0}
+    for root, dirs, files in os.walk(static_folder):
+        if os.path.abspath(root) == os.path.abspath(static_folder) \
+                and output_dir in dirs:
+            dirs.remove(output_dir)
+        dirs.sort()
+        for name in sorted(files):
+            source = os.path.join(root, name)
+            rel = os.path.relpath(source, static_folder).replace(os.sep, "/")
+            with open(source, "rb") as f:
+                data = f.read()
+            manifest[rel] = fingerprint(rel, data)
+            target = os.path.join(output, manifest[rel])
+            stats["files"] += 1
+            stats["bytes"] += len(data)
+            if not os.path.exists(target):
+                _write(target, data)
+                stats["written"] += 1
+            if mimetypes.guess_type(rel)[0] not in compress_mimetypes \
+                    or len(data) < min_size:
+                continue
+            encodings = [("gzip", ".gz", 9)]
+            if compression.brotli is not None:
+                encodings.append(("br", ".br", 11))
+            for encoding, suffix, level in encodings:
+                if not os.path.exists(target + suffix):
+                    compressed = compression.compress(data, encoding, level)
+                    # Not worth a file, and a request for it, if it is no smaller.
+                    if len(compressed) >= len(data):
+                        continue
+                    _write(target + suffix, compressed)
+                stats[f"{encoding}_bytes"] += os.path.getsize(target + suffix)
+    _write(os.path.join(output, MANIFEST),
+           json.dumps(manifest, indent=2, sort_keys=True).encode())
+    if clean:
+        keep = {MANIFEST} | {path + suffix for path in manifest.values()
+                             for suffix in ("", ".gz", ".br")}
+        for root, _, files in os.walk(output):
+            for name in files:
+                path = os.path.join(root, name)
+                if os.path.relpath(path, output).replace(os.sep, "/") not in keep:
+                    os.remove(path)
+    return stats
+
+
+def load_manifest(app):
+    """Read the manifest `flask assets build` wrote, if there is one."""
+    path = os.path.join(app.static_folder, app.config["ASSETS_DIR"], MANIFEST)
+    try:
+        with open(path) as f:
+            app.extensions["assets_manifest"] = json.load(f)
+    except FileNotFoundError:
+        app.extensions["assets_manifest"] = {}
+
+
+def init_app(app):
+    """Point url_for('static') at the fingerprinted copies, and serve those
+    precompressed and cacheable forever. Off in debug mode, where static
+    files are edited without rebuilding."""
+    if app.debug or app.static_folder is None:
+        return
+    load_manifest(app)
+    prefix = app.config["ASSETS_DIR"] + "/"
+
+    @app.url_defaults
+    def fingerprinted_static_url(endpoint, values):
+        if endpoint == "static":
+            hashed = app.extensions["assets_manifest"].get(values.get("filename"))
+            if hashed is not None:
+                values["filename"] = prefix + hashed
+
+    def static(filename):
+        if not filename.startswith(prefix):
+            return app.send_static_file(filename)
+        options = {"cache_timeout": IMMUTABLE_MAX_AGE}
+        path = safe_join(app.static_folder, filename)
+        encoding = compression.negotiate(
+            [e for e, suffix in (("br", ".br"), ("gzip", ".gz"))
+             if os.path.isfile(path + suffix)])
+        if encoding is not None:
+            response = send_from_directory(
+                app.static_folder, filename + (".br" if encoding == "br" else ".gz"),
+                mimetype=mimetypes.guess_type(filename)[0] or
+                "application/octet-stream", **options)
+            response.headers["Content-Encoding"] = encoding
+        else:
+            response = send_from_directory(app.static_folder, filename, **options)
+        response.vary.add("Accept-Encoding")
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
+
+    app.view_functions["static"] = static
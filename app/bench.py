@@ -0,0 +1,449 @@
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import requests
+from flask import current_app
+from sqlalchemy.exc import OperationalError
+from werkzeug.security import generate_password_hash
+
+from app import create_worker_app, db
+from app.instrumentation import percentile
+from app.models import User, Task, Message, Conversation, Participant, \
+    followers
+from config import Config
+
+BENCH_PREFIX = "bench"
+BENCH_PASSWORD = "bench"
+ROUTES = ["index", "explore", "user", "search", "notifications", "messages",
+          "send_message"]
+WORDS = ["buy", "milk", "call", "mum", "fix", "bike", "write", "report",
+         "water", "plants", "book", "flight", "clean", "desk", "read", "paper"]
+
+class ContentionConfig(Config):
+    # Benchmark processes don't write to the app's log files or Redis, and
+    # aren't rate limited.
+    TESTING = True
+    SLOW_QUERY_MS = 0
+    LOCAL_CACHE_ENABLED = False
+    RATELIMIT_ENABLED = False
+
+
+_csrf_re = re.compile(r'name="csrf_token"[^>]*value="([^"]+)"')
+
+
+def _chunks(rows, size):
+    for i in range(0, len(rows), size):
+        yield rows[i:i + size]
+
+
+def _power_law_weights(n, alpha):
+    """Popularity weights so that a few users attract most of the follows."""
+    return [1.0 / (rank ** alpha) for rank in range(1, n + 1)]
+
+
+def seed(users=1000, tasks_per_user=20, messages=5000, mean_follows=20,
+         alpha=1.2, chunk_size=5000, rng_seed=42):
+    """Bulk insert a synthetic data set of bench users and their activity.
+
+    Follow targets are drawn from a power-law popularity distribution and
+    out-degrees from an exponential one, giving the long-tailed graph real
+    social sites have. Rows bypass the ORM unit of work and go to the
+    database as chunked executemany inserts.
+    """
+    rng = random.Random(rng_seed)
+    password_hash = generate_password_hash(BENCH_PASSWORD)
+    start = db.session.query(db.func.count(User.id)).scalar()
+    now = datetime.utcnow()
+
+    user_rows = [{"username": f"{BENCH_PREFIX}{start + i}",
+                  "email": f"{BENCH_PREFIX}{start + i}@example.com",
+                  "password_hash": password_hash,
+                  "last_seen": now} for i in range(users)]
+    for chunk in _chunks(user_rows, chunk_size):
+        db.session.bulk_insert_mappings(User, chunk)
+    db.session.commit()
+    ids = [row.id for row in db.session.query(User.id).filter(
+        User.username.in_([r["username"] for r in user_rows])).order_by(User.id)]
+
+    cum_weights = []
+    total = 0.0
+    for weight in _power_law_weights(len(ids), alpha):
+        total += weight
+        cum_weights.append(total)
+    popular = ids[:]
+    rng.shuffle(popular)
+    follow_rows = []
+    for follower_id in ids:
+        degree = min(len(ids) - 1, int(rng.expovariate(1.0 / mean_follows)))
+        targets = set(rng.choices(popular, cum_weights=cum_weights, k=degree))
+        targets.discard(follower_id)
+        follow_rows.extend({"follower_id": follower_id, "followed_id": t}
+                           for t in targets)
+    for chunk in _chunks(follow_rows, chunk_size):
+        db.session.execute(followers.insert(), chunk)
+    db.session.commit()
+
+    task_rows = []
+    for user_id in ids:
+        for _ in range(tasks_per_user):
+            task_rows.append({
+                "body": " ".join(rng.choices(WORDS, k=rng.randint(2, 6))),
+                "done": rng.random() < 0.3,
+                "timestamp": now - timedelta(seconds=rng.randint(0, 30 * 86400)),
+                "user_id": user_id,
+                "language": "en",
+            })
+    for chunk in _chunks(task_rows, chunk_size):
+        db.session.bulk_insert_mappings(Task, chunk)
+    db.session.commit()
+
+    message_rows = []
+    for _ in range(messages if len(ids) > 1 else 0):
+        sender_id, recipient_id = rng.sample(ids, 2)
+        message_rows.append({
+            "sender_id": sender_id,
+            "recipient_id": recipient_id,
+            "body": " ".join(rng.choices(WORDS, k=rng.randint(2, 6))),
+            "timestamp": now - timedelta(seconds=rng.randint(0, 30 * 86400)),
+            "key": ":".join(str(i) for i in sorted((sender_id, recipient_id))),
+        })
+    _seed_conversations(message_rows, chunk_size)
+
+    return {"users": len(ids), "follows": len(follow_rows),
+            "tasks": len(task_rows), "messages": len(message_rows)}
+
+
+def _seed_conversations(message_rows, chunk_size):
+    """Insert messages along with their conversations and participants."""
+    keys = sorted({row["key"] for row in message_rows})
+    for chunk in _chunks([{"key": key} for key in keys], chunk_size):
+        db.session.bulk_insert_mappings(Conversation, chunk)
+    db.session.commit()
+    conversation_ids = {}
+    for chunk in _chunks(keys, 500):
+        conversation_ids.update(db.session.query(Conversation.key, Conversation.id)
+                                .filter(Conversation.key.in_(chunk)))
+
+    # Inserted oldest first, so the highest id in a thread is its last message.
+    message_rows.sort(key=lambda row: row["timestamp"])
+    for row in message_rows:
+        row["conversation_id"] = conversation_ids[row.pop("key")]
+    for chunk in _chunks(message_rows, chunk_size):
+        db.session.bulk_insert_mappings(Message, chunk)
+    db.session.commit()
+
+    if not conversation_ids:
+        return
+    latest = db.session.query(
+        Message.conversation_id, db.func.max(Message.id),
+        db.func.max(Message.timestamp)).filter(
+        Message.conversation_id >= min(conversation_ids.values())) \
+        .group_by(Message.conversation_id).all()
+    db.session.bulk_update_mappings(Conversation, [
+        {"id": cid, "last_message_id": mid, "last_timestamp": ts}
+        for cid, mid, ts in latest])
+    participant_rows = []
+    for key, cid in conversation_ids.items():
+        participant_rows.extend({"conversation_id": cid, "user_id": int(user_id),
+                                 "unread_count": 0}
+                                for user_id in key.split(":"))
+    timestamps = {cid: ts for cid, _, ts in latest}
+    for row in participant_rows:
+        row["timestamp"] = timestamps[row["conversation_id"]]
+    for chunk in _chunks(participant_rows, chunk_size):
+        db.session.bulk_insert_mappings(Participant, chunk)
+    db.session.commit()
+
+
+class TestClientSession(object):
+    """Drives the app in-process through the Flask test client."""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def get(self, path):
+        response = self.client.get(path)
+        return response.status_code, response.get_data(as_text=True)
+
+    def post(self, path, data):
+        response = self.client.post(path, data=data)
+        return response.status_code, response.get_data(as_text=True)
+
+
+class HTTPSession(object):
+    """Drives a running server, e.g. gunicorn, over HTTP."""
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip("/")
+        self.session = requests.Session()
+
+    def get(self, path):
+        response = self.session.get(self.base_url + path, allow_redirects=False)
+        return response.status_code, response.text
+
+    def post(self, path, data):
+        response = self.session.post(self.base_url + path, data=data,
+                                     allow_redirects=False)
+        return response.status_code, response.text
+
+
+class BenchUser(object):
+    def __init__(self, session, username, usernames, rng):
+        self.session = session
+        self.username = username
+        self.usernames = usernames
+        self.rng = rng
+        self.csrf_token = None
+
+    def login(self):
+        _, html = self.session.get("/auth/login")
+        match = _csrf_re.search(html)
+        # The CSRF token is tied to the session, so it is reused for every
+        # later form post made by this user.
+        self.csrf_token = match.group(1) if match else None
+        status, _ = self.session.post("/auth/login", {
+            "username": self.username, "password": BENCH_PASSWORD,
+            "csrf_token": self.csrf_token})
+        if status != 302:
+            raise RuntimeError(f"Could not log in as {self.username}")
+
+    def request(self, route):
+        if route == "index":
+            return self.session.get("/index")
+        if route == "explore":
+            return self.session.get("/explore")
+        if route == "user":
+            return self.session.get(f"/user/{self.rng.choice(self.usernames)}")
+        if route == "search":
+            return self.session.get(f"/search?q={self.rng.choice(WORDS)}")
+        if route == "notifications":
+            return self.session.get("/notifications")
+        if route == "messages":
+            return self.session.get("/messages")
+        if route == "send_message":
+            recipient = self.rng.choice(self.usernames)
+            return self.session.post(f"/send_message/{recipient}", {
+                "message": " ".join(self.rng.choices(WORDS, k=4)),
+                "csrf_token": self.csrf_token})
+        raise ValueError(f"Unknown route {route}")
+
+
+def _summarize(samples, elapsed):
+    # 429s are cheap and would flatter the latencies, so they are counted
+    # on their own and left out of everything else.
+    limited = [s for s in samples if s[2] == 429]
+    samples = [s for s in samples if s[2] != 429]
+    latencies = sorted(s[1] * 1000 for s in samples)
+    return {
+        "count": len(samples),
+        "errors": sum(1 for s in samples if s[2] >= 400),
+        "rate_limited": len(limited),
+        "throughput_rps": round(len(samples) / elapsed, 2) if elapsed else 0.0,
+        "mean_ms": round(sum(latencies) / len(latencies), 2) if latencies else 0.0,
+        "p50_ms": round(percentile(latencies, 50), 2),
+        "p95_ms": round(percentile(latencies, 95), 2),
+        "p99_ms": round(percentile(latencies, 99), 2),
+    }
+
+
+def run(routes=None, requests_per_route=100, concurrency=4, base_url=None,
+        rng_seed=42):
+    """Replay a mix of page requests from concurrent logged-in bench users.
+
+    Without `base_url` requests go through the Flask test client of the
+    current app, with rate limiting off; otherwise they are sent over HTTP
+    to a running server, whose rate limited responses are reported apart.
+    """
+    routes = routes or ROUTES
+    usernames = [u.username for u in User.query.filter(
+        User.username.like(f"{BENCH_PREFIX}%")).with_entities(User.username)]
+    if not usernames:
+        raise RuntimeError("No bench users found, run `flask bench seed` first.")
+    app = current_app._get_current_object()
+    rng = random.Random(rng_seed)
+    plan = [route for route in routes for _ in range(requests_per_route)]
+    rng.shuffle(plan)
+    shares = [plan[i::concurrency] for i in range(concurrency)]
+
+    def worker(worker_id):
+        worker_rng = random.Random(rng_seed + worker_id)
+        with app.app_context():
+            session = HTTPSession(base_url) if base_url else TestClientSession(app)
+            user = BenchUser(session, worker_rng.choice(usernames), usernames,
+                             worker_rng)
+            user.login()
+            samples = []
+            for route in shares[worker_id]:
+                start = time.perf_counter()
+                status, _ = user.request(route)
+                samples.append((route, time.perf_counter() - start, status))
+            return samples
+
+    ratelimit_enabled = app.config["RATELIMIT_ENABLED"]
+    if not base_url:
+        app.config["RATELIMIT_ENABLED"] = False
+    start = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            samples = [s for result in executor.map(worker, range(concurrency))
+                       for s in result]
+    finally:
+        app.config["RATELIMIT_ENABLED"] = ratelimit_enabled
+    elapsed = time.perf_counter() - start
+
+    return {
+        "commit": _git_commit(),
+        "mode": "http" if base_url else "test_client",
+        "concurrency": concurrency,
+        "elapsed_s": round(elapsed, 3),
+        "total": _summarize(samples, elapsed),
+        "routes": {route: _summarize([s for s in samples if s[0] == route], elapsed)
+                   for route in routes},
+    }
+
+
+def _contention_worker(role, config_class, uri, pragmas, pool_size, user_ids,
+                       duration, rng_seed):
+    app = create_worker_app(config_class)
+    app.config["SQLALCHEMY_DATABASE_URI"] = uri
+    app.config["SQLITE_PRAGMAS"] = pragmas
+    app.config["SQLITE_POOL_SIZE"] = pool_size
+    rng = random.Random(rng_seed)
+    latencies, errors = [], 0
+    with app.app_context():
+        deadline = time.perf_counter() + duration
+        while time.perf_counter() < deadline:
+            user = User.query.get(rng.choice(user_ids))
+            start = time.perf_counter()
+            try:
+                if role == "write":
+                    # The same write every logged in page view can make.
+                    user.last_seen = datetime.utcnow()
+                    db.session.commit()
+                else:
+                    user.followed_tasks().limit(25).all()
+            except OperationalError:
+                db.session.rollback()
+                errors += 1
+                continue
+            finally:
+                db.session.remove()
+            latencies.append(time.perf_counter() - start)
+    return role, latencies, errors
+
+
+def contention(writers=4, readers=4, duration=5.0, pragmas=None,
+               pool_size=None, rng_seed=42, config_class=ContentionConfig):
+    """Hammer the current SQLite database from separate processes, the way
+    several gunicorn workers do, with `last_seen` style single row writes
+    and home page reads. `pragmas` and `pool_size` default to the app
+    config; pass `pragmas={}` and `pool_size=0` for SQLite's defaults.
+
+    The processes build their apps from `config_class`, a module level
+    class so it can be passed to them, with the current database.
+    """
+    uri = current_app.config["SQLALCHEMY_DATABASE_URI"]
+    if not uri.startswith("sqlite:///") or uri == "sqlite:///:memory:":
+        raise RuntimeError("The contention benchmark needs an SQLite file database.")
+    if pragmas is None:
+        pragmas = current_app.config["SQLITE_PRAGMAS"]
+    if pool_size is None:
+        pool_size = current_app.config["SQLITE_POOL_SIZE"]
+    user_ids = [row[0] for row in db.session.query(User.id).filter(
+        User.username.like(f"{BENCH_PREFIX}%"))]
+    if not user_ids:
+        raise RuntimeError("No bench users found, run `flask bench seed` first.")
+    roles = ["write"] * writers + ["read"] * readers
+    start = time.perf_counter()
+    with ProcessPoolExecutor(len(roles)) as executor:
+        results = list(executor.map(
+            _contention_worker, roles, [config_class] * len(roles),
+            [uri] * len(roles),
+            [pragmas] * len(roles), [pool_size] * len(roles),
+            [user_ids] * len(roles), [duration] * len(roles),
+            range(rng_seed, rng_seed + len(roles))))
+    elapsed = time.perf_counter() - start
+    report = {"commit": _git_commit(), "writers": writers, "readers": readers,
+              "pragmas": pragmas, "pool_size": pool_size}
+    for role in ("write", "read"):
+        latencies = sorted(l * 1000 for r, ls, _ in results if r == role
+                           for l in ls)
+        report[role] = {
+            "count": len(latencies),
+            "errors": sum(e for r, _, e in results if r == role),
+            "throughput_ops": round(len(latencies) / elapsed, 2),
+            "p50_ms": round(percentile(latencies, 50), 2),
+            "p95_ms": round(percentile(latencies, 95), 2),
+            "p99_ms": round(percentile(latencies, 99), 2),
+        }
+    return report
+
+
+def compare(baseline, candidate):
+    """Per-route relative change in p50/p95 latency and throughput."""
+    report = {}
+    for route, new in candidate["routes"].items():
+        old = baseline["routes"].get(route)
+        if not old:
+            continue
+        report[route] = {key: round((new[key] - old[key]) / old[key] * 100, 1)
+                         if old[key] else None
+                         for key in ("p50_ms", "p95_ms", "throughput_rps")}
+    return report
+
+
+def start_gunicorn(workers, port):
+    executable = shutil.which("gunicorn") or \
+        os.path.join(os.path.dirname(sys.executable), "gunicorn")
+    process = subprocess.Popen([executable, "-w", str(workers),
+                                "-b", f"127.0.0.1:{port}", "microblog:app"])
+    url = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        if process.poll() is not None:
+            break
+        try:
+            requests.get(url + "/auth/login", timeout=1)
+            return process, url
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("gunicorn did not start")
+
+
+STARTUP_COMMANDS = {
+    "flask_help": ["-m", "flask", "--help"],
+    "import_web_app": ["-c", "import microblog"],
+    "import_jobs": ["-c", "import app.jobs"],
+    "worker_app": ["-c", "from app import create_worker_app; create_worker_app()"],
+}
+
+
+def startup(runs=5):
+    """Wall-clock time of fresh interpreters booting the app in various ways."""
+    report = {}
+    for name, args in STARTUP_COMMANDS.items():
+        timings = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            subprocess.run([sys.executable] + args, check=True,
+                           stdout=subprocess.DEVNULL)
+            timings.append((time.perf_counter() - start) * 1000)
+        timings.sort()
+        report[name] = {"min_ms": round(timings[0], 1),
+                        "p50_ms": round(percentile(timings, 50), 1)}
+    return {"commit": _git_commit(), "runs": runs, "startup": report}
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
@@ -0,0 +1,113 @@
+import json
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy.exc import IntegrityError
+
+from app import db
+from app.models import Conversation, Message, Notification, Participant, \
+    User, followers
+
+
+def _conversation_ids(sender, recipient_ids):
+    """Map each recipient id to its thread with `sender`, creating the
+    missing threads and their participant rows with bulk inserts."""
+    # The same "<lower id>:<higher id>" keys as Conversation.key_for.
+    keys = {":".join(str(i) for i in sorted((sender.id, r))): r
+            for r in recipient_ids}
+    found = dict(db.session.query(Conversation.key, Conversation.id)
+                 .filter(Conversation.key.in_(keys)).all())
+    missing = [key for key in keys if key not in found]
+    if missing:
+        now = datetime.utcnow()
+        db.session.execute(Conversation.__table__.insert(),
+                           [{"key": key} for key in missing])
+        created = dict(db.session.query(Conversation.key, Conversation.id)
+                       .filter(Conversation.key.in_(missing)).all())
+        db.session.execute(Participant.__table__.insert(), [
+            {"conversation_id": created[key], "user_id": user_id,
+             "unread_count": 0, "timestamp": now}
+            for key in missing for user_id in (sender.id, keys[key])])
+        found.update(created)
+    return {keys[key]: conversation_id for key, conversation_id in found.items()}
+
+
+def _send_chunk(sender, body, recipient_ids):
+    threads = _conversation_ids(sender, recipient_ids)
+    thread_ids = list(threads.values())
+    now = datetime.utcnow()
+    db.session.execute(Message.__table__.insert(), [
+        {"sender_id": sender.id, "recipient_id": r, "body": body,
+         "timestamp": now, "conversation_id": threads[r]}
+        for r in recipient_ids])
+    message, conversation, participant = \
+        Message.__table__, Conversation.__table__, Participant.__table__
+    db.session.execute(conversation.update()
+                       .where(conversation.c.id.in_(thread_ids))
+                       .values(last_timestamp=now, last_message_id=db.select(
+                           [db.func.max(message.c.id)])
+                           .where(message.c.conversation_id == conversation.c.id)
+                           .as_scalar()))
+    db.session.execute(participant.update()
+                       .where(participant.c.conversation_id.in_(thread_ids))
+                       .values(timestamp=now, unread_count=db.case(
+                           [(participant.c.user_id != sender.id,
+                             participant.c.unread_count + 1)],
+                           else_=participant.c.unread_count)))
+    replace_unread_notifications(recipient_ids)
+
+
+def replace_unread_notifications(user_ids):
+    """Reset the unread badge of each of `user_ids` to the sum of their
+    threads' unread counts, in two statements."""
+    counts = dict(db.session.query(Participant.user_id,
+                                   db.func.sum(Participant.unread_count))
+                  .filter(Participant.user_id.in_(user_ids))
+                  .group_by(Participant.user_id))
+    Notification.query.filter(Notification.name == "unread_message_count",
+                              Notification.user_id.in_(user_ids)) \
+        .delete(synchronize_session=False)
+    db.session.execute(Notification.__table__.insert(), [
+        {"name": "unread_message_count", "user_id": user_id,
+         "payload_json": json.dumps(int(counts.get(user_id, 0)))}
+        for user_id in user_ids])
+
+
+def broadcast(sender, body, chunk_size=None, progress=None):
+    """Send `body` as a private message to each of the sender's followers.
+
+    Followers are paged through by id, a chunk at a time, each chunk in
+    its own transaction, with bulk inserts for the messages and any new
+    threads and a single UPDATE each for the threads and the unread
+    counts. Accounts being deleted are skipped. `progress`, if given, is
+    called with the number of followers done and the total counted at the
+    start after each chunk.
+    """
+    chunk_size = chunk_size or current_app.config["BROADCAST_CHUNK_SIZE"]
+    recipients = db.session.query(followers.c.follower_id) \
+        .join(User, User.id == followers.c.follower_id) \
+        .filter(followers.c.followed_id == sender.id,
+                followers.c.follower_id != sender.id,
+                User.deleted_at.is_(None)).distinct()
+    total = recipients.count()
+    sent, last = 0, 0
+    while True:
+        chunk = [row[0] for row in recipients
+                 .filter(followers.c.follower_id > last)
+                 .order_by(followers.c.follower_id).limit(chunk_size)]
+        if not chunk:
+            break
+        last = chunk[-1]
+        try:
+            _send_chunk(sender, body, chunk)
+            db.session.commit()
+        except IntegrityError:
+            # A message sent meanwhile created one of the threads; the
+            # retry finds it.
+            db.session.rollback()
+            _send_chunk(sender, body, chunk)
+            db.session.commit()
+        sent += len(chunk)
+        if progress is not None:
+            progress(sent, max(total, sent))
+    return sent
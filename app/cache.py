@@ -0,0 +1,191 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import redis
+from flask import current_app
+
+from app import db
+
+VERSION_KEY = "cache-version:{}"
+
+
+class LocalCache(object):
+    """A per-process LRU cache kept fresh by an invalidation bus.
+
+    Writers publish `(kind, ids)` messages on a Redis channel after they
+    commit, and a subscriber thread in every process evicts the matching
+    entries. Each kind also has a version counter in Redis that every
+    message carries: a jump in versions, or a reconnect, means messages
+    were missed, and the whole kind is dropped. Entries are only served
+    while the subscriber is connected; otherwise every lookup goes to the
+    loader.
+    """
+
+    def __init__(self, client, channel, size=10000, ttl=300):
+        self.client = client
+        self.channel = channel
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.versions = {}
+        self.evictions = 0
+        self.connected = False
+        self.pid = None
+
+    def get(self, kind, key, loader):
+        self._ensure_subscriber()
+        if not self.connected:
+            return loader()
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get((kind, key))
+            if entry is not None and entry[1] > now:
+                self.entries.move_to_end((kind, key))
+                return entry[0]
+            evictions = self.evictions
+        value = loader()
+        with self.lock:
+            # Not stored if anything was evicted while it loaded, as the
+            # value may predate that change.
+            if self.connected and evictions == self.evictions:
+                self.entries[(kind, key)] = (value, now + self.ttl)
+                self.entries.move_to_end((kind, key))
+                while len(self.entries) > self.size:
+                    self.entries.popitem(last=False)
+        return value
+
+    def invalidate(self, kind, keys):
+        with self.lock:
+            self.evictions += 1
+            for key in keys:
+                self.entries.pop((kind, key), None)
+
+    def clear(self, kind=None):
+        with self.lock:
+            self.evictions += 1
+            if kind is None:
+                self.entries.clear()
+            else:
+                for entry in [e for e in self.entries if e[0] == kind]:
+                    del self.entries[entry]
+
+    def _ensure_subscriber(self):
+        # Per process: a forked gunicorn worker starts its own thread.
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.connected = False
+            self.entries.clear()
+        threading.Thread(target=self._listen, name="cache-invalidation",
+                         daemon=True).start()
+
+    def _sync_versions(self):
+        kinds = list(self.versions)
+        current = self.client.mget([VERSION_KEY.format(k) for k in kinds]) \
+            if kinds else []
+        for kind, version in zip(kinds, current):
+            version = int(version or 0)
+            if version != self.versions[kind]:
+                self.clear(kind)
+                self.versions[kind] = version
+
+    def handle(self, message):
+        data = json.loads(message["data"])
+        kind, version = data["kind"], data["version"]
+        known = self.versions.get(kind)
+        if known is not None and version > known + 1:
+            self.clear(kind)
+        else:
+            self.invalidate(kind, data["ids"])
+        self.versions[kind] = max(version, known or 0)
+
+    def _listen(self):
+        pid, backoff = self.pid, 1
+        while self.pid == pid:
+            try:
+                pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                # Subscribed first, so nothing published after the versions
+                # are read can be missed.
+                self._sync_versions()
+                self.connected, backoff = True, 1
+                while self.pid == pid:
+                    message = pubsub.get_message(timeout=1.0)
+                    if message is not None and message["type"] == "message":
+                        self.handle(message)
+            except (redis.exceptions.RedisError, OSError):
+                self.connected = False
+                self.clear()
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 30)
+
+
+def cached(kind, key, loader):
+    """`loader()`, served from the process cache until a change to `key`
+    of this kind is published. On a miss it reads from the primary: a
+    replica's value may already be stale, and nothing would evict it."""
+    cache = current_app.extensions.get("local_cache")
+    if cache is None:
+        return loader()
+
+    def load():
+        with db.session().primary():
+            return loader()
+
+    return cache.get(kind, key, load)
+
+
+def publish(changes):
+    """Evict `{kind: ids}` from this process now and from every other
+    process through the bus."""
+    changes = {kind: sorted(ids) for kind, ids in changes.items() if ids}
+    if not changes:
+        return
+    cache = current_app.extensions.get("local_cache")
+    if cache is None:
+        return
+    for kind, ids in changes.items():
+        cache.invalidate(kind, ids)
+    try:
+        pipe = current_app.redis.pipeline()
+        for kind in changes:
+            pipe.incr(VERSION_KEY.format(kind))
+        versions = pipe.execute()
+        pipe = current_app.redis.pipeline()
+        for (kind, ids), version in zip(changes.items(), versions):
+            pipe.publish(cache.channel, json.dumps(
+                {"kind": kind, "ids": ids, "version": version}))
+        pipe.execute()
+    except redis.exceptions.RedisError as e:
+        # Subscribers that lost Redis too serve nothing from cache; any
+        # others keep the stale entries for at most LOCAL_CACHE_TTL.
+        current_app.logger.warning("Could not publish cache invalidation: %s", e)
+
+
+def record(session, kind, ids):
+    """Queue `ids` of `kind` to be published when `session` commits, for
+    changes the flush hooks can't see, such as bulk statements."""
+    session.info.setdefault("cache_invalidations", {}) \
+        .setdefault(kind, set()).update(ids)
+
+
+def publish_pending(session):
+    publish(session.info.pop("cache_invalidations", {}))
+
+
+def discard_pending(session):
+    session.info.pop("cache_invalidations", None)
+
+
+def init_app(app):
+    if app.config["LOCAL_CACHE_ENABLED"]:
+        app.extensions["local_cache"] = LocalCache(
+            app.redis, app.config["CACHE_BUS_CHANNEL"],
+            size=app.config["LOCAL_CACHE_SIZE"], ttl=app.config["LOCAL_CACHE_TTL"])
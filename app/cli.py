@@ -1,3 +1,4 @@
+import json
 import os
 import click
 
@@ -33,3 +34,353 @@ def register(app):
         """Compile all languages."""
         if os.system('pybabel compile -d app/translations'):
             raise RuntimeError('compile command failed')
+
+    @app.cli.group()
+    def bench():
+        """Synthetic data and load benchmark commands."""
+        pass
+
+    @bench.command()
+    @click.option('--users', default=1000, help='Number of users to create.')
+    @click.option('--tasks-per-user', default=20)
+    @click.option('--messages', default=5000)
+    @click.option('--mean-follows', default=20,
+                  help='Mean number of users each user follows.')
+    @click.option('--alpha', default=1.2,
+                  help='Power-law exponent of follower popularity.')
+    @click.option('--seed', 'rng_seed', default=42)
+    def seed(users, tasks_per_user, messages, mean_follows, alpha, rng_seed):
+        """Bulk insert synthetic users, follows, tasks and messages."""
+        from app import bench as bench_module
+        counts = bench_module.seed(users=users, tasks_per_user=tasks_per_user,
+                                   messages=messages, mean_follows=mean_follows,
+                                   alpha=alpha, rng_seed=rng_seed)
+        click.echo(json.dumps(counts))
+
+    @bench.command()
+    @click.option('--routes', default=None,
+                  help='Comma separated routes to drive (default: all).')
+    @click.option('--requests', 'requests_per_route', default=100,
+                  help='Requests per route.')
+    @click.option('--concurrency', default=4)
+    @click.option('--url', default=None,
+                  help='Benchmark a running server instead of the test client.')
+    @click.option('--gunicorn', 'gunicorn_workers', default=0,
+                  help='Start a local gunicorn with this many workers.')
+    @click.option('--port', default=8765)
+    @click.option('--output', type=click.File('w'), default='-')
+    def run(routes, requests_per_route, concurrency, url, gunicorn_workers,
+            port, output):
+        """Drive the main routes and report latency percentiles as JSON."""
+        from app import bench as bench_module
+        process = None
+        if gunicorn_workers:
+            process, url = bench_module.start_gunicorn(gunicorn_workers, port)
+        try:
+            report = bench_module.run(routes=routes.split(',') if routes else None,
+                                      requests_per_route=requests_per_route,
+                                      concurrency=concurrency, base_url=url)
+        finally:
+            if process is not None:
+                process.terminate()
+                process.wait()
+        json.dump(report, output, indent=2)
+        output.write('\n')
+
+    @bench.command()
+    @click.option('--writers', default=4, help='Writing processes.')
+    @click.option('--readers', default=4, help='Reading processes.')
+    @click.option('--duration', default=5.0, help='Seconds to run for.')
+    @click.option('--sqlite-defaults', is_flag=True,
+                  help='No PRAGMAs and no pooling, for comparison.')
+    def contention(writers, readers, duration, sqlite_defaults):
+        """Concurrent SQLite writes and reads from several processes."""
+        from app import bench as bench_module
+        options = {'pragmas': {}, 'pool_size': 0} if sqlite_defaults else {}
+        click.echo(json.dumps(bench_module.contention(
+            writers=writers, readers=readers, duration=duration, **options),
+            indent=2))
+
+    @bench.command()
+    @click.option('--runs', default=5)
+    def startup(runs):
+        """Measure CLI, web app and worker boot times in fresh processes."""
+        from app import bench as bench_module
+        click.echo(json.dumps(bench_module.startup(runs), indent=2))
+
+    @bench.command()
+    @click.argument('baseline', type=click.File())
+    @click.argument('candidate', type=click.File())
+    def compare(baseline, candidate):
+        """Show the percentage change between two `bench run` reports."""
+        from app import bench as bench_module
+        click.echo(json.dumps(bench_module.compare(json.load(baseline),
+                                                   json.load(candidate)),
+                              indent=2))
+
+    @app.cli.group()
+    def worker():
+        """Background job worker commands."""
+        pass
+
+    @worker.command()
+    @click.option('--processes', default=None, type=int,
+                  help='Number of worker processes (default: WORKER_PROCESSES).')
+    def supervise(processes):
+        """Run a pool of RQ workers across the priority queues."""
+        from app import workers
+        config = app.config
+        plan = workers.plan_workers(processes or config['WORKER_PROCESSES'],
+                                    config['WORKER_WEIGHTS'],
+                                    list(config['RQ_QUEUES']))
+        supervisor = workers.Supervisor(
+            plan, config['REDIS_URL'], config['RQ_QUEUES'],
+            shutdown_timeout=config['WORKER_SHUTDOWN_TIMEOUT'],
+            metrics_interval=config['WORKER_METRICS_INTERVAL'], log=click.echo)
+        if not supervisor.run(metrics=workers.queue_metrics):
+            raise click.ClickException('The workers kept exiting on start')
+
+    @worker.command()
+    def metrics():
+        """Show the depth and wait times of every job queue as JSON."""
+        from app import workers
+        click.echo(json.dumps(workers.queue_metrics(), indent=2))
+
+    @app.cli.group()
+    def maintenance():
+        """Database retention and upkeep commands."""
+        pass
+
+    @maintenance.command('run')
+    @click.argument('tasks', nargs=-1)
+    def run_maintenance(tasks):
+        """Run maintenance tasks once (default: all of them)."""
+        from app import maintenance as maintenance_module
+        unknown = set(tasks) - set(maintenance_module.TASKS)
+        if unknown:
+            raise click.BadParameter(', '.join(sorted(unknown)), param_hint='TASKS')
+        for name in tasks or maintenance_module.TASKS:
+            result = maintenance_module.run_task(name)
+            click.echo(f'{name}: {json.dumps(result)}')
+
+    @maintenance.command()
+    @click.option('--tick', default=60, help='Seconds between schedule checks.')
+    def schedule(tick):
+        """Keep running, and run each task when MAINTENANCE_SCHEDULE says so."""
+        from app import maintenance as maintenance_module
+        maintenance_module.schedule(tick)
+
+    @app.cli.group()
+    def tasks():
+        """Task data commands."""
+        pass
+
+    @tasks.command('import')
+    @click.argument('username')
+    @click.argument('path', type=click.Path(exists=True, dir_okay=False))
+    @click.option('--format', 'fmt', type=click.Choice(['jsonl', 'csv']),
+                  default=None, help='Default: guessed from the file name.')
+    @click.option('--chunk-size', default=None, type=int)
+    @click.option('--processes', default=None, type=int,
+                  help='Language detection processes, 0 to detect in-process.')
+    def import_tasks(username, path, fmt, chunk_size, processes):
+        """Bulk import tasks for a user from a JSON Lines or CSV file."""
+        from app import importer
+        from app.models import User
+        user = User.query.filter_by(username=username).first()
+        if user is None:
+            raise click.BadParameter(f'No user {username}', param_hint='USERNAME')
+        with open(path, 'rb') as f:
+            try:
+                total = importer.import_tasks(
+                    user, f, fmt or importer.guess_format(path),
+                    chunk_size=chunk_size, processes=processes,
+                    progress=lambda n: click.echo(f'{n} tasks imported', err=True))
+            except importer.InvalidImport as e:
+                raise click.ClickException(str(e))
+        click.echo(json.dumps({'imported': total}))
+
+    @app.cli.group()
+    def accounts():
+        """User account commands."""
+        pass
+
+    @accounts.command('delete')
+    @click.argument('username')
+    @click.confirmation_option(prompt='Delete this account and all its data?')
+    def delete_account(username):
+        """Lock an account and delete it and its data, in the foreground.
+
+        Also finishes a deletion whose job failed part way.
+        """
+        from datetime import datetime
+        from app import accounts as accounts_module
+        from app import db
+        from app.models import User
+        user = User.query.filter_by(username=username).first()
+        if user is None:
+            raise click.BadParameter(f'No user {username}', param_hint='USERNAME')
+        if user.deleted_at is None:
+            user.deleted_at = datetime.utcnow()
+            user.revoke_token()
+            db.session.commit()
+        counts = accounts_module.delete_account(
+            user, progress=lambda done, total: click.echo(
+                f'{done}/{total} rows deleted', err=True))
+        click.echo(json.dumps(counts))
+
+    @app.cli.group()
+    def follows():
+        """Follow graph commands."""
+        pass
+
+    @follows.command('import')
+    @click.argument('path', type=click.Path(exists=True, dir_okay=False))
+    @click.option('--format', 'fmt', type=click.Choice(['jsonl', 'csv']),
+                  default=None, help='Default: guessed from the file name.')
+    @click.option('--by', 'key', type=click.Choice(['username', 'id']),
+                  default='username', help='How the records name users.')
+    @click.option('--chunk-size', default=None, type=int)
+    def import_follows(path, fmt, key, chunk_size):
+        """Bulk import follows from a JSON Lines or CSV file of follower
+        and followed users, e.g. exported from another system."""
+        from app import importer
+        with open(path, 'rb') as f:
+            try:
+                result = importer.import_follows(
+                    f, fmt or importer.guess_format(path), key=key,
+                    chunk_size=chunk_size,
+                    progress=lambda n: click.echo(f'{n} records read', err=True))
+            except importer.InvalidImport as e:
+                raise click.ClickException(str(e))
+        click.echo(json.dumps(result))
+
+    @app.cli.group()
+    def profile():
+        """Sampled request and job profiles."""
+        pass
+
+    @profile.command()
+    @click.option('--top', default=20, help='Functions to show per endpoint.')
+    @click.option('--sort', type=click.Choice(['cumulative', 'tottime']),
+                  default='cumulative')
+    @click.option('--name', default=None,
+                  help='Only this endpoint or job, e.g. main.index.')
+    @click.option('--json', 'as_json', is_flag=True)
+    def report(top, sort, name, as_json):
+        """Aggregate the saved profiles and show the heaviest functions."""
+        from app import profiling
+        result = profiling.report(app.config['PROFILE_DIR'], top=top, sort=sort,
+                                  name=name)
+        if as_json:
+            click.echo(json.dumps(result, indent=2))
+            return
+        for target, data in result.items():
+            click.echo(f'{target} ({data["samples"]} samples, '
+                       f'{data["total_s"]:.3f}s)')
+            for row in data['functions']:
+                click.echo(f'  {row["cumtime"]:10.4f} {row["tottime"]:10.4f} '
+                           f'{row["calls"]:8d}  {row["function"]}')
+
+    @profile.command()
+    def token():
+        """Print a token that forces profiling of requests sending it in
+        the PROFILE_HEADER header."""
+        from app import profiling
+        click.echo(profiling.make_token(app))
+
+    @app.cli.group()
+    def slowlog():
+        """Slow SQL query log commands."""
+        pass
+
+    @slowlog.command()
+    @click.option('--top', default=20, help='Number of statements to show.')
+    @click.option('--path', default=None, type=click.Path(dir_okay=False),
+                  help='Default: SLOW_QUERY_LOG.')
+    def summary(top, path):
+        """Show the statements that spent the most total time, as JSON,
+        from the log and its rotated files."""
+        import glob
+        from app import slowlog as slowlog_module
+        path = path or app.config['SLOW_QUERY_LOG']
+        paths = [p for p in [path] + glob.glob(glob.escape(path) + '.*')
+                 if os.path.isfile(p)]
+        if not paths:
+            raise click.ClickException(f'No slow query log at {path}')
+
+        def lines():
+            for p in paths:
+                with open(p) as f:
+                    yield from f
+
+        click.echo(json.dumps(slowlog_module.summarize(lines(), top), indent=2))
+
+    @app.cli.group()
+    def assets():
+        """Static asset commands."""
+        pass
+
+    @assets.command()
+    @click.option('--clean', is_flag=True,
+                  help='Remove outputs the new manifest no longer refers to.')
+    def build(clean):
+        """Fingerprint and precompress the static files."""
+        from app import assets as assets_module
+        if not os.path.isdir(app.static_folder):
+            raise click.ClickException(f'No static folder at {app.static_folder}')
+        click.echo(json.dumps(assets_module.build(
+            app.static_folder, app.config['ASSETS_DIR'],
+            app.config['COMPRESS_MIMETYPES'],
+            min_size=app.config['COMPRESS_MIN_SIZE'], clean=clean)))
+
+    @app.cli.group()
+    def suggestions():
+        """Follow suggestion ("who to follow") commands."""
+        pass
+
+    @suggestions.command()
+    @click.option('--full', is_flag=True,
+                  help='Recompute every user, not just the stale ones.')
+    def refresh(full):
+        """Recompute follow suggestions from the follow graph."""
+        from app import suggestions as suggestions_module
+        click.echo(json.dumps({'users': suggestions_module.refresh(full=full)}))
+
+    @app.cli.command()
+    @click.argument('paths', nargs=-1)
+    @click.option('--since', default=None,
+                  help='Only requests in the last so many minutes (30m), '
+                       'hours (2h) or days (1d).')
+    @click.option('--format', 'fmt', type=click.Choice(['json', 'csv']),
+                  default='json')
+    @click.option('--sort', type=click.Choice(['count', 'total_ms', 'p95_ms']),
+                  default='total_ms')
+    @click.option('--top', default=None, type=int)
+    @click.option('--processes', default=None, type=int,
+                  help='Files read in parallel (default: one per CPU).')
+    def logstats(paths, since, fmt, sort, top, processes):
+        """Per-route request counts and latencies from app or gunicorn logs.
+
+        PATHS default to logs/microblog.log*; gzipped files are read as
+        they are and - reads standard input.
+        """
+        import glob
+        from datetime import datetime, timedelta, timezone
+        from app import logstats as logstats_module
+        paths = list(paths) or sorted(glob.glob('logs/microblog.log*'))
+        cutoff = None
+        if since:
+            units = {'m': 'minutes', 'h': 'hours', 'd': 'days'}
+            if since[-1:] not in units or not since[:-1].isdigit():
+                raise click.BadParameter(since, param_hint='--since')
+            cutoff = datetime.now(timezone.utc) - \
+                timedelta(**{units[since[-1]]: int(since[:-1])})
+        summary = logstats_module.summarize(paths, cutoff, processes,
+                                            logstats_module.url_rules(app))
+        summary.sort(key=lambda row: row[sort] or 0, reverse=True)
+        summary = summary[:top] if top else summary
+        if fmt == 'csv':
+            logstats_module.write_csv(summary, click.get_text_stream('stdout'))
+        else:
+            click.echo(json.dumps(summary, indent=2))
@@ -0,0 +1,92 @@
+import zlib
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def compressor(encoding, level):
+    """(compress, flush, finish) functions of an incremental "br" or "gzip"
+    compressor. `flush` returns everything compressed so far, so a stream
+    can be sent a chunk at a time."""
+    if encoding == "br":
+        c = brotli.Compressor(quality=level)
+        return c.process, c.flush, c.finish
+    c = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return c.compress, lambda: c.flush(zlib.Z_SYNC_FLUSH), c.flush
+
+
+def compress(data, encoding, level):
+    compress_, _, finish = compressor(encoding, level)
+    return compress_(data) + finish()
+
+
+def negotiate(encodings=("br", "gzip")):
+    """The first of `encodings` the client accepts, or None."""
+    for encoding in encodings:
+        if encoding == "br" and brotli is None:
+            continue
+        if request.accept_encodings[encoding]:
+            return encoding
+    return None
+
+
+def _stream(chunks, close, encoding, level):
+    compress_, flush, finish = compressor(encoding, level)
+    try:
+        for chunk in chunks:
+            data = compress_(chunk) + flush()
+            if data:
+                yield data
+        yield finish()
+    finally:
+        if close is not None:
+            close()
+
+
+def _compressible(app, response):
+    if response.direct_passthrough or "Content-Encoding" in response.headers:
+        # Files, which send_file streams from disk; see app.assets for
+        # precompressed static files.
+        return False
+    if response.status_code < 200 or response.status_code in (204, 206, 304):
+        return False
+    if "no-transform" in response.headers.get("Cache-Control", ""):
+        return False
+    return response.mimetype in app.config["COMPRESS_MIMETYPES"]
+
+
+def init_app(app):
+    if not app.config["COMPRESS_ENABLED"]:
+        return
+
+    @app.after_request
+    def compress_response(response):
+        if not _compressible(app, response):
+            return response
+        response.vary.add("Accept-Encoding")
+        encoding = negotiate()
+        if encoding is None or request.method == "HEAD":
+            return response
+        level = app.config["COMPRESS_BROTLI_QUALITY"] if encoding == "br" \
+            else app.config["COMPRESS_GZIP_LEVEL"]
+        if response.is_streamed:
+            # Every chunk is flushed as it comes, so streamed pages still
+            # reach the client a piece at a time.
+            response.response = _stream(
+                response.iter_encoded(),
+                getattr(response.response, "close", None), encoding, level)
+            response.headers.pop("Content-Length", None)
+        else:
+            data = response.get_data()
+            if len(data) < app.config["COMPRESS_MIN_SIZE"]:
+                return response
+            response.set_data(compress(data, encoding, level))
+        response.headers["Content-Encoding"] = encoding
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
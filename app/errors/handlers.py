@@ -1,12 +1,31 @@
-from flask import render_template
+from flask import make_response, render_template, request
 from app import db
+from app.api.errors import error_response as api_error_response
 from app.errors import bp
 
+
+def wants_json_response():
+    return request.blueprint == "api" or \
+        request.accept_mimetypes["application/json"] >= \
+        request.accept_mimetypes["text/html"]
+
+
 @bp.app_errorhandler(404)
 def not_found_error(error):
     return render_template("errors/404.html"), 404
 
 
+@bp.app_errorhandler(429)
+def too_many_requests(error):
+    if wants_json_response():
+        response = api_error_response(429, error.description)
+    else:
+        response = make_response(render_template("errors/429.html"), 429)
+    if getattr(error, "retry_after", None) is not None:
+        response.headers["Retry-After"] = str(error.retry_after)
+    return response
+
+
 @bp.app_errorhandler(500)
 def internal_error(error):
     db.session.rollback()
@@ -0,0 +1,140 @@
+import uuid
+
+import redis
+from flask import current_app
+from sqlalchemy import inspect
+
+from app import db
+from app.models import Task
+
+EXPLORE_KEY = "explore:task_ids"
+EXPLORE_WARM_KEY = "explore:warm"
+EXPLORE_LOCK_KEY = "explore:rebuild"
+
+
+def _cache_size():
+    return current_app.config["EXPLORE_CACHE_SIZE"]
+
+
+def _newest_ids():
+    return [row.id for row in db.session.query(Task.id)
+            .order_by(Task.timestamp.desc(), Task.id.desc())
+            .limit(_cache_size())]
+
+
+def rebuild_explore(attempts=3):
+    """Replace the cached explore list with the newest task ids from the DB.
+
+    The new list is built under a temporary key and renamed over the old
+    one, in a transaction that fails if a commit pushed to the list after
+    the query, so that task isn't lost; the rebuild is then retried.
+    Returns whether the list was replaced.
+    """
+    r = current_app.redis
+    temp_key = f"{EXPLORE_KEY}:{uuid.uuid4().hex}"
+    with r.pipeline() as pipe:
+        for _ in range(attempts):
+            try:
+                pipe.watch(EXPLORE_KEY)
+                ids = _newest_ids()
+                if ids:
+                    r.pipeline().rpush(temp_key, *ids).expire(temp_key, 60) \
+                        .execute()
+                pipe.multi()
+                if ids:
+                    pipe.rename(temp_key, EXPLORE_KEY)
+                else:
+                    pipe.delete(EXPLORE_KEY)
+                # The list is rebuilt from scratch every so often, which
+                # heals any drift from writes that bypassed the session,
+                # e.g. bulk inserts.
+                pipe.set(EXPLORE_WARM_KEY, 1,
+                         ex=current_app.config["EXPLORE_CACHE_TTL"])
+                pipe.execute()
+                return True
+            except redis.exceptions.WatchError:
+                r.delete(temp_key)
+    return False
+
+
+def _ensure_warm():
+    r = current_app.redis
+    if r.exists(EXPLORE_WARM_KEY):
+        return True
+    # Only one process rebuilds; the others read from the DB meanwhile.
+    if not r.set(EXPLORE_LOCK_KEY, 1, nx=True, ex=30):
+        return False
+    try:
+        return rebuild_explore()
+    finally:
+        r.delete(EXPLORE_LOCK_KEY)
+
+
+def _explore_from_cache(page, per_page):
+    start = (page - 1) * per_page
+    cache_size = _cache_size()
+    if start + per_page > cache_size or not _ensure_warm():
+        return None
+    ids = [int(i) for i in current_app.redis.lrange(
+        EXPLORE_KEY, start, start + per_page)]
+    # The page is the last one the cache can hold, and the DB may have more.
+    has_next = len(ids) > per_page or \
+        (start + per_page == cache_size and len(ids) == per_page)
+    ids = ids[:per_page]
+    tasks = {t.id: t for t in Task.query.filter(Task.id.in_(ids))} if ids else {}
+    return [tasks[i] for i in ids if i in tasks], has_next
+
+
+def explore_page(page, per_page):
+    """Return the tasks on one explore page and whether another page exists.
+
+    The first EXPLORE_CACHE_SIZE tasks come from a Redis list of ids shared
+    by every viewer, so the page costs one LRANGE and a primary key lookup.
+    Deeper pages, or any page while Redis is unavailable, fall back to the
+    database.
+    """
+    try:
+        cached = _explore_from_cache(page, per_page)
+    except redis.exceptions.RedisError as e:
+        current_app.logger.warning("Explore cache unavailable: %s", e)
+        cached = None
+    if cached is not None:
+        return cached
+    tasks = Task.query.order_by(Task.timestamp.desc(), Task.id.desc()) \
+        .offset((page - 1) * per_page).limit(per_page + 1).all()
+    return tasks[:per_page], len(tasks) > per_page
+
+
+def _record_changes(session, flush_context):
+    # Collected at flush time, since objects flushed before the commit are
+    # no longer in session.new when the commit happens.
+    info = session.info.setdefault("explore_changes", {"add": [], "delete": []})
+    info["add"].extend(obj for obj in session.new if isinstance(obj, Task))
+    info["delete"].extend(obj for obj in session.deleted if isinstance(obj, Task))
+
+
+def _publish_changes(session):
+    changes = session.info.pop("explore_changes", None)
+    if not changes or not (changes["add"] or changes["delete"]):
+        return
+    try:
+        # Pushed even while the list is cold, so that a rebuild that read
+        # the DB before this commit notices and starts over.
+        pipe = current_app.redis.pipeline()
+        for task in changes["add"]:
+            pipe.lpush(EXPLORE_KEY, inspect(task).identity[0])
+        for task in changes["delete"]:
+            pipe.lrem(EXPLORE_KEY, 0, inspect(task).identity[0])
+        pipe.ltrim(EXPLORE_KEY, 0, _cache_size() - 1)
+        pipe.execute()
+    except redis.exceptions.RedisError as e:
+        current_app.logger.warning("Could not update explore cache: %s", e)
+
+
+def _discard_changes(session):
+    session.info.pop("explore_changes", None)
+
+
+db.event.listen(db.session, "after_flush", _record_changes)
+db.event.listen(db.session, "after_commit", _publish_changes)
+db.event.listen(db.session, "after_rollback", _discard_changes)
@@ -0,0 +1,182 @@
+import csv
+import io
+import json
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from itertools import islice
+
+import redis
+from flask import current_app
+
+from app import db
+from app.feeds import rebuild_explore
+from app.models import Task, User
+from app.search import add_many_to_index
+from app.translate import detect_language
+
+FORMATS = ("jsonl", "csv")
+
+
+class InvalidImport(ValueError):
+    pass
+
+
+def guess_format(filename):
+    return "csv" if filename.lower().endswith(".csv") else "jsonl"
+
+
+def _parse_bool(value):
+    if isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes", "y")
+    return bool(value)
+
+
+def _row(record, line):
+    body = (record.get("body") or "").strip()
+    if not body or len(body) > 140:
+        raise InvalidImport(f"Line {line}: body must be 1 to 140 characters")
+    timestamp = record.get("timestamp")
+    try:
+        timestamp = datetime.fromisoformat(timestamp) if timestamp \
+            else datetime.utcnow()
+    except (TypeError, ValueError):
+        raise InvalidImport(f"Line {line}: bad timestamp {timestamp!r}")
+    # Stored as naive UTC, like every other timestamp.
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return {"body": body, "done": _parse_bool(record.get("done", False)),
+            "timestamp": timestamp}
+
+
+def _follow_row(record, line):
+    follower = str(record.get("follower") or "").strip()
+    followed = str(record.get("followed") or "").strip()
+    if not follower or not followed:
+        raise InvalidImport(f"Line {line}: follower and followed are required")
+    return follower, followed
+
+
+def parse(stream, fmt, row=_row):
+    """Yield rows, made by `row` (task rows by default), from a binary
+    stream of JSON Lines or CSV, one record at a time, so files of any size
+    import in constant memory."""
+    if fmt not in FORMATS:
+        raise InvalidImport(f"Unknown format {fmt!r}")
+    text = io.TextIOWrapper(stream, encoding="utf-8", newline="")
+    try:
+        if fmt == "csv":
+            for line, record in enumerate(csv.DictReader(text), start=2):
+                yield row(record, line)
+        else:
+            for line, raw in enumerate(text, start=1):
+                if raw.strip():
+                    try:
+                        record = json.loads(raw)
+                    except ValueError:
+                        raise InvalidImport(f"Line {line}: invalid JSON")
+                    yield row(record, line)
+    finally:
+        # Hand the stream back to the caller open.
+        text.detach()
+
+
+def _chunks(rows, size):
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def import_tasks(user, stream, fmt, chunk_size=None, processes=None,
+                 progress=None):
+    """Bulk insert the tasks in `stream` for `user`.
+
+    Rows are inserted a chunk at a time with one executemany and one
+    commit per chunk. Language detection for a chunk runs in a process
+    pool, and the chunk is sent to the search index in a single bulk
+    request. The per-object session hooks are bypassed, so the explore
+    cache is rebuilt once at the end instead of on every commit.
+    `progress`, if given, is called with the number of tasks imported
+    after each chunk.
+    """
+    chunk_size = chunk_size or current_app.config["IMPORT_CHUNK_SIZE"]
+    if processes is None:
+        processes = current_app.config["IMPORT_PROCESSES"]
+    pool = ProcessPoolExecutor(processes) if processes else None
+    total = 0
+    try:
+        for rows in _chunks(parse(stream, fmt), chunk_size):
+            # Detection dominates the import time, so repeated bodies are
+            # only detected once.
+            bodies = list(dict.fromkeys(row["body"] for row in rows))
+            if pool is not None:
+                languages = pool.map(detect_language, bodies, chunksize=max(
+                    1, len(bodies) // (processes * 4)))
+            else:
+                languages = map(detect_language, bodies)
+            languages = dict(zip(bodies, languages))
+            for row in rows:
+                row["language"] = languages[row["body"]]
+                row["user_id"] = user.id
+            last_id = db.session.query(db.func.max(Task.id)).scalar() or 0
+            db.session.execute(Task.__table__.insert(), rows)
+            db.session.commit()
+            total += len(rows)
+            add_many_to_index(Task.__tablename__, Task.query.filter(
+                Task.user_id == user.id, Task.id > last_id))
+            if progress is not None:
+                progress(total)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    if total:
+        try:
+            rebuild_explore()
+        except redis.exceptions.RedisError as e:
+            current_app.logger.warning("Could not rebuild explore cache: %s", e)
+    return total
+
+
+def import_follows(stream, fmt, key="username", chunk_size=None, progress=None):
+    """Add the follows in `stream`, records with a `follower` and a
+    `followed` user, named by username or, with `key="id"`, by user id.
+
+    Each chunk resolves its users with one query, then adds every
+    follower's new follows with User.follow_many, and commits. Follows that
+    already exist are skipped, so an interrupted import can be rerun, and
+    so are records naming unknown users. The follower counts cached by
+    other processes are invalidated and the followers' suggestions marked
+    stale as for any follow. `progress`, if given, is called with the
+    number of records read after each chunk.
+    """
+    chunk_size = chunk_size or current_app.config["IMPORT_CHUNK_SIZE"]
+    column = User.id if key == "id" else User.username
+    result = {"records": 0, "followed": 0, "unknown": 0}
+    for rows in _chunks(parse(stream, fmt, _follow_row), chunk_size):
+        if key == "id":
+            try:
+                rows = [(int(a), int(b)) for a, b in rows]
+            except ValueError:
+                raise InvalidImport("User ids must be integers")
+        names = {name for edge in rows for name in edge}
+        ids = {}
+        for chunk in _chunks(names, 500):
+            ids.update(db.session.query(column, User.id)
+                       .filter(column.in_(chunk), User.deleted_at.is_(None)))
+        edges = defaultdict(set)
+        for follower, followed in rows:
+            if follower in ids and followed in ids:
+                edges[ids[follower]].add(ids[followed])
+            else:
+                result["unknown"] += 1
+        for chunk in _chunks(list(edges), 500):
+            for user in User.query.filter(User.id.in_(chunk)):
+                result["followed"] += len(user.follow_many(edges[user.id]))
+        db.session.commit()
+        result["records"] += len(rows)
+        if progress is not None:
+            progress(result["records"])
+    return result
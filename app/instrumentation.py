@@ -0,0 +1,207 @@
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+from flask import before_render_template, g, has_request_context, \
+    request, template_rendered
+from redis import Redis
+from redis.client import Pipeline
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+_local = threading.local()
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of an already sorted sequence."""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def record(kind, elapsed):
+    """Add one timed call of the given kind to the current request and to
+    any active `count_queries` blocks."""
+    for counter in getattr(_local, "counters", ()):
+        counter.add(kind, elapsed)
+    if has_request_context() and "timings" in g:
+        g.timings.add(kind, elapsed)
+
+
+@contextmanager
+def timed(kind):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(kind, time.perf_counter() - start)
+
+
+class Timings(object):
+    def __init__(self):
+        self.counts = defaultdict(int)
+        self.durations = defaultdict(float)
+
+    def add(self, kind, elapsed):
+        self.counts[kind] += 1
+        self.durations[kind] += elapsed
+
+    @property
+    def queries(self):
+        return self.counts["db"]
+
+
+@contextmanager
+def count_queries():
+    """Count the SQL, Redis and Elasticsearch calls made inside the block.
+
+        with count_queries() as timings:
+            user.followed_tasks().all()
+        assert timings.queries == 1
+    """
+    timings = Timings()
+    if not hasattr(_local, "counters"):
+        _local.counters = []
+    _local.counters.append(timings)
+    try:
+        yield timings
+    finally:
+        _local.counters.remove(timings)
+
+
+class InstrumentedPipeline(Pipeline):
+    def execute(self, raise_on_error=True):
+        with timed("redis"):
+            return super(InstrumentedPipeline, self).execute(raise_on_error)
+
+
+class InstrumentedRedis(Redis):
+    """A Redis client that reports the time spent in every command."""
+
+    def execute_command(self, *args, **options):
+        with timed("redis"):
+            return super(InstrumentedRedis, self).execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks,
+                                    transaction, shard_hint)
+
+
+# The start time is kept on the statement's execution context, which is
+# thrown away with it, so a statement that fails, and never reaches
+# after_cursor_execute, leaves nothing behind on the connection.
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.query_start_time = time.perf_counter()
+
+
+# Called as f(conn, statement, parameters, executemany, elapsed) after
+# every statement, on the thread that ran it; see app.slowlog.
+query_listeners = []
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, "query_start_time", None)
+    if start is None:
+        return
+    elapsed = time.perf_counter() - start
+    record("db", elapsed)
+    for listener in query_listeners:
+        listener(conn, statement, parameters, executemany, elapsed)
+
+
+class RouteStats(object):
+    """Rolling per-endpoint latency and query count samples."""
+
+    def __init__(self, window):
+        self.window = window
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.seen = defaultdict(int)
+
+    def add(self, endpoint, elapsed, queries):
+        with self.lock:
+            if endpoint not in self.samples:
+                self.samples[endpoint] = deque(maxlen=self.window)
+            self.samples[endpoint].append((elapsed, queries))
+            self.seen[endpoint] += 1
+            return self.seen[endpoint]
+
+    def summary(self, endpoint):
+        with self.lock:
+            samples = list(self.samples.get(endpoint, ()))
+        latencies = sorted(s[0] * 1000 for s in samples)
+        queries = sorted(s[1] for s in samples)
+        return {
+            "count": len(samples),
+            "p50_ms": round(percentile(latencies, 50), 2),
+            "p95_ms": round(percentile(latencies, 95), 2),
+            "p99_ms": round(percentile(latencies, 99), 2),
+            "queries_p50": percentile(queries, 50),
+            "queries_max": queries[-1] if queries else 0,
+        }
+
+
+def server_timing_header(timings, total):
+    parts = []
+    for kind, desc in (("db", "queries"), ("redis", "calls"),
+                       ("es", "calls"), ("tpl", "renders")):
+        if timings.counts[kind]:
+            parts.append(f'{kind};desc="{timings.counts[kind]} {desc}";'
+                         f'dur={timings.durations[kind] * 1000:.2f}')
+    parts.append(f"total;dur={total * 1000:.2f}")
+    return ", ".join(parts)
+
+
+def init_app(app):
+    if not app.config["INSTRUMENT_REQUESTS"]:
+        return
+    stats = app.extensions["route_stats"] = \
+        RouteStats(app.config["ROUTE_STATS_WINDOW"])
+
+    @app.before_request
+    def start_timer():
+        g.timings = Timings()
+        g.request_start_time = time.perf_counter()
+
+    @app.after_request
+    def emit_timings(response):
+        if "timings" not in g:
+            return response
+        total = time.perf_counter() - g.request_start_time
+        timings = g.timings
+        response.headers["Server-Timing"] = server_timing_header(timings, total)
+
+        endpoint = request.endpoint or "<unmatched>"
+        seen = stats.add(endpoint, total, timings.queries)
+        log_every = app.config["ROUTE_STATS_LOG_EVERY"]
+        if log_every and seen % log_every == 0:
+            app.logger.info("Route stats %s: %s", endpoint, stats.summary(endpoint))
+
+        budget = app.config["QUERY_BUDGETS"].get(
+            endpoint, app.config["QUERY_BUDGET_DEFAULT"])
+        if budget is not None and timings.queries > budget:
+            message = f"{endpoint} issued {timings.queries} queries " \
+                      f"(budget {budget})"
+            if app.config["RAISE_ON_QUERY_BUDGET"]:
+                raise QueryBudgetExceeded(message)
+            app.logger.warning(message)
+        return response
+
+    def start_render(sender, template, context, **extra):
+        if has_request_context():
+            g.setdefault("render_start_times", []).append(time.perf_counter())
+
+    def end_render(sender, template, context, **extra):
+        if has_request_context() and g.get("render_start_times"):
+            record("tpl", time.perf_counter() - g.render_start_times.pop())
+
+    before_render_template.connect(start_render, app, weak=False)
+    template_rendered.connect(end_render, app, weak=False)
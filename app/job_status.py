@@ -0,0 +1,66 @@
+import redis
+from flask import current_app, g
+
+from app.models import Job
+
+
+def _no_jobs_key(user_id):
+    return f"user:{user_id}:no_jobs"
+
+
+def clear_no_jobs(user_id):
+    """Forget the cached "no jobs" answer, e.g. when a job is launched."""
+    try:
+        current_app.redis.delete(_no_jobs_key(user_id))
+    except redis.exceptions.RedisError:
+        pass
+
+
+def jobs_in_progress(user):
+    """Return `(job, progress)` pairs for the user's unfinished jobs.
+
+    Most users have no jobs running, so that answer is cached in Redis and
+    the common page render costs one GET. Otherwise the progress of every
+    job is read with a single pipelined `Job.fetch_many` call. The result is
+    memoized for the rest of the request.
+    """
+    if "jobs_in_progress" in g:
+        return g.jobs_in_progress
+    r = current_app.redis
+    try:
+        if r.exists(_no_jobs_key(user.id)):
+            g.jobs_in_progress = []
+            return g.jobs_in_progress
+    except redis.exceptions.RedisError:
+        r = None
+
+    jobs = Job.query.filter_by(user_id=user.id, complete=False).all()
+    if not jobs:
+        if r is not None:
+            try:
+                r.set(_no_jobs_key(user.id), 1,
+                      ex=current_app.config["JOB_STATUS_NEGATIVE_TTL"])
+            except redis.exceptions.RedisError:
+                pass
+        g.jobs_in_progress = []
+        return g.jobs_in_progress
+
+    from rq.job import Job as RQJob
+    try:
+        rq_jobs = RQJob.fetch_many([job.id for job in jobs],
+                                   connection=current_app.redis)
+    except redis.exceptions.RedisError:
+        rq_jobs = [None] * len(jobs)
+    # A job RQ no longer knows about has finished, as Job.get_progress assumes.
+    g.jobs_in_progress = [
+        (job, rq_job.meta.get("progress", 0) if rq_job is not None else 100)
+        for job, rq_job in zip(jobs, rq_jobs)
+    ]
+    return g.jobs_in_progress
+
+
+def job_in_progress(user, name):
+    for job, _ in jobs_in_progress(user):
+        if job.name == name:
+            return job
+    return None
@@ -1,16 +1,61 @@
+import os
 import sys
 import json
 import time
+from functools import wraps
 
 from rq import get_current_job
-from flask import render_template
+from flask import current_app, has_app_context, render_template
 
-from app import db, create_app
+from app import accounts, broadcast, db, create_worker_app, importer, profiling
 from app.models import Job, User, Task
 from app.mail_framework import send_email
+from app.queues import release_job
 
-app = create_app()
-app.app_context().push()
+_app = None
+
+
+def _get_app():
+    # Built on the first job a process runs rather than at import time, so
+    # importing this module is cheap and never touches the network.
+    global _app
+    if _app is None:
+        _app = create_worker_app()
+    return _app
+
+
+def app_job(f):
+    """Run a job function inside an application context."""
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        if has_app_context():
+            return _run_job(f, args, kwargs)
+        with _get_app().app_context():
+            return _run_job(f, args, kwargs)
+    return wrapper
+
+
+def _run_job(f, args, kwargs):
+    try:
+        with profiling.profiled("job", f.__name__):
+            return f(*args, **kwargs)
+    except Exception:
+        db.session.rollback()
+        raise
+    finally:
+        _mark_job_complete()
+
+
+def _mark_job_complete():
+    # The worker owns the `complete` flag: it is set here whether the job
+    # succeeded or failed, so pages never have to reconcile it with RQ.
+    rq_job = get_current_job()
+    if rq_job:
+        release_job(rq_job.get_id(), rq_job.meta)
+        job = Job.query.get(rq_job.get_id())
+        if job is not None and not job.complete:
+            job.complete = True
+            db.session.commit()
 
 
 def _set_job_progress(progress):
@@ -19,6 +64,9 @@ def _set_job_progress(progress):
         rq_job.meta["progress"] = progress
         rq_job.save_meta()
         job = Job.query.get(rq_job.get_id())
+        # The launching request may not have committed the row yet.
+        if job is None:
+            return
         job.user.add_notification("job_progress", {"job_id": rq_job.get_id(),
                                                    "progress": progress})
         if progress >= 100:
@@ -26,6 +74,7 @@ def _set_job_progress(progress):
         db.session.commit()
 
 
+@app_job
 def export_tasks(user_id):
     try:
         # Read user tasks from database
@@ -41,7 +90,7 @@ def export_tasks(user_id):
             _set_job_progress(100 * i // total_tasks)
 
         # Send email with data to user.
-        # send_email("[Microtasks] Your tasks", sender=app.config["ADMINS"][0],
+        # send_email("[Microtasks] Your tasks", sender=current_app.config["ADMINS"][0],
         #            recipients=[user.email],
         #            text_body=render_template("email/export_tasks.txt", user=user),
         #            html_body=render_template("email/export_tasks.html", user=user),
@@ -49,7 +98,54 @@ def export_tasks(user_id):
         #            sync=True)
     except:
         # Handle errors
-        app.logger.error("Unhandled exception", exc_info=sys.exc_info())
+        current_app.logger.error("Unhandled exception", exc_info=sys.exc_info())
     finally:
         # Handle clean-up
         _set_job_progress(100)
+
+
+@app_job
+def import_tasks(user_id, path, fmt):
+    """Import an uploaded file of tasks, then delete the file."""
+    user = User.query.get(user_id)
+    size = os.path.getsize(path) or 1
+    try:
+        _set_job_progress(0)
+        with open(path, "rb") as f:
+            total = importer.import_tasks(
+                user, f, fmt,
+                progress=lambda n: _set_job_progress(min(99, 100 * f.tell() // size)))
+        user.add_notification("tasks_imported", {"count": total})
+    except importer.InvalidImport as e:
+        # Chunks before the bad line are already committed.
+        db.session.rollback()
+        user.add_notification("tasks_imported", {"error": str(e)})
+    finally:
+        os.remove(path)
+        _set_job_progress(100)
+
+
+@app_job
+def broadcast_message(user_id, body):
+    """Send a private message to each of the user's followers."""
+    user = User.query.get(user_id)
+    try:
+        _set_job_progress(0)
+        broadcast.broadcast(
+            user, body,
+            progress=lambda done, total: _set_job_progress(min(99, 100 * done // total)))
+    finally:
+        _set_job_progress(100)
+
+
+@app_job
+def delete_account(user_id):
+    """Delete a user, who is already locked out, and all of their data."""
+    user = User.query.get(user_id)
+    if user is None:
+        return
+    _set_job_progress(0)
+    # No final 100%: the job's row and notifications go with the user.
+    accounts.delete_account(
+        user,
+        progress=lambda done, total: _set_job_progress(min(99, 100 * done // total)))
@@ -0,0 +1,251 @@
+import atexit
+import copy
+import json
+import logging
+import os
+import queue
+import smtplib
+import sys
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+from email.message import EmailMessage
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+from flask import g, has_request_context, request, session
+
+TEXT_FORMAT = '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'
+
+
+class RequestContextFilter(logging.Filter):
+    """Stamps records with the request they were logged from.
+
+    It runs on the request thread, before the record is queued, because
+    the request context is gone by the time the listener thread sees it.
+    """
+
+    def filter(self, record):
+        if has_request_context():
+            record.request_id = g.get("request_id")
+            record.method = request.method
+            record.path = request.path
+            record.endpoint = request.endpoint
+            start = g.get("log_start_time")
+            record.elapsed_ms = round((time.perf_counter() - start) * 1000, 2) \
+                if start else None
+            # Read from the session cookie so logging never loads the user.
+            record.user_id = session.get("_user_id")
+        return True
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line, for log shippers and `flask logstats`."""
+
+    fields = ("request_id", "method", "path", "endpoint", "status",
+              "elapsed_ms", "user_id")
+
+    def format(self, record):
+        payload = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "location": f"{record.pathname}:{record.lineno}",
+        }
+        for field in self.fields:
+            value = getattr(record, field, None)
+            if value is not None:
+                payload[field] = value
+        if record.exc_info:
+            payload["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            payload["exception"] = record.exc_text
+        return json.dumps(payload, default=str)
+
+
+class _QueueHandler(QueueHandler):
+    def prepare(self, record):
+        # Unlike the stdlib version this keeps the traceback in exc_text
+        # instead of baking it into the message, so the formatters on the
+        # listener side can still place it where they want.
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class ThrottledSMTPHandler(logging.Handler):
+    """Emails errors, but at most one message per `interval` seconds.
+
+    The first error after a quiet period is sent straight away. Errors that
+    follow within the interval are grouped by call site and sent together
+    as a digest when the interval expires, so an error storm produces a
+    handful of emails instead of one per failing request.
+    """
+
+    def __init__(self, mailhost, fromaddr, toaddrs, subject, credentials=None,
+                 secure=None, interval=300, timeout=10):
+        logging.Handler.__init__(self)
+        self.mailhost = mailhost
+        self.fromaddr = fromaddr
+        self.toaddrs = toaddrs
+        self.subject = subject
+        self.credentials = credentials
+        self.secure = secure
+        self.interval = interval
+        self.timeout = timeout
+        self.last_sent = None
+        self.pending = OrderedDict()
+        self.timer = None
+
+    def emit(self, record):
+        key = (record.pathname, record.lineno)
+        with self.lock:
+            if key in self.pending:
+                self.pending[key][1] += 1
+            else:
+                self.pending[key] = [self.format(record), 1]
+            wait = 0 if self.last_sent is None else \
+                self.last_sent + self.interval - time.monotonic()
+            if wait > 0:
+                if self.timer is None:
+                    self.timer = threading.Timer(wait, self.flush)
+                    self.timer.daemon = True
+                    self.timer.start()
+                return
+        self.flush()
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, OrderedDict()
+            self.timer = None
+            if not pending:
+                return
+            self.last_sent = time.monotonic()
+        total = sum(count for _, count in pending.values())
+        subject = self.subject if total == 1 else \
+            f"{self.subject} ({total} errors)"
+        body = "\n\n".join(text if count == 1 else f"[{count} times] {text}"
+                           for text, count in pending.values())
+        try:
+            self.deliver(subject, body)
+        except Exception:
+            if logging.raiseExceptions:
+                traceback.print_exc(file=sys.stderr)
+
+    def deliver(self, subject, body):
+        msg = EmailMessage()
+        msg["From"] = self.fromaddr
+        msg["To"] = ",".join(self.toaddrs)
+        msg["Subject"] = subject
+        msg.set_content(body)
+        host, port = self.mailhost
+        with smtplib.SMTP(host, port, timeout=self.timeout) as smtp:
+            if self.secure is not None:
+                smtp.ehlo()
+                smtp.starttls(*self.secure)
+                smtp.ehlo()
+            if self.credentials:
+                smtp.login(*self.credentials)
+            smtp.send_message(msg)
+
+    def close(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.flush()
+        logging.Handler.close(self)
+
+
+def configure_logging(app):
+    """Route app.logger through a queue drained by a background thread.
+
+    Request threads only append to an in-memory queue; file writes,
+    rotation and SMTP all happen on the listener thread.
+    """
+    if app.config["LOG_JSON"]:
+        formatter = JSONFormatter()
+    else:
+        formatter = logging.Formatter(TEXT_FORMAT)
+    handlers = []
+
+    if app.config['MAIL_SERVER']:
+        auth = None
+        if app.config['MAIL_USERNAME'] or app.config['MAIL_PASSWORD']:
+            auth = (app.config['MAIL_USERNAME'],
+                    app.config['MAIL_PASSWORD'])
+        secure = None
+        if app.config['MAIL_USE_TLS']:
+            secure = ()
+        mail_handler = ThrottledSMTPHandler(
+            mailhost=(app.config['MAIL_SERVER'], app.config['MAIL_PORT']),
+            fromaddr='no-reply@' + app.config['MAIL_SERVER'],
+            toaddrs=app.config['ADMINS'], subject='Microblog Failure',
+            credentials=auth, secure=secure,
+            interval=app.config['LOG_MAIL_INTERVAL'])
+        mail_handler.setLevel(logging.ERROR)
+        mail_handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+        handlers.append(mail_handler)
+
+    if app.config['LOG_TO_STDOUT']:
+        stream_handler = logging.StreamHandler()
+        stream_handler.setFormatter(formatter)
+        stream_handler.setLevel(logging.INFO)
+        handlers.append(stream_handler)
+    else:
+        if not os.path.exists('logs'):
+            os.mkdir('logs')
+        file_handler = RotatingFileHandler(
+            'logs/microblog.log', maxBytes=app.config['LOG_MAX_BYTES'],
+            backupCount=app.config['LOG_BACKUP_COUNT'])
+        file_handler.setFormatter(formatter)
+        file_handler.setLevel(logging.INFO)
+        handlers.append(file_handler)
+
+    app.logger.setLevel(logging.INFO)
+    app.extensions["log_listener"] = queue_logger(
+        app.logger, handlers, RequestContextFilter())
+
+
+def queue_logger(logger, handlers, *filters):
+    """Have `logger` put its records on an in-memory queue, after `filters`,
+    for `handlers` to handle on a listener thread. Returns the started
+    listener."""
+    log_queue = queue.Queue(-1)
+    queue_handler = _QueueHandler(log_queue)
+    for f in filters:
+        queue_handler.addFilter(f)
+    logger.addHandler(queue_handler)
+
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    # atexit runs in reverse order: drain the queue first, then close the
+    # handlers, which sends any pending error digest.
+    for handler in handlers:
+        atexit.register(handler.close)
+    atexit.register(listener.stop)
+    return listener
+
+
+def init_app(app):
+    @app.before_request
+    def assign_request_id():
+        g.request_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex
+        g.log_start_time = time.perf_counter()
+
+    @app.after_request
+    def log_request(response):
+        if "request_id" not in g:
+            return response
+        response.headers["X-Request-ID"] = g.request_id
+        if app.config["LOG_REQUESTS"]:
+            elapsed_ms = (time.perf_counter() - g.log_start_time) * 1000
+            app.logger.info("%s %s %s %.2fms %s", request.method,
+                            request.full_path.rstrip("?"), response.status_code,
+                            elapsed_ms, request.endpoint or "-",
+                            extra={"status": response.status_code})
+        return response
@@ -0,0 +1,214 @@
+import bisect
+import csv
+import gzip
+import io
+import json
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from werkzeug.exceptions import HTTPException
+from werkzeug.routing import Map, RequestRedirect, Rule
+
+# Upper bounds, in milliseconds, of the latency histogram buckets; the
+# last bucket holds everything slower.
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+# "2021-04-10 15:21:51,047 INFO: GET /index?page=2 200 12.34ms main.index
+# [in ...]"; the endpoint is "-" for unmatched URLs and missing from lines
+# written before it was logged.
+TEXT_RE = re.compile(
+    r"^(?P<time>\d{4}-\d\d-\d\d \d\d:\d\d:\d\d),\d+ INFO: "
+    r"(?P<method>[A-Z]+) (?P<path>\S+) (?P<status>\d{3})"
+    r"(?: (?P<elapsed>[\d.]+)ms)?(?: (?P<endpoint>[^\s\[]+))? \[in ")
+# gunicorn's default access log format, optionally followed by %(D)s, the
+# request time in microseconds.
+ACCESS_RE = re.compile(
+    r'^\S+ \S+ \S+ \[(?P<time>[^\]]+)\] "(?P<method>[A-Z]+) (?P<path>\S+) [^"]*" '
+    r'(?P<status>\d{3}) \S+ "[^"]*" "[^"]*"(?: (?P<micros>\d+))?\s*$')
+_ids = re.compile(r"/\d+(?=/|$)")
+
+
+def route_for(path):
+    """A path without its query string and with numeric ids folded, for
+    lines that don't name their endpoint."""
+    return _ids.sub("/<int>", path.split("?", 1)[0])
+
+
+def url_rules(app):
+    """(rule, endpoint, methods) for every URL rule of `app`, picklable for
+    the worker processes of `summarize`."""
+    return [(rule.rule, rule.endpoint, sorted(rule.methods or ()))
+            for rule in app.url_map.iter_rules()]
+
+
+def endpoint_matcher(rules):
+    """A function of (method, path) that names the endpoint of `rules` the
+    request went to, or folds the path with `route_for` when none does,
+    so access log lines group like app log lines."""
+    if not rules:
+        return lambda method, path: route_for(path)
+    adapter = Map([Rule(rule, endpoint=endpoint, methods=methods or None)
+                   for rule, endpoint, methods in rules]).bind("")
+
+    def match(method, path):
+        try:
+            return adapter.match(path.split("?", 1)[0], method=method)[0]
+        except (HTTPException, RequestRedirect):
+            return route_for(path)
+
+    return match
+
+
+def open_log(path):
+    if path == "-":
+        return io.TextIOWrapper(sys.stdin.buffer, encoding="utf-8",
+                                errors="replace")
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8", errors="replace")
+    return open(path, encoding="utf-8", errors="replace")
+
+
+def parse(lines, match=None):
+    """Yield (time, route, status, elapsed_ms) for every request line in an
+    app log, JSON or text, or a gunicorn access log. `time` is an aware
+    datetime, app log times being local, and `elapsed_ms` is None when the
+    line has no timing. Routes are endpoints where the line names one, and
+    otherwise `match(method, path)`, by default the folded path."""
+    match_route = match or (lambda method, path: route_for(path))
+    for line in lines:
+        if line.startswith("{"):
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if "status" not in entry or "path" not in entry:
+                continue
+            when = datetime.strptime(entry["time"].split(",")[0],
+                                     "%Y-%m-%d %H:%M:%S")
+            yield (when.astimezone(),
+                   entry.get("endpoint") or route_for(entry["path"]),
+                   int(entry["status"]), entry.get("elapsed_ms"))
+            continue
+        match = TEXT_RE.match(line)
+        if match:
+            when = datetime.strptime(match["time"], "%Y-%m-%d %H:%M:%S")
+            elapsed = match["elapsed"]
+            endpoint = match["endpoint"]
+            route = endpoint if endpoint and endpoint != "-" \
+                else route_for(match["path"])
+            yield (when.astimezone(), route,
+                   int(match["status"]), float(elapsed) if elapsed else None)
+            continue
+        match = ACCESS_RE.match(line)
+        if match:
+            when = datetime.strptime(match["time"], "%d/%b/%Y:%H:%M:%S %z")
+            micros = match["micros"]
+            yield (when, match_route(match["method"], match["path"]),
+                   int(match["status"]), int(micros) / 1000 if micros else None)
+
+
+def _new_route():
+    return {"count": 0, "status": {}, "timed": 0, "total_ms": 0.0,
+            "max_ms": 0.0, "histogram": [0] * (len(BUCKETS) + 1)}
+
+
+def aggregate(records, since=None):
+    """Per-route counts and latency histograms. Memory grows with the number
+    of routes, not the number of lines."""
+    routes = {}
+    for when, route, status, elapsed in records:
+        if since is not None and when < since:
+            continue
+        stats = routes.get(route)
+        if stats is None:
+            stats = routes[route] = _new_route()
+        stats["count"] += 1
+        status_class = f"{status // 100}xx"
+        stats["status"][status_class] = stats["status"].get(status_class, 0) + 1
+        if elapsed is not None:
+            stats["timed"] += 1
+            stats["total_ms"] += elapsed
+            stats["max_ms"] = max(stats["max_ms"], elapsed)
+            stats["histogram"][bisect.bisect_left(BUCKETS, elapsed)] += 1
+    return routes
+
+
+def merge(into, routes):
+    for route, stats in routes.items():
+        target = into.get(route)
+        if target is None:
+            into[route] = stats
+            continue
+        for key in ("count", "timed", "total_ms"):
+            target[key] += stats[key]
+        target["max_ms"] = max(target["max_ms"], stats["max_ms"])
+        for status_class, n in stats["status"].items():
+            target["status"][status_class] = target["status"].get(status_class, 0) + n
+        target["histogram"] = [a + b for a, b in
+                               zip(target["histogram"], stats["histogram"])]
+    return into
+
+
+def histogram_percentile(histogram, p, max_ms):
+    """The upper bound of the bucket holding the p-th percentile."""
+    total = sum(histogram)
+    if not total:
+        return 0.0
+    rank = p / 100.0 * total
+    seen = 0
+    for bound, n in zip(BUCKETS + (max_ms,), histogram):
+        seen += n
+        if seen >= rank:
+            return float(min(bound, max_ms))
+    return max_ms
+
+
+def analyze_file(path, since=None, rules=None):
+    with open_log(path) as f:
+        return aggregate(parse(f, endpoint_matcher(rules)), since)
+
+
+def summarize(paths, since=None, processes=None, rules=None):
+    """Aggregate several log files, one process per file. `rules`, from
+    `url_rules`, map access log paths to endpoints."""
+    routes = {}
+    if processes == 0 or len(paths) < 2 or "-" in paths:
+        for path in paths:
+            merge(routes, analyze_file(path, since, rules))
+    else:
+        with ProcessPoolExecutor(processes) as executor:
+            for result in executor.map(analyze_file, paths,
+                                       [since] * len(paths),
+                                       [rules] * len(paths)):
+                merge(routes, result)
+    summary = []
+    for route, stats in routes.items():
+        summary.append({
+            "route": route,
+            "count": stats["count"],
+            "status": dict(sorted(stats["status"].items())),
+            "mean_ms": round(stats["total_ms"] / stats["timed"], 2)
+            if stats["timed"] else None,
+            "p50_ms": histogram_percentile(stats["histogram"], 50, stats["max_ms"]),
+            "p95_ms": histogram_percentile(stats["histogram"], 95, stats["max_ms"]),
+            "p99_ms": histogram_percentile(stats["histogram"], 99, stats["max_ms"]),
+            "max_ms": round(stats["max_ms"], 2),
+            "total_ms": round(stats["total_ms"], 2),
+            "histogram": dict(zip([f"<={b}" for b in BUCKETS] + ["more"],
+                                  stats["histogram"])),
+        })
+    return summary
+
+
+CSV_FIELDS = ("route", "count", "2xx", "3xx", "4xx", "5xx", "mean_ms",
+              "p50_ms", "p95_ms", "p99_ms", "max_ms", "total_ms")
+
+
+def write_csv(summary, out):
+    writer = csv.DictWriter(out, CSV_FIELDS, extrasaction="ignore")
+    writer.writeheader()
+    for row in summary:
+        writer.writerow(dict(row, **{k: row["status"].get(k, 0)
+                                     for k in ("2xx", "3xx", "4xx", "5xx")}))
@@ -1,89 +1,104 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from flask import render_template, flash, redirect, url_for, request, g, \
     jsonify, current_app
 from flask_babel import _, get_locale
-from flask_login import current_user, login_required
-from guess_language import guess_language
+from flask_login import current_user, login_required, logout_user
+from sqlalchemy.exc import IntegrityError
 
 from app import db
+from app.api.pagination import keyset_page
+from app.feeds import explore_page
+from app.job_status import job_in_progress, jobs_in_progress
 from app.main import bp
-from app.main.forms import EditProfileForm, EmptyForm, TaskForm, SearchForm, MessageForm
-from app.models import User, Task, Message, Notification
-from app.translate import translate
+from app.main.forms import DeleteAccountForm, EditProfileForm, EmptyForm, \
+    TaskForm, SearchForm, MessageForm
+from app.models import User, Task, Message, Notification, Conversation, \
+    Participant
+from app.queues import DuplicateJob, JobLimitExceeded
+from app.translate import detect_language, translate
 
 
 @bp.before_app_request
 def before_request():
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow()
-        db.session.commit()
+        # Only write last_seen once a minute, so that most page views stay
+        # read-only and can be served from a replica.
+        now = datetime.utcnow()
+        interval = timedelta(seconds=current_app.config["LAST_SEEN_UPDATE_INTERVAL"])
+        if current_user.last_seen is None or now - current_user.last_seen > interval:
+            current_user.last_seen = now
+            db.session.commit()
         g.search_form = SearchForm()
     g.locale = str(get_locale())
 
 
+@bp.app_context_processor
+def inject_job_status():
+    return {"jobs_in_progress": jobs_in_progress,
+            "job_in_progress": job_in_progress}
+
+
 @bp.route('/', methods=['GET', 'POST'])
 @bp.route('/index', methods=['GET', 'POST'])
 @login_required
 def index():
     form = TaskForm()
     if form.validate_on_submit():
-        language = guess_language(form.task.data)
-        if language == 'UNKNOWN' or len(language) > 5:
-            language = ''
         task = Task(body=form.task.data, author=current_user,
-                    language=language)
+                    language=detect_language(form.task.data))
         db.session.add(task)
         db.session.commit()
         flash(_('Your task has been added.'))
         return redirect(url_for('main.index'))
-    page = request.args.get('page', 1, type=int)
+    page = max(request.args.get('page', 1, type=int), 1)
     tasks = current_user.followed_tasks().paginate(
         page, current_app.config['TASKS_PER_PAGE'], False)
     next_url = url_for('main.index', page=tasks.next_num) \
         if tasks.has_next else None
     prev_url = url_for('main.index', page=tasks.prev_num) \
         if tasks.has_prev else None
+    suggestions = current_user.follow_suggestions(
+        current_app.config['SUGGESTIONS_SHOWN'])
     return render_template('index.html', title=_('Home'), form=form,
                            tasks=tasks.items, next_url=next_url,
-                           prev_url=prev_url)
+                           prev_url=prev_url, suggestions=suggestions)
 
 
 @bp.route('/explore')
 @login_required
 def explore():
-    page = request.args.get('page', 1, type=int)
-    tasks = Task.query.order_by(Task.timestamp.desc()).paginate(
-        page, current_app.config['TASKS_PER_PAGE'], False)
-    next_url = url_for('main.explore', page=tasks.next_num) \
-        if tasks.has_next else None
-    prev_url = url_for('main.explore', page=tasks.prev_num) \
-        if tasks.has_prev else None
+    page = max(request.args.get('page', 1, type=int), 1)
+    tasks, has_next = explore_page(page, current_app.config['TASKS_PER_PAGE'])
+    next_url = url_for('main.explore', page=page + 1) if has_next else None
+    prev_url = url_for('main.explore', page=page - 1) if page > 1 else None
     return render_template('index.html', title=_('Explore'),
-                           tasks=tasks.items, next_url=next_url,
+                           tasks=tasks, next_url=next_url,
                            prev_url=prev_url)
 
 
 @bp.route('/user/<username>')
 @login_required
 def user(username):
-    user = User.query.filter_by(username=username).first_or_404()
-    page = request.args.get('page', 1, type=int)
-    tasks = user.tasks.order_by(Task.timestamp.desc()).paginate(
-        page, current_app.config['TASKS_PER_PAGE'], False)
+    user = User.query.filter_by(username=username, deleted_at=None).first_or_404()
+    page = max(request.args.get('page', 1, type=int), 1)
+    tasks, has_next = user.tasks_page(page, current_app.config['TASKS_PER_PAGE'])
     next_url = url_for('main.user', username=user.username,
-                       page=tasks.next_num) if tasks.has_next else None
+                       page=page + 1) if has_next else None
     prev_url = url_for('main.user', username=user.username,
-                       page=tasks.prev_num) if tasks.has_prev else None
+                       page=page - 1) if page > 1 else None
     form = EmptyForm()
-    return render_template('user.html', user=user, tasks=tasks.items,
-                           next_url=next_url, prev_url=prev_url, form=form)
+    suggestions = current_user.follow_suggestions(
+        current_app.config['SUGGESTIONS_SHOWN']) if user == current_user else []
+    return render_template('user.html', user=user, tasks=tasks,
+                           next_url=next_url, prev_url=prev_url, form=form,
+                           suggestions=suggestions)
 
 
 @bp.route("/user/<username>/popup")
 @login_required
 def user_popup(username):
-    user = User.query.filter_by(username=username).first_or_404()
+    user = User.query.filter_by(username=username, deleted_at=None).first_or_404()
     form = EmptyForm()
     return render_template("user_popup.html", user=user, form=form)
 
@@ -105,12 +120,42 @@ def edit_profile():
                            form=form)
 
 
+@bp.route("/delete_account", methods=["GET", "POST"])
+@login_required
+def delete_account():
+    form = DeleteAccountForm()
+    if form.validate_on_submit():
+        if not current_user.check_password(form.password.data):
+            flash(_("Invalid password"))
+            return redirect(url_for("main.delete_account"))
+        # Locked out, and committed, before the job can start.
+        current_user.deleted_at = datetime.utcnow()
+        current_user.revoke_token()
+        db.session.commit()
+        try:
+            current_user.launch_job("delete_account", _("Deleting your account..."),
+                                    dedupe_key="delete_account")
+            db.session.commit()
+        except (DuplicateJob, JobLimitExceeded):
+            # The resume_deletions maintenance task queues it later.
+            pass
+        except IntegrityError:
+            # The job already deleted the user, so its Job row has nowhere
+            # to go.
+            db.session.rollback()
+        logout_user()
+        flash(_("Your account is being deleted."))
+        return redirect(url_for("main.index"))
+    return render_template("delete_account.html", title=_("Delete Account"),
+                           form=form)
+
+
 @bp.route('/follow/<username>', methods=['POST'])
 @login_required
 def follow(username):
     form = EmptyForm()
     if form.validate_on_submit():
-        user = User.query.filter_by(username=username).first()
+        user = User.query.filter_by(username=username, deleted_at=None).first()
         if user is None:
             flash(_('User %(username)s not found.', username=username))
             return redirect(url_for('main.index'))
@@ -158,7 +203,7 @@ def translate_text():
 def search():
     if not g.search_form.validate():
         return redirect(url_for("main.explore"))
-    page = request.args.get("page", 1, type=int)
+    page = max(request.args.get("page", 1, type=int), 1)
     tasks, total = Task.search(g.search_form.query.data, page, current_app.config["TASKS_PER_PAGE"])
     next_url = url_for("main.search", q=g.search_form.query.data, page=page + 1) \
         if total > page * current_app.config["TASKS_PER_PAGE"] else None
@@ -170,38 +215,85 @@ def search():
 @bp.route("/send_message/<recipient>", methods=["GET", "POST"])
 @login_required
 def send_message(recipient):
-    user = User.query.filter_by(username=recipient).first_or_404()
+    user = User.query.filter_by(username=recipient, deleted_at=None).first_or_404()
     form = MessageForm()
     if form.validate_on_submit():
-        message = Message(
-            author=current_user,
-            recipient=user,
-            body=form.message.data
-        )
-        db.session.add(message)
-
+        current_user.send_message(user, form.message.data)
         user.add_notification("unread_message_count", user.new_messages())
         db.session.commit()
         flash(_("Your message has been sent."))
-        return redirect(url_for("main.user", username=recipient))
-    return render_template("send_message.html", form=form, title=recipient)
+        return redirect(url_for("main.conversation", username=recipient))
+    return render_template("send_message.html", form=form, title=recipient,
+                           recipient=recipient)
+
+
+@bp.route("/broadcast", methods=["GET", "POST"])
+@login_required
+def broadcast():
+    form = MessageForm()
+    if form.validate_on_submit():
+        try:
+            current_user.launch_job("broadcast_message",
+                                    _("Sending your message to your followers..."),
+                                    form.message.data, dedupe_key="broadcast")
+            db.session.commit()
+            flash(_("Your message is being sent to your followers."))
+        except DuplicateJob:
+            flash(_("Your previous message is still being sent..."))
+        except JobLimitExceeded:
+            flash(_("Too many background jobs are running, please try again later."))
+        return redirect(url_for("main.user", username=current_user.username))
+    return render_template("send_message.html", form=form, title=_("Followers"),
+                           recipient=_("all your followers"))
 
 
 @bp.route("/messages")
 @login_required
 def messages():
-    current_user.last_message_read_time = datetime.utcnow()
-    db.session.commit()
-
-    # If page number encoded in URL, take that (e.g. myurl?page=3)
-    # Otherwise, default to 1.
-    page = request.args.get("page", 1, type=int)
-    messages = current_user.messages_received.order_by(
-        Message.timestamp.desc()).paginate(
-        page, current_app.config["TASKS_PER_PAGE"], False)
-    next_url = url_for("main.messages", page=messages.next_num) if messages.has_next else None
-    prev_url = url_for("main.messages", page=messages.prev_num) if messages.has_prev else None
-    return render_template("messages.html", messages=messages.items, next_url=next_url, prev_url=prev_url)
+    # Keyset paging over the user's participant rows, newest thread first,
+    # then one query each for the threads and the other participants.
+    participants, next_cursor = keyset_page(
+        Participant.query.filter_by(user_id=current_user.id), Participant,
+        current_app.config["TASKS_PER_PAGE"])
+    ids = [p.conversation_id for p in participants]
+    conversations = {c.id: c for c in Conversation.query.filter(
+        Conversation.id.in_(ids)).options(db.joinedload("last_message"))} \
+        if ids else {}
+    peers = {p.conversation_id: p.user for p in Participant.query.filter(
+        Participant.conversation_id.in_(ids),
+        Participant.user_id != current_user.id).options(db.joinedload("user"))} \
+        if ids else {}
+    threads = [(conversations[p.conversation_id],
+                peers.get(p.conversation_id, current_user), p.unread_count)
+               for p in participants]
+    next_url = url_for("main.messages", cursor=next_cursor) if next_cursor else None
+    first_url = url_for("main.messages") if request.args.get("cursor") else None
+    return render_template("messages.html", threads=threads, next_url=next_url,
+                           first_url=first_url)
+
+
+@bp.route("/messages/<username>")
+@login_required
+def conversation(username):
+    user = User.query.filter_by(username=username, deleted_at=None).first_or_404()
+    conversation = Conversation.between(current_user, user)
+    messages, next_cursor = [], None
+    if conversation is not None:
+        messages, next_cursor = keyset_page(
+            conversation.messages, Message, current_app.config["TASKS_PER_PAGE"])
+        participant = conversation.participants.filter_by(
+            user_id=current_user.id).first()
+        if participant is not None and participant.unread_count:
+            current_user.mark_conversation_read(conversation)
+            current_user.add_notification("unread_message_count",
+                                          current_user.new_messages())
+            db.session.commit()
+    next_url = url_for("main.conversation", username=username,
+                       cursor=next_cursor) if next_cursor else None
+    first_url = url_for("main.conversation", username=username) \
+        if request.args.get("cursor") else None
+    return render_template("conversation.html", user=user, messages=messages,
+                           next_url=next_url, first_url=first_url)
 
 
 @bp.route("/notifications")
@@ -220,9 +312,12 @@ def notifications():
 @bp.route("/export_tasks")
 @login_required
 def export_tasks():
-    if current_user.get_job_in_progress("export_tasks"):
-        flash(_("An export job is currently in progress..."))
-    else:
-        current_user.launch_job("export_tasks", _("Exporting tasks..."))
+    try:
+        current_user.launch_job("export_tasks", _("Exporting tasks..."),
+                                dedupe_key="export")
         db.session.commit()
+    except DuplicateJob:
+        flash(_("An export job is currently in progress..."))
+    except JobLimitExceeded:
+        flash(_("Too many background jobs are running, please try again later."))
     return redirect(url_for("main.user", username=current_user.username))
@@ -0,0 +1,290 @@
+import json
+import time
+from datetime import datetime, timedelta
+
+import redis
+from flask import current_app
+
+from app import db
+from app.feeds import rebuild_explore
+from app.models import ArchivedTask, Job, Notification, Participant, Task, \
+    User
+from app.queues import DuplicateJob, JobLimitExceeded
+from app.suggestions import refresh as refresh_suggestions
+
+# Notifications that hold a running total rather than an event; they are
+# kept up to date by reconcile_counts instead of being swept.
+COUNT_NOTIFICATIONS = ("unread_message_count",)
+
+
+def _batched(query_ids, delete):
+    """Apply `delete` to ids from `query_ids` one small batch at a time.
+
+    Each batch is its own transaction followed by a short pause, so other
+    writers never wait long for a lock. `delete` must take the rows out of
+    what `query_ids` selects.
+    """
+    batch_size = current_app.config["MAINTENANCE_BATCH_SIZE"]
+    pause = current_app.config["MAINTENANCE_BATCH_PAUSE"]
+    total = 0
+    while True:
+        ids = [row[0] for row in query_ids().limit(batch_size)]
+        if not ids:
+            break
+        delete(ids)
+        db.session.commit()
+        total += len(ids)
+        if len(ids) < batch_size:
+            break
+        time.sleep(pause)
+    return total
+
+
+def sweep_notifications():
+    """Delete event notifications older than NOTIFICATION_RETENTION_DAYS."""
+    cutoff = time.time() - \
+        current_app.config["NOTIFICATION_RETENTION_DAYS"] * 86400
+    return _batched(
+        lambda: db.session.query(Notification.id).filter(
+            Notification.timestamp < cutoff,
+            Notification.name.notin_(COUNT_NOTIFICATIONS)),
+        lambda ids: Notification.query.filter(Notification.id.in_(ids))
+        .delete(synchronize_session=False))
+
+
+def sweep_jobs():
+    """Delete completed jobs older than JOB_RETENTION_DAYS."""
+    cutoff = datetime.utcnow() - \
+        timedelta(days=current_app.config["JOB_RETENTION_DAYS"])
+    return _batched(
+        lambda: db.session.query(Job.id).filter(
+            Job.complete, db.or_(Job.timestamp < cutoff, Job.timestamp.is_(None))),
+        lambda ids: Job.query.filter(Job.id.in_(ids))
+        .delete(synchronize_session=False))
+
+
+def archive_tasks():
+    """Move tasks older than ARCHIVE_AFTER_DAYS, and done tasks older than
+    ARCHIVE_DONE_AFTER_DAYS, into the archive table.
+
+    Each batch is copied with INSERT ... SELECT and deleted in the same
+    transaction, so a task is always in exactly one of the two tables.
+    """
+    now = datetime.utcnow()
+    cutoff = now - timedelta(days=current_app.config["ARCHIVE_AFTER_DAYS"])
+    done_cutoff = now - \
+        timedelta(days=current_app.config["ARCHIVE_DONE_AFTER_DAYS"])
+    columns = ["id", "body", "done", "timestamp", "user_id", "language"]
+    task, archive = Task.__table__, ArchivedTask.__table__
+
+    def move(ids):
+        db.session.execute(archive.insert().from_select(
+            columns + ["archived_at"],
+            db.select([task.c[name] for name in columns] +
+                      [db.literal(now, db.DateTime)])
+            .where(task.c.id.in_(ids))))
+        db.session.execute(task.delete().where(task.c.id.in_(ids)))
+
+    moved = _batched(
+        lambda: db.session.query(Task.id).filter(
+            db.or_(Task.timestamp < cutoff,
+                   db.and_(Task.done, Task.timestamp < done_cutoff)))
+        .order_by(Task.id),
+        move)
+    if moved:
+        try:
+            rebuild_explore()
+        except redis.exceptions.RedisError as e:
+            current_app.logger.warning("Could not rebuild explore cache: %s", e)
+    return moved
+
+
+def _reconcile_jobs():
+    """Close jobs RQ has lost and free the per-type running slots held by
+    jobs that are finished or missing.
+
+    Slots are removed one by one rather than rebuilt, so a slot reserved
+    for a job whose row isn't committed yet survives; the slots are read
+    before the jobs, so one reserved meanwhile isn't even looked at.
+    """
+    from rq.job import Job as RQJob
+    r = current_app.redis
+    slots = {name: {job_id.decode()
+                    for job_id in r.zrange(f"job-slots:{name}", 0, -1)}
+             for name in current_app.config["JOB_TYPE_LIMITS"]}
+    running = set()
+    closed = 0
+    batch_size = current_app.config["MAINTENANCE_BATCH_SIZE"]
+    last_id = ""
+    while True:
+        jobs = Job.query.filter_by(complete=False).filter(Job.id > last_id) \
+            .order_by(Job.id).limit(batch_size).all()
+        if not jobs:
+            break
+        last_id = jobs[-1].id
+        rq_jobs = RQJob.fetch_many([job.id for job in jobs], connection=r)
+        for job, rq_job in zip(jobs, rq_jobs):
+            if rq_job is None or rq_job.is_failed:
+                job.complete = True
+                closed += 1
+            else:
+                running.add(job.id)
+        db.session.commit()
+    others = list(set().union(*slots.values()) - running)
+    # Slots of jobs without a row are only kept while RQ still has the job
+    # unfinished, e.g. one launched by a request that hasn't committed.
+    with_row = {row[0] for row in db.session.query(Job.id)
+                .filter(Job.id.in_(others))} if others else set()
+    without_row = [job_id for job_id in others if job_id not in with_row]
+    launched = {job_id for job_id, rq_job in zip(
+        without_row, RQJob.fetch_many(without_row, connection=r))
+        if rq_job is not None and not (rq_job.is_finished or rq_job.is_failed)}
+    pipe = r.pipeline()
+    for name, job_ids in slots.items():
+        stale = job_ids - running - launched
+        if stale:
+            pipe.zrem(f"job-slots:{name}", *stale)
+    pipe.execute()
+    return closed
+
+
+def _reconcile_unread_counts():
+    fixed = 0
+    batch_size = current_app.config["MAINTENANCE_BATCH_SIZE"]
+    last_id = 0
+    while True:
+        notifications = Notification.query.filter(
+            Notification.name == "unread_message_count",
+            Notification.id > last_id) \
+            .order_by(Notification.id).limit(batch_size).all()
+        if not notifications:
+            break
+        last_id = notifications[-1].id
+        user_ids = [n.user_id for n in notifications]
+        counts = dict(db.session.query(Participant.user_id,
+                                       db.func.sum(Participant.unread_count))
+                      .filter(Participant.user_id.in_(user_ids))
+                      .group_by(Participant.user_id))
+        for n in notifications:
+            count = counts.get(n.user_id, 0)
+            if n.get_data() != count:
+                n.payload_json = json.dumps(count)
+                fixed += 1
+        db.session.commit()
+    return fixed
+
+
+def reconcile_counts():
+    """Repair the stored counts that can drift from the rows they count:
+    unread message badges, in-progress jobs and the running-job slots."""
+    result = {"unread_counts": _reconcile_unread_counts()}
+    try:
+        result["jobs_closed"] = _reconcile_jobs()
+    except redis.exceptions.RedisError as e:
+        current_app.logger.warning("Skipping job reconciliation: %s", e)
+    return result
+
+
+def resume_deletions():
+    """Queue the deletion again for accounts marked deleted more than
+    ACCOUNT_DELETE_RETRY_AFTER seconds ago that still exist, because their
+    job failed or was never queued. Deletion picks up where it stopped."""
+    cutoff = datetime.utcnow() - \
+        timedelta(seconds=current_app.config["ACCOUNT_DELETE_RETRY_AFTER"])
+    queued = 0
+    for user in User.query.filter(User.deleted_at < cutoff).order_by(User.id):
+        try:
+            user.launch_job("delete_account", "Deleting your account...",
+                            dedupe_key="delete_account")
+            db.session.commit()
+            queued += 1
+        except (DuplicateJob, JobLimitExceeded):
+            # Still running, or no slot free until the next run.
+            db.session.rollback()
+        except redis.exceptions.RedisError as e:
+            db.session.rollback()
+            current_app.logger.warning("Could not queue account deletions: %s", e)
+            break
+    return queued
+
+
+def analyze():
+    """Refresh the query planner's table statistics."""
+    db.session.execute("ANALYZE")
+    db.session.commit()
+    return db.engine.dialect.name
+
+
+def vacuum():
+    """Return free pages to the OS on SQLite; a no-op elsewhere.
+
+    Databases in incremental auto-vacuum mode give back up to
+    MAINTENANCE_BATCH_SIZE pages per run. Otherwise a full VACUUM, which
+    locks the whole database while it rewrites it, only runs once the free
+    pages exceed MAINTENANCE_VACUUM_FREE_RATIO of the file.
+    """
+    if db.engine.dialect.name != "sqlite":
+        return None
+    with db.engine.connect() as conn:
+        pages = conn.execute("PRAGMA page_count").scalar()
+        free = conn.execute("PRAGMA freelist_count").scalar()
+        if conn.execute("PRAGMA auto_vacuum").scalar() == 2:
+            conn.execute(f"PRAGMA incremental_vacuum("
+                         f"{current_app.config['MAINTENANCE_BATCH_SIZE']})")
+            return "incremental"
+        if not pages or \
+                free / pages < current_app.config["MAINTENANCE_VACUUM_FREE_RATIO"]:
+            return "skipped"
+        conn.execute("VACUUM")
+    return "full"
+
+
+TASKS = {
+    "sweep_notifications": sweep_notifications,
+    "sweep_jobs": sweep_jobs,
+    "archive_tasks": archive_tasks,
+    "refresh_suggestions": refresh_suggestions,
+    "reconcile_counts": reconcile_counts,
+    "resume_deletions": resume_deletions,
+    "analyze": analyze,
+    "vacuum": vacuum,
+}
+
+
+def run_task(name):
+    start = time.perf_counter()
+    result = TASKS[name]()
+    elapsed = time.perf_counter() - start
+    current_app.logger.info("Maintenance %s: %s (%.2fs)", name, result, elapsed)
+    return result
+
+
+def _claim(name, interval, last_run):
+    """Whether `name` is due. A Redis key that expires after `interval`
+    marks a run, so several schedulers share one schedule; without Redis
+    each process keeps its own."""
+    try:
+        return bool(current_app.redis.set(f"maintenance:{name}", 1, nx=True,
+                                          ex=interval))
+    except redis.exceptions.RedisError:
+        now = time.monotonic()
+        if now - last_run.get(name, -interval) < interval:
+            return False
+        last_run[name] = now
+        return True
+
+
+def schedule(tick=60, once=False):
+    """Run each task in MAINTENANCE_SCHEDULE whenever its interval is up."""
+    last_run = {}
+    while True:
+        for name, interval in current_app.config["MAINTENANCE_SCHEDULE"].items():
+            if _claim(name, interval, last_run):
+                try:
+                    run_task(name)
+                except Exception:
+                    db.session.rollback()
+                    current_app.logger.exception("Maintenance %s failed", name)
+        if once:
+            break
+        time.sleep(tick)
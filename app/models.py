@@ -1,16 +1,21 @@
+import base64
 import json
-from datetime import datetime
+import os
+from datetime import datetime, timedelta
 from hashlib import md5
+from itertools import chain
 from time import time
 
 import jwt
 import redis
-import rq
 from flask import current_app
 from flask_login import UserMixin
+from sqlalchemy.exc import IntegrityError
 from werkzeug.security import generate_password_hash, check_password_hash
 
-from app import db, login
+from app import cache, db, login
+from app.queues import JobLimitExceeded, get_queue, job_priority, \
+    release_job, reserve_job
 from app.search import add_to_index, query_index
 
 
@@ -31,11 +36,76 @@ class Message(db.Model):
     body = db.Column(db.String(140))
     sender_id = db.Column(db.Integer, db.ForeignKey("user.id"))
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
+    conversation_id = db.Column(db.Integer, db.ForeignKey("conversation.id"))
+
+    __table_args__ = (
+        db.Index("ix_message_conversation_timestamp", "conversation_id",
+                 "timestamp"),
+    )
 
     def __repr__(self):
         return f"Message {self.body}>"
 
 
+class Conversation(db.Model):
+    """A private thread between two users.
+
+    The last message and its time are copied here, and onto each
+    participant's row, when a message is sent, so the inbox never has to
+    look at the messages themselves.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    # "<lower user id>:<higher user id>", so a pair has exactly one thread.
+    key = db.Column(db.String(64), index=True, unique=True)
+    last_message_id = db.Column(db.Integer)
+    last_timestamp = db.Column(db.DateTime)
+    last_message = db.relationship(
+        "Message", primaryjoin="foreign(Conversation.last_message_id) == Message.id",
+        viewonly=True)
+    messages = db.relationship("Message", backref="conversation", lazy="dynamic")
+    participants = db.relationship("Participant", backref="conversation",
+                                   lazy="dynamic")
+
+    @staticmethod
+    def key_for(user, other):
+        return ":".join(str(i) for i in sorted((user.id, other.id)))
+
+    @staticmethod
+    def between(user, other, create=False):
+        key = Conversation.key_for(user, other)
+        conversation = Conversation.query.filter_by(key=key).first()
+        if conversation is not None or not create:
+            return conversation
+        try:
+            # A savepoint, so losing a race to create the same thread only
+            # undoes this insert.
+            with db.session.begin_nested():
+                conversation = Conversation(key=key)
+                db.session.add(conversation)
+                for u in {user, other}:
+                    db.session.add(Participant(conversation=conversation, user=u))
+        except IntegrityError:
+            conversation = Conversation.query.filter_by(key=key).one()
+        return conversation
+
+
+class Participant(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    conversation_id = db.Column(db.Integer, db.ForeignKey("conversation.id"),
+                                nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    unread_count = db.Column(db.Integer, default=0, nullable=False)
+    # The conversation's last_timestamp, duplicated so that a user's inbox
+    # is a range scan of one index.
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    user = db.relationship("User")
+
+    __table_args__ = (
+        db.UniqueConstraint("conversation_id", "user_id"),
+        db.Index("ix_participant_user_timestamp", "user_id", "timestamp", "id"),
+    )
+
+
 class SearchableMixin(object):
     @classmethod
     def search(cls, expression, page, per_page):
@@ -79,19 +149,54 @@ class SearchableMixin(object):
 db.event.listen(db.session, "before_commit", SearchableMixin.before_commit)
 db.event.listen(db.session, "after_commit", SearchableMixin.after_commit)
 
+
+def _record_invalidations(session, flush_context):
+    """Note the follow counts changed by a flush, to be evicted from every
+    process's cache once the transaction commits. Only kinds that something
+    caches are recorded, as each costs a publish."""
+    for obj in chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, User):
+            added, _, removed = db.inspect(obj).attrs.followed.history
+            if added or removed:
+                cache.record(session, "follows",
+                             [obj.id] + [u.id for u in chain(added, removed)])
+
+
+db.event.listen(db.session, "after_flush", _record_invalidations)
+db.event.listen(db.session, "after_commit", cache.publish_pending)
+db.event.listen(db.session, "after_rollback", cache.discard_pending)
+
 # An association table that helps model a many-to-many relationship
 # between a user's followers and "followeds".
 followers = db.Table(
     "followers",
     db.Column("follower_id", db.Integer, db.ForeignKey("user.id")),
     db.Column("followed_id", db.Integer, db.ForeignKey("user.id")),
+    # Finds a user's followers without scanning the table.
+    db.Index("ix_followers_followed_follower", "followed_id", "follower_id"),
 )
 
 
 @login.user_loader
 def load_user(_id):
     """Given an ID, load a user from the database for flask_login."""
-    return User.query.get(int(_id))
+    user = User.query.get(int(_id))
+    return user if user is not None and user.deleted_at is None else None
+
+
+class FollowSuggestion(db.Model):
+    """Precomputed "who to follow" entries, refreshed offline by
+    app.suggestions so pages never walk the follow graph."""
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True)
+    suggested_id = db.Column(db.Integer, db.ForeignKey("user.id"),
+                             primary_key=True)
+    # Number of followed users who follow the suggested user.
+    score = db.Column(db.Integer)
+    suggested = db.relationship("User", foreign_keys=[suggested_id])
+
+    __table_args__ = (
+        db.Index("ix_follow_suggestion_user_score", "user_id", "score"),
+    )
 
 
 # Multiple inheritance to fit the flask_login requirements.
@@ -123,11 +228,44 @@ class User(UserMixin, db.Model):
     last_message_read_time = db.Column(db.DateTime)
     notifications = db.relationship("Notification", backref="user", lazy="dynamic")
     jobs = db.relationship("Job", backref="user", lazy="dynamic")
+    token = db.Column(db.String(32), index=True, unique=True)
+    token_expiration = db.Column(db.DateTime)
+    # Set when the user follows or unfollows someone, so the next
+    # suggestions refresh recomputes them and their followers.
+    suggestions_stale = db.Column(db.Boolean, default=False, index=True)
+    # Set when the user asks for their account to be deleted. From then on
+    # they can't log in, and the delete_account job removes their data.
+    deleted_at = db.Column(db.DateTime)
 
     def new_messages(self):
-        last_read_time = self.last_message_read_time or datetime(1900, 1, 1)
-        return Message.query.filter_by(recipient=self).filter(
-            Message.timestamp > last_read_time).count()
+        return db.session.query(db.func.coalesce(db.func.sum(
+            Participant.unread_count), 0)).filter_by(user_id=self.id).scalar()
+
+    def send_message(self, recipient, body):
+        """Add a message to the thread with `recipient`, creating the thread
+        if needed, and bump the recipient's unread count."""
+        conversation = Conversation.between(self, recipient, create=True)
+        message = Message(author=self, recipient=recipient, body=body,
+                          conversation=conversation)
+        db.session.add(message)
+        db.session.flush()
+        conversation.last_message_id = message.id
+        conversation.last_timestamp = message.timestamp
+        # One UPDATE for both sides, incrementing in SQL so concurrent
+        # messages don't lose counts.
+        Participant.query.filter_by(conversation_id=conversation.id).update({
+            "timestamp": message.timestamp,
+            "unread_count": db.case(
+                [(Participant.user_id == recipient.id,
+                  Participant.unread_count + 1)],
+                else_=Participant.unread_count),
+        }, synchronize_session=False)
+        return message
+
+    def mark_conversation_read(self, conversation):
+        Participant.query.filter_by(conversation_id=conversation.id,
+                                    user_id=self.id) \
+            .update({"unread_count": 0}, synchronize_session=False)
 
     def avatar(self, size):
         digest = md5(self.email.lower().encode("utf-8")).hexdigest()
@@ -144,10 +282,61 @@ class User(UserMixin, db.Model):
     def follow(self, user):
         if not self.is_following(user):
             self.followed.append(user)
+            self.suggestions_stale = True
+            FollowSuggestion.query.filter_by(user_id=self.id, suggested_id=user.id) \
+                .delete(synchronize_session=False)
 
     def unfollow(self, user):
         if self.is_following(user):
             self.followed.remove(user)
+            self.suggestions_stale = True
+
+    def _diff_follows(self, user_ids):
+        """Split `user_ids` into the ids of active users this user already
+        follows and of those they don't, in one query."""
+        followed, not_followed = set(), set()
+        rows = db.session.query(User.id, followers.c.follower_id).outerjoin(
+            followers, db.and_(followers.c.followed_id == User.id,
+                               followers.c.follower_id == self.id)) \
+            .filter(User.id.in_(set(user_ids) - {self.id}),
+                    User.deleted_at.is_(None))
+        for user_id, follower_id in rows:
+            (followed if follower_id is not None else not_followed).add(user_id)
+        return followed, not_followed
+
+    def follow_many(self, user_ids):
+        """Follow every user in `user_ids` not already followed, with one
+        multi-row INSERT. Unknown ids, and this user's own, are ignored.
+        Returns the ids newly followed."""
+        _, new = self._diff_follows(user_ids)
+        if new:
+            db.session.execute(followers.insert(), [
+                {"follower_id": self.id, "followed_id": user_id}
+                for user_id in sorted(new)])
+            FollowSuggestion.query.filter(
+                FollowSuggestion.user_id == self.id,
+                FollowSuggestion.suggested_id.in_(new)) \
+                .delete(synchronize_session=False)
+            self.suggestions_stale = True
+            cache.record(db.session, "follows", new | {self.id})
+        return sorted(new)
+
+    def unfollow_many(self, user_ids):
+        """Unfollow every followed user in `user_ids` with one DELETE.
+        Returns the ids unfollowed."""
+        gone, _ = self._diff_follows(user_ids)
+        if gone:
+            db.session.execute(followers.delete().where(db.and_(
+                followers.c.follower_id == self.id,
+                followers.c.followed_id.in_(gone))))
+            self.suggestions_stale = True
+            cache.record(db.session, "follows", gone | {self.id})
+        return sorted(gone)
+
+    def follow_counts(self):
+        """(followers, following), from the process cache."""
+        return cache.cached("follows", self.id, lambda: (
+            self.followers.count(), self.followed.count()))
 
     def is_following(self, user):
         return self.followed.filter(followers.c.followed_id == user.id).count() > 0
@@ -161,10 +350,39 @@ class User(UserMixin, db.Model):
         own = Task.query.filter_by(user_id=self.id)
         return followed.union(own).order_by(Task.timestamp.desc())
 
+    def follow_suggestions(self, limit):
+        return [s.suggested for s in FollowSuggestion.query
+                .filter_by(user_id=self.id)
+                .join(FollowSuggestion.suggested)
+                .filter(User.deleted_at.is_(None))
+                .options(db.contains_eager(FollowSuggestion.suggested))
+                .order_by(FollowSuggestion.score.desc(),
+                          FollowSuggestion.suggested_id)
+                .limit(limit)]
+
     def own_tasks(self):
         own = Task.query.filter_by(user_id=self.id)
         return own.order_by(Task.timestamp.desc())
 
+    def tasks_page(self, page, per_page):
+        """One page of the user's tasks, newest first, and whether there
+        is another page.
+
+        Current tasks come first. The archive is only queried once the
+        pages run past them, so most profile views never touch it.
+        """
+        start = (max(page, 1) - 1) * per_page
+        hot = self.tasks.order_by(Task.timestamp.desc(), Task.id.desc()) \
+            .offset(start).limit(per_page + 1).all()
+        if len(hot) > per_page:
+            return hot[:per_page], True
+        hot_total = start + len(hot) if hot else self.tasks.count()
+        need = per_page - len(hot)
+        archived = ArchivedTask.query.filter_by(user_id=self.id) \
+            .order_by(ArchivedTask.timestamp.desc(), ArchivedTask.id.desc()) \
+            .offset(max(0, start - hot_total)).limit(need + 1).all()
+        return hot + archived[:need], len(archived) > need
+
     def get_reset_password_token(self, expires_in=600):
         return jwt.encode(
             {"reset_password": self.id,
@@ -189,10 +407,33 @@ class User(UserMixin, db.Model):
         db.session.add(n)
         return n
 
-    def launch_job(self, name, description, *args, **kwargs):
-        rq_job = current_app.job_queue.enqueue("app.jobs." + name, self.id, *args, **kwargs)
+    def launch_job(self, name, description, *args, dedupe_key=None,
+                   priority=None, **kwargs):
+        """Enqueue a background job for this user.
+
+        The job goes to the queue of the given priority class, by default
+        the one configured for the job in JOB_PRIORITIES.
+
+        Raises JobLimitExceeded if the user already has JOB_MAX_PER_USER
+        unfinished jobs or the job type is at its global cap, and DuplicateJob
+        if a job with the same `dedupe_key` is still queued or running.
+        """
+        # Avoid circular dependencies.
+        from app.job_status import clear_no_jobs
+        if Job.query.filter_by(user=self, complete=False).count() \
+                >= current_app.config["JOB_MAX_PER_USER"]:
+            raise JobLimitExceeded("Too many jobs in progress")
+        queue = get_queue(priority or job_priority(name))
+        job_id, meta = reserve_job(self.id, name, dedupe_key)
+        try:
+            rq_job = queue.enqueue("app.jobs." + name, self.id, *args,
+                                   job_id=job_id, meta=meta, **kwargs)
+        except Exception:
+            release_job(job_id, meta)
+            raise
         job = Job(id=rq_job.get_id(), name=name, description=description, user=self)
         db.session.add(job)
+        clear_no_jobs(self.id)
         return job
 
     def get_jobs_in_progress(self):
@@ -201,13 +442,35 @@ class User(UserMixin, db.Model):
     def get_job_in_progress(self, name):
         return Job.query.filter_by(user=self, name=name, complete=False).first()
 
+    def get_token(self, expires_in=3600):
+        """Return the current API token, issuing a new one if it is about to expire."""
+        now = datetime.utcnow()
+        if self.token and self.token_expiration > now + timedelta(seconds=60):
+            return self.token
+        self.token = base64.b64encode(os.urandom(24)).decode("utf-8")
+        self.token_expiration = now + timedelta(seconds=expires_in)
+        db.session.add(self)
+        return self.token
+
+    def revoke_token(self):
+        self.token_expiration = datetime.utcnow() - timedelta(seconds=1)
+
+    @staticmethod
+    def check_token(token):
+        user = User.query.filter_by(token=token).first()
+        if user is None or user.token_expiration < datetime.utcnow() \
+                or user.deleted_at is not None:
+            return None
+        return user
+
     def __repr__(self) -> str:
         return f"<User {self.username}>"
 
 
 @login.user_loader
 def load_user(_id):
-    return User.query.get(int(_id))
+    user = User.query.get(int(_id))
+    return user if user is not None and user.deleted_at is None else None
 
 
 class Task(SearchableMixin, db.Model):
@@ -219,21 +482,63 @@ class Task(SearchableMixin, db.Model):
     language = db.Column(db.String(5))
     __searchable__ = ["body"]
 
+    # Without AUTOINCREMENT SQLite hands out the ids of deleted rows again,
+    # which may still be in use in archived_task.
+    __table_args__ = {"sqlite_autoincrement": True}
+
+    @classmethod
+    def search(cls, expression, page, per_page):
+        """Like SearchableMixin.search, but returns a list that also holds
+        hits from the archive, in relevance order."""
+        ids, total = query_index(cls.__tablename__, expression, page, per_page)
+        found = {t.id: t for t in cls.query.filter(cls.id.in_(ids))} if ids else {}
+        missing = [i for i in ids if i not in found]
+        if missing:
+            found.update((t.id, t) for t in ArchivedTask.query.filter(
+                ArchivedTask.id.in_(missing)))
+        return [found[i] for i in ids if i in found], total
+
     def __repr__(self) -> str:
         return f"<Task {self.body} written by user {self.user_id}>"
 
 
+class ArchivedTask(db.Model):
+    """Old and done tasks, moved out of `task` by the archive_tasks
+    maintenance job so the hot table and its indexes stay small.
+
+    Rows keep their task id and stay in the search index under it.
+    """
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    body = db.Column(db.String(140))
+    done = db.Column(db.Boolean())
+    timestamp = db.Column(db.DateTime)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"))
+    language = db.Column(db.String(5))
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+    author = db.relationship("User")
+
+    __table_args__ = (
+        db.Index("ix_archived_task_user_timestamp", "user_id", "timestamp", "id"),
+    )
+
+    def __repr__(self) -> str:
+        return f"<ArchivedTask {self.body} written by user {self.user_id}>"
+
+
 class Job(db.Model):
     id = db.Column(db.String(36), primary_key=True)
     name = db.Column(db.String(128), index=True)
     description = db.Column(db.String(128))
     user_id = db.Column(db.Integer, db.ForeignKey("user.id"))
     complete = db.Column(db.Boolean, default=False)
+    timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
 
     def get_rq_job(self):
+        from rq.exceptions import NoSuchJobError
+        from rq.job import Job as RQJob
         try:
-            rq_job = rq.job.Job.fetch(self.id, connection=current_app.redis)
-        except (redis.exceptions.RedisError, rq.exceptions.NoSuchJobError):
+            rq_job = RQJob.fetch(self.id, connection=current_app.redis)
+        except (redis.exceptions.RedisError, NoSuchJobError):
             return None
         return rq_job
 
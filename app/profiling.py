@@ -0,0 +1,128 @@
+import cProfile
+import os
+import pstats
+import random
+import re
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from flask import current_app, g, request
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+
+SUFFIX = ".pstats"
+_unsafe = re.compile(r"[^A-Za-z0-9_.-]")
+
+
+def _serializer(app):
+    return URLSafeTimedSerializer(app.config["SECRET_KEY"], salt="profile")
+
+
+def make_token(app):
+    """A token for the PROFILE_HEADER header that forces a request to be
+    profiled, for admins chasing a slow page."""
+    return _serializer(app).dumps("profile")
+
+
+def _token_valid(app, token):
+    try:
+        _serializer(app).loads(token, max_age=app.config["PROFILE_TOKEN_MAX_AGE"])
+    except BadSignature:
+        return False
+    return True
+
+
+def start():
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Only one profiler can be active at a time on Python 3.12+.
+        return None
+    return profiler
+
+
+def save(profiler, kind, name):
+    """Write the profile to PROFILE_DIR and drop the oldest files beyond
+    PROFILE_MAX_FILES."""
+    profiler.disable()
+    directory = current_app.config["PROFILE_DIR"]
+    os.makedirs(directory, exist_ok=True)
+    filename = f"{kind}__{_unsafe.sub('_', name)}__" \
+               f"{int(time.time() * 1000)}_{os.getpid()}{SUFFIX}"
+    profiler.dump_stats(os.path.join(directory, filename))
+    # Oldest first, by the timestamp after the last separator.
+    files = sorted((f for f in os.listdir(directory) if f.endswith(SUFFIX)),
+                   key=lambda f: f.rsplit("__", 1)[1])
+    for old in files[:-current_app.config["PROFILE_MAX_FILES"]]:
+        try:
+            os.remove(os.path.join(directory, old))
+        except OSError:
+            pass
+
+
+def _sampled():
+    rate = current_app.config["PROFILE_SAMPLE_RATE"]
+    return rate > 0 and random.random() < rate
+
+
+@contextmanager
+def profiled(kind, name):
+    """Profile the block if it is picked by PROFILE_SAMPLE_RATE."""
+    profiler = start() if _sampled() else None
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            save(profiler, kind, name)
+
+
+def _parse_filename(filename):
+    kind, name, _ = filename[:-len(SUFFIX)].split("__", 2)
+    return kind, name
+
+
+def report(directory, top=20, sort="cumulative", name=None):
+    """Aggregate the saved profiles per endpoint or job and return the top
+    functions of each, heaviest first."""
+    groups = defaultdict(list)
+    for filename in sorted(os.listdir(directory)) if os.path.isdir(directory) else ():
+        if not filename.endswith(SUFFIX):
+            continue
+        kind, target = _parse_filename(filename)
+        if name is None or target == name:
+            groups[f"{kind}:{target}"].append(os.path.join(directory, filename))
+    result = {}
+    for target, paths in sorted(groups.items()):
+        stats = pstats.Stats(*paths)
+        rows = []
+        for (path, line, function), (_, calls, tottime, cumtime, _) \
+                in stats.stats.items():
+            rows.append({
+                "function": f"{os.path.basename(path)}:{line}({function})",
+                "calls": calls,
+                "tottime": round(tottime, 6),
+                "cumtime": round(cumtime, 6),
+            })
+        key = "tottime" if sort == "tottime" else "cumtime"
+        rows.sort(key=lambda row: row[key], reverse=True)
+        result[target] = {"samples": len(paths),
+                          "total_s": round(stats.total_tt, 6),
+                          "functions": rows[:top]}
+    return result
+
+
+def init_app(app):
+    header = app.config["PROFILE_HEADER"]
+
+    @app.before_request
+    def start_profiling():
+        token = request.headers.get(header)
+        if (token and _token_valid(app, token)) or _sampled():
+            g.profiler = start()
+
+    @app.teardown_request
+    def stop_profiling(exc):
+        profiler = g.pop("profiler", None)
+        if profiler is not None:
+            save(profiler, "request", request.endpoint or "unmatched")
@@ -0,0 +1,91 @@
+import time
+import uuid
+
+from flask import current_app
+
+
+class JobLimitExceeded(Exception):
+    pass
+
+
+class DuplicateJob(JobLimitExceeded):
+    pass
+
+
+def get_queue(priority="default"):
+    """Return the RQ queue for a priority class, creating it on first use.
+
+    Priority classes map to queue names through the RQ_QUEUES setting. rq
+    is imported here rather than at module level so that web processes and
+    CLI commands that never enqueue a job don't pay for the import.
+    """
+    try:
+        name = current_app.config["RQ_QUEUES"][priority]
+    except KeyError:
+        raise ValueError(f"Unknown job priority {priority!r}")
+    queues = current_app.extensions.setdefault("rq_queues", {})
+    if name not in queues:
+        import rq
+        queues[name] = rq.Queue(name, connection=current_app.redis)
+    return queues[name]
+
+
+def job_priority(name):
+    return current_app.config["JOB_PRIORITIES"].get(name, "default")
+
+
+def _lock_key(user_id, name, dedupe_key):
+    return f"job-lock:{user_id}:{name}:{dedupe_key}"
+
+
+def _running_key(name):
+    return f"job-slots:{name}"
+
+
+def reserve_job(user_id, name, dedupe_key=None):
+    """Claim the right to enqueue a job, before it is enqueued.
+
+    With a `dedupe_key`, an atomic SET NX lock makes sure only one job with
+    that key is queued or running for the user; a second attempt raises
+    DuplicateJob. Job types listed in JOB_TYPE_LIMITS also take one of a
+    fixed number of global slots: a sorted set of job ids scored by the
+    time their slot expires, so a slot a crashed worker never released
+    frees itself after JOB_LOCK_TTL seconds. Returns the job id to enqueue under and
+    the meta that `release_job` needs to undo the reservation.
+    """
+    r = current_app.redis
+    job_id = str(uuid.uuid4())
+    ttl = current_app.config["JOB_LOCK_TTL"]
+    meta = {}
+    if dedupe_key is not None:
+        lock_key = _lock_key(user_id, name, dedupe_key)
+        if not r.set(lock_key, job_id, nx=True, ex=ttl):
+            raise DuplicateJob(f"{name} is already queued")
+        meta["lock_key"] = lock_key
+
+    limit = current_app.config["JOB_TYPE_LIMITS"].get(name)
+    if limit is not None:
+        key = _running_key(name)
+        now = time.time()
+        pipe = r.pipeline()
+        pipe.zremrangebyscore(key, "-inf", now)
+        pipe.zadd(key, {job_id: now + ttl})
+        pipe.zcard(key)
+        # Every slot in it has expired by the time the key does.
+        pipe.expire(key, ttl)
+        running = pipe.execute()[2]
+        meta["slot_key"] = key
+        if running > limit:
+            release_job(job_id, meta)
+            raise JobLimitExceeded(f"Too many {name} jobs are running")
+    return job_id, meta
+
+
+def release_job(job_id, meta):
+    r = current_app.redis
+    lock_key = meta.get("lock_key")
+    # Only drop the lock if it still belongs to this job.
+    if lock_key and r.get(lock_key) == job_id.encode():
+        r.delete(lock_key)
+    if meta.get("slot_key"):
+        r.zrem(meta["slot_key"], job_id)
@@ -0,0 +1,115 @@
+import math
+import threading
+import time
+
+import redis
+from flask import current_app, request, session
+from werkzeug.exceptions import TooManyRequests
+
+# Refills the bucket for the time since the last request, then takes one
+# token if there is one. Runs atomically in Redis, so concurrent requests
+# from many web processes can't overspend a bucket.
+TOKEN_BUCKET_LUA = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local state = redis.call("HMGET", KEYS[1], "tokens", "ts")
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local retry_after = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    retry_after = (1 - tokens) / rate
+end
+redis.call("HSET", KEYS[1], "tokens", tokens, "ts", now)
+redis.call("EXPIRE", KEYS[1], math.ceil(capacity / rate) + 1)
+return tostring(retry_after)
+"""
+
+
+class LocalBuckets(object):
+    """The same token buckets kept in process memory.
+
+    Used while Redis is unreachable. Each process then enforces the limits
+    on its own, which is looser than the shared buckets but still stops a
+    single client from hammering an endpoint. Redis is tried again after
+    `retry_interval` seconds rather than on every request.
+    """
+
+    def __init__(self, retry_interval=30):
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.retry_interval = retry_interval
+        self.down_until = 0
+
+    def take(self, key, capacity, rate, now):
+        with self.lock:
+            tokens, ts = self.buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + max(0, now - ts) * rate)
+            retry_after = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                retry_after = (1 - tokens) / rate
+            self.buckets[key] = (tokens, now)
+            # Forget full buckets so the dict doesn't grow without bound.
+            if len(self.buckets) > 10000:
+                self.buckets = {k: v for k, v in self.buckets.items()
+                                if v[0] + (now - v[1]) * rate < capacity}
+            return retry_after
+
+
+def client_id(limit):
+    """Who a request is counted against: the logged in user, or the owner of
+    the bearer token for the API, or the client address for anonymous
+    requests and for limits marked `by_ip`."""
+    if not limit.get("by_ip"):
+        user_id = session.get("_user_id")
+        if user_id is None and request.blueprint == "api":
+            # Avoid circular dependencies.
+            from app.api.auth import token_user
+            user = token_user()
+            user_id = user.id if user is not None else None
+        if user_id is not None:
+            return f"user:{user_id}"
+    return f"ip:{request.remote_addr}"
+
+
+def take_token(key, capacity, rate):
+    """Spend one token from the bucket at `key`. Returns 0 when the request
+    may go ahead, otherwise the seconds until a token is available."""
+    now = time.time()
+    local = current_app.extensions["ratelimit_local"]
+    if time.monotonic() >= local.down_until:
+        script = current_app.extensions.get("ratelimit_script")
+        if script is None:
+            script = current_app.extensions["ratelimit_script"] = \
+                current_app.redis.register_script(TOKEN_BUCKET_LUA)
+        try:
+            return float(script(keys=[key], args=[capacity, rate, now]))
+        except redis.exceptions.RedisError as e:
+            current_app.logger.warning("Rate limiting in-process for %ss: %s",
+                                       local.retry_interval, e)
+            local.down_until = time.monotonic() + local.retry_interval
+    return local.take(key, capacity, rate, now)
+
+
+def init_app(app):
+    app.extensions["ratelimit_local"] = LocalBuckets(
+        app.config["RATELIMIT_REDIS_RETRY_INTERVAL"])
+
+    @app.before_request
+    def check_rate_limit():
+        if not app.config["RATELIMIT_ENABLED"]:
+            return
+        limit = app.config["RATE_LIMITS"].get(request.endpoint)
+        if limit is None or \
+                request.method not in limit.get("methods", (request.method,)):
+            return
+        key = f"ratelimit:{request.endpoint}:{client_id(limit)}"
+        retry_after = take_token(key, limit["limit"],
+                                 limit["limit"] / limit["period"])
+        if retry_after:
+            raise TooManyRequests(retry_after=math.ceil(retry_after))
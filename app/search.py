@@ -1,29 +1,124 @@
+import time
+
 from flask import current_app
 
+from app.instrumentation import timed
+
+
+class ElasticsearchConnection(object):
+    """Lazily connects to Elasticsearch on first use.
+
+    Nothing touches the network at app creation time. If the cluster cannot
+    be reached, search degrades to "no results" and indexing is skipped;
+    the connection is retried after ELASTICSEARCH_RETRY_INTERVAL seconds.
+    """
+
+    def __init__(self, url, timeout=5, retry_interval=30):
+        self.url = url
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        self.down_until = 0
+        self._client = None
+        self._indices = set()
+
+    def client(self, index):
+        if not self.url or time.monotonic() < self.down_until:
+            return None
+        if self._client is None:
+            from elasticsearch import Elasticsearch
+            self._client = Elasticsearch([self.url], timeout=self.timeout)
+        if index not in self._indices:
+            from elasticsearch.exceptions import TransportError
+            try:
+                with timed("es"):
+                    if not self._client.indices.exists(index):
+                        self._client.indices.create(index)
+            except TransportError as e:
+                self.mark_down(e)
+                return None
+            self._indices.add(index)
+        return self._client
+
+    def mark_down(self, error):
+        current_app.logger.warning("Elasticsearch unavailable, retrying in "
+                                   "%ss: %s", self.retry_interval, error)
+        self.down_until = time.monotonic() + self.retry_interval
+        # Re-check the indices once the cluster is back.
+        self._indices.clear()
+
+
+def _connection():
+    return current_app.extensions["elasticsearch"]
+
+
+def _call(index, method, **kwargs):
+    connection = _connection()
+    client = connection.client(index)
+    if client is None:
+        return None
+    from elasticsearch.exceptions import ConnectionError
+    try:
+        with timed("es"):
+            return getattr(client, method)(index=index, **kwargs)
+    except ConnectionError as e:
+        connection.mark_down(e)
+        return None
+
 
 def add_to_index(index, model):
-    if not current_app.elasticsearch:
-        return
     payload = {}
     for field in model.__searchable__:
         payload[field] = getattr(model, field)
-    current_app.elasticsearch.index(index=index, id=model.id, body=payload)
+    _call(index, "index", id=model.id, body=payload)
+
+
+def add_many_to_index(index, models):
+    """Index many models with a single bulk request."""
+    connection = _connection()
+    client = connection.client(index)
+    if client is None:
+        return
+    from elasticsearch.exceptions import ConnectionError
+    from elasticsearch.helpers import bulk
+    actions = [{"_index": index, "_id": model.id,
+                "_source": {field: getattr(model, field)
+                            for field in model.__searchable__}}
+               for model in models]
+    try:
+        with timed("es"):
+            bulk(client, actions)
+    except ConnectionError as e:
+        connection.mark_down(e)
 
 
 def remove_from_index(index, model):
-    if not current_app.elasticsearch:
+    _call(index, "delete", id=model.id)
+
+
+def remove_many_from_index(index, ids):
+    """Delete many documents with a single bulk request. Ids that were
+    never indexed are ignored."""
+    connection = _connection()
+    client = connection.client(index)
+    if client is None:
         return
-    current_app.elasticsearch.delete(index=index, id=model.id)
+    from elasticsearch.exceptions import ConnectionError
+    from elasticsearch.helpers import bulk
+    actions = [{"_op_type": "delete", "_index": index, "_id": i} for i in ids]
+    try:
+        with timed("es"):
+            bulk(client, actions, raise_on_error=False)
+    except ConnectionError as e:
+        connection.mark_down(e)
 
 
 def query_index(index, query, page, per_page):
-    if not current_app.elasticsearch:
-        return [], 0
-
-    search = current_app.elasticsearch.search(
-        index=index,
+    search = _call(
+        index, "search",
         body={"query": {"multi_match": {"query": query, "fields": ["*"]}},
               "from": (page - 1) * per_page, "size": per_page}
     )
+    if search is None:
+        return [], 0
     ids = [int(hit["_id"]) for hit in search["hits"]["hits"]]
     return ids, search["hits"]["total"]["value"]
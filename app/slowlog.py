@@ -0,0 +1,135 @@
+import json
+import logging
+import re
+from collections import defaultdict
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+
+from flask import current_app, has_app_context, has_request_context, request
+
+from app.instrumentation import query_listeners
+from app.log import queue_logger
+
+EXPLAIN = {"sqlite": "EXPLAIN QUERY PLAN ", "postgresql": "EXPLAIN "}
+EXPLAINABLE = ("select", "with", "update", "delete", "insert")
+
+_strings = re.compile(r"'(?:[^']|'')*'")
+_numbers = re.compile(r"\b\d+(?:\.\d+)?\b")
+_lists = re.compile(r"\((?:\s*(?:\?|%\(\w+\)s|%s)\s*,)+\s*(?:\?|%\(\w+\)s|%s)\s*\)")
+_spaces = re.compile(r"\s+")
+
+
+def normalize(statement):
+    """The statement with literals and IN lists folded, so the same query
+    with different values is counted as one."""
+    statement = _strings.sub("?", statement)
+    statement = _numbers.sub("?", statement)
+    statement = _lists.sub("(...)", statement)
+    return _spaces.sub(" ", statement).strip()
+
+
+def _source():
+    if has_request_context():
+        return request.endpoint or "<unmatched>"
+    from rq import get_current_job
+    job = get_current_job()
+    if job is not None:
+        return f"job:{job.func_name}"
+    return "<cli>"
+
+
+def explain(conn, statement, parameters):
+    """The query plan of `statement`, from a separate cursor so the results
+    of the query itself are left alone. EXPLAIN without ANALYZE does not
+    run the statement."""
+    prefix = EXPLAIN.get(conn.dialect.name)
+    if prefix is None or \
+            not statement.lstrip().lower().startswith(EXPLAINABLE):
+        return None
+    cursor = conn.connection.cursor()
+    postgres = conn.dialect.name == "postgresql"
+    try:
+        # A failed statement aborts the whole transaction on Postgres.
+        if postgres:
+            cursor.execute("SAVEPOINT slow_query_explain")
+        try:
+            cursor.execute(prefix + statement, parameters)
+            rows = cursor.fetchall()
+        except Exception as e:
+            if postgres:
+                cursor.execute("ROLLBACK TO SAVEPOINT slow_query_explain")
+            return f"EXPLAIN failed: {e}"
+        if postgres:
+            cursor.execute("RELEASE SAVEPOINT slow_query_explain")
+    finally:
+        cursor.close()
+    if postgres:
+        return "\n".join(row[0] for row in rows)
+    return "\n".join(str(row[-1]) for row in rows)
+
+
+def _log_slow_query(conn, statement, parameters, executemany, elapsed):
+    if not has_app_context():
+        return
+    logger = current_app.extensions.get("slow_query_log")
+    elapsed_ms = elapsed * 1000
+    if logger is None or elapsed_ms < current_app.config["SLOW_QUERY_MS"]:
+        return
+    entry = {
+        "time": datetime.utcnow().isoformat(),
+        "elapsed_ms": round(elapsed_ms, 3),
+        "source": _source(),
+        "normalized": normalize(statement),
+        "statement": statement,
+        "parameters": repr(parameters)[:1000],
+        "executemany": executemany,
+        "plan": None if executemany else explain(conn, statement, parameters),
+    }
+    logger.info(json.dumps(entry, default=str))
+
+
+query_listeners.append(_log_slow_query)
+
+
+def summarize(lines, top=20):
+    """The slowest statements in a slow query log by total time spent."""
+    stats = defaultdict(lambda: {"count": 0, "total_ms": 0.0, "max_ms": 0.0,
+                                 "sources": set(), "plan": None})
+    for line in lines:
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            continue
+        s = stats[entry["normalized"]]
+        s["count"] += 1
+        s["total_ms"] += entry["elapsed_ms"]
+        s["sources"].add(entry["source"])
+        if entry["elapsed_ms"] >= s["max_ms"]:
+            s["max_ms"] = entry["elapsed_ms"]
+            s["plan"] = entry.get("plan")
+    worst = sorted(stats.items(), key=lambda item: item[1]["total_ms"],
+                   reverse=True)[:top]
+    return [{"statement": statement,
+             "count": s["count"],
+             "total_ms": round(s["total_ms"], 3),
+             "mean_ms": round(s["total_ms"] / s["count"], 3),
+             "max_ms": s["max_ms"],
+             "sources": sorted(s["sources"]),
+             "plan": s["plan"]} for statement, s in worst]
+
+
+def init_app(app):
+    """Write slow queries to SLOW_QUERY_LOG from a listener thread, so the
+    request only pays for the EXPLAIN."""
+    if not app.config["SLOW_QUERY_MS"]:
+        return
+    handler = RotatingFileHandler(app.config["SLOW_QUERY_LOG"],
+                                  maxBytes=app.config["LOG_MAX_BYTES"],
+                                  backupCount=app.config["LOG_BACKUP_COUNT"],
+                                  delay=True)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    # One logger per app, outside the logging module's tree, so apps with
+    # different logs don't share handlers.
+    logger = logging.Logger("app.slowlog", logging.INFO)
+    app.extensions["slow_query_log"] = logger
+    app.extensions["slow_query_listener"] = queue_logger(logger, [handler])
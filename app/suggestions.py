@@ -0,0 +1,160 @@
+import heapq
+from array import array
+from collections import Counter, namedtuple
+
+from flask import current_app
+
+from app import db
+from app.models import FollowSuggestion, User, followers
+
+try:
+    import numpy as np
+    from scipy import sparse
+except ImportError:
+    np = sparse = None
+
+# The follow graph in compressed sparse row form: the users followed by
+# user `u` are indices[indptr[u]:indptr[u + 1]], in ascending order.
+Graph = namedtuple("Graph", "indptr indices")
+
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def load_graph(exclude=()):
+    """Read the whole followers table into a Graph, a few thousand rows at
+    a time, leaving out follows of the users in `exclude`. Two 8 byte
+    integers per user and one per follow.
+
+    The graph covers every user that existed when it was started, and
+    grows to take in users who joined, and followed, while it was read."""
+    size = (db.session.query(db.func.max(User.id)).scalar() or 0) + 1
+    counts = array("q", bytes(8 * size))
+    indices = array("q")
+    result = db.session.execute(
+        db.select([followers.c.follower_id, followers.c.followed_id])
+        .order_by(followers.c.follower_id, followers.c.followed_id))
+    last = None
+    for rows in iter(lambda: result.fetchmany(10000), []):
+        for edge in rows:
+            if edge != last and None not in edge and edge[1] not in exclude:
+                size = max(size, edge[0] + 1, edge[1] + 1)
+                if size > len(counts):
+                    counts.extend(bytes(8 * (size - len(counts))))
+                counts[edge[0]] += 1
+                indices.append(edge[1])
+                last = edge
+    indptr = array("q", bytes(8 * (size + 1)))
+    for u in range(size):
+        indptr[u + 1] = indptr[u] + counts[u]
+    return Graph(indptr, indices)
+
+
+def _top(candidates, k):
+    return heapq.nsmallest(k, candidates, key=lambda c: (-c[1], c[0]))
+
+
+def _two_hop_python(graph, user_ids, k):
+    indptr, indices = graph
+    result = {}
+    for u in user_ids:
+        followed = indices[indptr[u]:indptr[u + 1]]
+        counts = Counter()
+        for v in followed:
+            counts.update(indices[indptr[v]:indptr[v + 1]])
+        for v in followed:
+            counts.pop(v, None)
+        counts.pop(u, None)
+        result[u] = _top(counts.items(), k)
+    return result
+
+
+def _two_hop_scipy(graph, user_ids, k):
+    indptr = np.frombuffer(graph.indptr, dtype=np.int64)
+    indices = np.frombuffer(graph.indices, dtype=np.int64)
+    size = len(indptr) - 1
+    adjacency = sparse.csr_matrix(
+        (np.ones(len(indices), dtype=np.int32), indices, indptr),
+        shape=(size, size))
+    # Row i holds, for every user, how many of user_ids[i]'s followed
+    # users follow them.
+    two_hop = adjacency[user_ids] @ adjacency
+    result = {}
+    for i, u in enumerate(user_ids):
+        start, end = two_hop.indptr[i], two_hop.indptr[i + 1]
+        candidates, scores = two_hop.indices[start:end], two_hop.data[start:end]
+        keep = ~np.isin(candidates, indices[indptr[u]:indptr[u + 1]]) & \
+            (candidates != u)
+        candidates, scores = candidates[keep], scores[keep]
+        order = np.lexsort((candidates, -scores))[:k]
+        result[u] = [(int(candidates[j]), int(scores[j])) for j in order]
+    return result
+
+
+def two_hop(graph, user_ids, k):
+    """Top `k` (user id, score) suggestions for each of `user_ids`: the
+    users followed by the most of the users they follow, ties going to
+    the lower id. Uses SciPy's sparse matrix product when installed."""
+    if sparse is not None:
+        return _two_hop_scipy(graph, user_ids, k)
+    return _two_hop_python(graph, user_ids, k)
+
+
+def _affected_users(stale):
+    """Stale users and their followers, whose two-hop neighbourhood runs
+    through the stale users' follows."""
+    affected = set(stale)
+    for chunk in _chunks(stale, 500):
+        affected.update(row[0] for row in db.session.query(
+            followers.c.follower_id).filter(followers.c.followed_id.in_(chunk))
+            .distinct())
+    return sorted(affected)
+
+
+def _mark_stale(user_ids, stale):
+    for chunk in _chunks(user_ids, 500):
+        User.query.filter(User.id.in_(chunk)) \
+            .update({"suggestions_stale": stale}, synchronize_session=False)
+    db.session.commit()
+
+
+def refresh(full=False):
+    """Recompute the stored suggestions of every user marked stale, and of
+    their followers, or of every user with `full`. Returns the number of
+    users refreshed."""
+    active = db.session.query(User.id).filter(User.deleted_at.is_(None))
+    if full:
+        users = [row[0] for row in active.order_by(User.id)]
+        stale = users
+    else:
+        stale = [row[0] for row in active
+                 .filter(User.suggestions_stale.is_(True)).order_by(User.id)]
+    if not stale:
+        return 0
+    # Cleared before the graph is read, so a follow made while this runs
+    # marks its user stale again for the next refresh, and set again if
+    # the refresh fails.
+    _mark_stale(stale, False)
+    try:
+        if not full:
+            users = _affected_users(stale)
+        # Accounts waiting for deletion are never suggested.
+        graph = load_graph(exclude={row[0] for row in db.session.query(User.id)
+                                    .filter(User.deleted_at.isnot(None))})
+        k = current_app.config["SUGGESTIONS_PER_USER"]
+        for batch in _chunks(users, current_app.config["SUGGESTIONS_BATCH_SIZE"]):
+            suggestions = two_hop(graph, batch, k)
+            FollowSuggestion.query.filter(FollowSuggestion.user_id.in_(batch)) \
+                .delete(synchronize_session=False)
+            rows = [{"user_id": u, "suggested_id": v, "score": score}
+                    for u in batch for v, score in suggestions[u]]
+            if rows:
+                db.session.execute(FollowSuggestion.__table__.insert(), rows)
+            db.session.commit()
+    except Exception:
+        db.session.rollback()
+        _mark_stale(stale, True)
+        raise
+    return len(users)
@@ -1,6 +1,15 @@
 import requests
 from flask import current_app
 from flask_babel import _
+from guess_language import guess_language
+
+
+def detect_language(text):
+    """The language code of `text`, or '' if it can't be told."""
+    language = guess_language(text)
+    if language == 'UNKNOWN' or len(language) > 5:
+        return ''
+    return language
 
 
 def translate(text, source_language, dest_language):
@@ -0,0 +1,190 @@
+import signal
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+from flask import current_app
+
+from app.instrumentation import percentile
+from app.queues import get_queue
+
+
+def plan_workers(processes, weights, priorities):
+    """Assign each worker process an ordered list of priority classes.
+
+    RQ workers always drain their queues in order, so a worker listing
+    `high` first starves `bulk` whenever high jobs keep coming. Instead each
+    process leads with one class, handed out in proportion to `weights`
+    (largest remainder), then falls back to the others in priority order.
+    Every class with a weight gets at least one dedicated process when
+    there are enough processes to go round. With no weights at all every
+    class gets an equal share.
+    """
+    if any(weight < 0 for weight in weights.values()):
+        raise ValueError("Worker weights can't be negative")
+    weighted = [p for p in priorities if weights.get(p)]
+    if not weighted:
+        weighted, weights = list(priorities), dict.fromkeys(priorities, 1)
+    total = sum(weights[p] for p in weighted)
+    shares = {p: processes * weights[p] / total for p in weighted}
+    counts = {p: int(shares[p]) for p in weighted}
+    by_remainder = sorted(weighted, key=lambda p: shares[p] - counts[p],
+                          reverse=True)
+    for p in by_remainder[:processes - sum(counts.values())]:
+        counts[p] += 1
+    if processes >= len(weighted):
+        for p in weighted:
+            if not counts[p]:
+                counts[max(weighted, key=counts.get)] -= 1
+                counts[p] = 1
+    plan = []
+    for lead in weighted:
+        order = [lead] + [p for p in priorities if p != lead]
+        plan.extend([order] * counts[lead])
+    return plan
+
+
+def queue_metrics(sample=50):
+    """Depth, wait and failure counts for every configured queue.
+
+    `oldest_wait_s` is how long the job at the head of the queue has been
+    waiting; `wait_p50_s`/`wait_p95_s` are the enqueue-to-start delays of
+    the last `sample` finished jobs.
+    """
+    from rq.job import Job as RQJob
+    now = datetime.utcnow()
+    metrics = {}
+    for priority in current_app.config["RQ_QUEUES"]:
+        queue = get_queue(priority)
+        head = queue.get_job_ids(0, 1)
+        head_job = RQJob.fetch_many(head, connection=queue.connection)[0] \
+            if head else None
+        finished = RQJob.fetch_many(
+            queue.finished_job_registry.get_job_ids(-sample, -1),
+            connection=queue.connection)
+        waits = sorted((job.started_at - job.enqueued_at).total_seconds()
+                       for job in finished
+                       if job and job.started_at and job.enqueued_at)
+        metrics[priority] = {
+            "queue": queue.name,
+            "depth": queue.count,
+            "started": queue.started_job_registry.count,
+            "failed": queue.failed_job_registry.count,
+            "oldest_wait_s": round((now - head_job.enqueued_at).total_seconds(), 2)
+            if head_job and head_job.enqueued_at else 0.0,
+            "wait_p50_s": round(percentile(waits, 50), 2),
+            "wait_p95_s": round(percentile(waits, 95), 2),
+        }
+    return metrics
+
+
+class Supervisor(object):
+    """Runs a pool of `rq worker` processes and keeps it at full strength.
+
+    SIGTERM or SIGINT asks every worker for a warm shutdown, so jobs in
+    progress finish; workers still busy after `shutdown_timeout` seconds
+    are killed. Workers that exit on their own are restarted. One that
+    exits within `quick_exit` seconds of starting is restarted after a
+    delay that doubles each time, up to `max_restart_delay`, and is given
+    up on after `max_quick_exits` such exits in a row.
+    """
+
+    def __init__(self, plan, redis_url, queue_names, shutdown_timeout=60,
+                 metrics_interval=60, quick_exit=30, restart_delay=1,
+                 max_restart_delay=60, max_quick_exits=5, log=None):
+        self.plan = plan
+        self.redis_url = redis_url
+        self.queue_names = queue_names
+        self.shutdown_timeout = shutdown_timeout
+        self.metrics_interval = metrics_interval
+        self.quick_exit = quick_exit
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.max_quick_exits = max_quick_exits
+        self.log = log or (lambda message: None)
+        self.processes = [None] * len(plan)
+        self.started_at = [0.0] * len(plan)
+        self.quick_exits = [0] * len(plan)
+        self.restart_at = [None] * len(plan)
+        self.given_up = set()
+        self.stopping = False
+
+    def command(self, priorities):
+        return [sys.executable, "-m", "rq.cli", "worker", "-u", self.redis_url] + \
+            [self.queue_names[p] for p in priorities]
+
+    def spawn(self, index):
+        # In a new session, so a Ctrl-C in the terminal reaches only the
+        # supervisor, which then stops the workers one signal at a time.
+        self.processes[index] = subprocess.Popen(self.command(self.plan[index]),
+                                                 start_new_session=True)
+        self.started_at[index] = time.monotonic()
+        self.restart_at[index] = None
+        self.log(f"Started worker {index} (pid {self.processes[index].pid}) "
+                 f"on {', '.join(self.plan[index])}")
+
+    def stop(self, signum=None, frame=None):
+        self.stopping = True
+
+    def restart_exited(self, now):
+        """Restart, or schedule the restart of, every worker that exited."""
+        for index, process in enumerate(self.processes):
+            if index in self.given_up:
+                continue
+            if self.restart_at[index] is not None:
+                if now >= self.restart_at[index]:
+                    self.spawn(index)
+                continue
+            if process.poll() is None:
+                continue
+            if now - self.started_at[index] < self.quick_exit:
+                self.quick_exits[index] += 1
+            else:
+                self.quick_exits[index] = 0
+            if self.quick_exits[index] > self.max_quick_exits:
+                self.log(f"Worker {index} exited with {process.returncode} "
+                         f"{self.quick_exits[index]} times in a row, giving up")
+                self.given_up.add(index)
+                continue
+            delay = min(self.max_restart_delay,
+                        self.restart_delay * 2 ** (self.quick_exits[index] - 1)) \
+                if self.quick_exits[index] else 0
+            self.log(f"Worker {index} exited with {process.returncode}, "
+                     f"restarting in {delay}s")
+            self.restart_at[index] = now + delay
+            if not delay:
+                self.spawn(index)
+
+    def run(self, metrics=None):
+        """Supervise the workers until stopped. Returns False if it stopped
+        because every worker was given up on."""
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for index in range(len(self.plan)):
+            self.spawn(index)
+        next_metrics = time.monotonic() + self.metrics_interval
+        while not self.stopping:
+            self.restart_exited(time.monotonic())
+            if len(self.given_up) == len(self.plan):
+                self.log("Every worker keeps exiting, stopping")
+                break
+            if metrics and time.monotonic() >= next_metrics:
+                self.log(f"Queue metrics: {metrics()}")
+                next_metrics = time.monotonic() + self.metrics_interval
+            time.sleep(1)
+        self.shutdown()
+        return len(self.given_up) < len(self.plan)
+
+    def shutdown(self):
+        self.log("Stopping workers")
+        for process in self.processes:
+            if process.poll() is None:
+                process.send_signal(signal.SIGTERM)
+        deadline = time.monotonic() + self.shutdown_timeout
+        for process in self.processes:
+            try:
+                process.wait(max(0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
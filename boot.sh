@@ -10,4 +10,8 @@ while true; do
   sleep 5
 done
 flask translate compile
-exec gunicorn -b :5000 --access-logfile - --error-logfile - microblog:app
+# The default access log format plus the request time in microseconds,
+# which `flask logstats` reads.
+exec gunicorn -b :5000 --access-logfile - --error-logfile - \
+    --access-logformat '%(h)s %(l)s %(u)s %(t)s "%(r)s" %(s)s %(b)s "%(f)s" "%(a)s" %(D)s' \
+    microblog:app
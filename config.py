@@ -10,6 +10,35 @@ class Config(object):
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
         'sqlite:///' + os.path.join(basedir, 'app.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Comma separated read replica URLs. SELECTs made while serving GET
+    # requests are spread across them.
+    SQLALCHEMY_REPLICA_URIS = [
+        uri for uri in (os.environ.get('DATABASE_REPLICA_URLS') or '').split(',')
+        if uri]
+    REPLICA_STICKY_SECONDS = int(os.environ.get('REPLICA_STICKY_SECONDS') or 5)
+    # Connection pool for server databases; pre-ping and recycle drop
+    # connections the server or a proxy has closed.
+    DATABASE_POOL_SIZE = int(os.environ.get('DATABASE_POOL_SIZE') or 10)
+    DATABASE_MAX_OVERFLOW = int(os.environ.get('DATABASE_MAX_OVERFLOW') or 10)
+    DATABASE_POOL_RECYCLE = 1800
+    DATABASE_POOL_PRE_PING = True
+    # SQLite files: connections per process (0 for a new connection per
+    # use) and the PRAGMAs run on each new connection. WAL lets readers
+    # work alongside the one writer, and busy_timeout makes writers wait
+    # for the lock instead of failing with "database is locked".
+    SQLITE_POOL_SIZE = int(os.environ.get('SQLITE_POOL_SIZE') or 5)
+    SQLITE_PRAGMAS = {
+        "busy_timeout": 5000,
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -16000,
+        "mmap_size": 128 * 1024 * 1024,
+    }
+    # Reverse proxies in front of the app whose X-Forwarded-For and
+    # X-Forwarded-Proto headers are trusted, so request.remote_addr, and
+    # rate limits by address, see the client. 0 when serving directly.
+    TRUSTED_PROXIES = int(os.environ.get('TRUSTED_PROXIES') or 0)
+    LAST_SEEN_UPDATE_INTERVAL = 60
     MAIL_SERVER = os.environ.get('MAIL_SERVER')
     MAIL_PORT = int(os.environ.get('MAIL_PORT') or 25)
     MAIL_USE_TLS = os.environ.get('MAIL_USE_TLS') is not None
@@ -19,6 +48,146 @@ class Config(object):
     LANGUAGES = ['en', 'es']
     MS_TRANSLATOR_KEY = os.environ.get('MS_TRANSLATOR_KEY')
     TASKS_PER_PAGE = 25
+    API_MAX_PAGE_SIZE = 100
+    # Most users one request to /api/follows can follow or unfollow.
+    FOLLOW_MANY_MAX = 500
+    # Number of newest task ids kept in the shared Redis explore list, and
+    # how often that list is rebuilt from the database.
+    EXPLORE_CACHE_SIZE = 20 * TASKS_PER_PAGE
+    EXPLORE_CACHE_TTL = 3600
     ELASTICSEARCH_URL = os.environ.get("ELASTICSEARCH_URL")
+    ELASTICSEARCH_TIMEOUT = 5
+    ELASTICSEARCH_RETRY_INTERVAL = 30
     LOG_TO_STDOUT = os.environ.get("LOG_TO_STDOUT")
-    REDIS_URL = os.environ.get("REDIS_URL") or "redis://"
\ No newline at end of file
+    LOG_JSON = os.environ.get("LOG_JSON") is not None
+    LOG_REQUESTS = os.environ.get("LOG_REQUESTS") is not None
+    LOG_MAX_BYTES = int(os.environ.get("LOG_MAX_BYTES") or 10 * 1024 * 1024)
+    LOG_BACKUP_COUNT = 10
+    # Minimum seconds between error emails; errors in between are batched.
+    LOG_MAIL_INTERVAL = 300
+    REDIS_URL = os.environ.get("REDIS_URL") or "redis://"
+    # How long a user's "no background jobs" answer is cached in Redis.
+    JOB_STATUS_NEGATIVE_TTL = 300
+    # Limits on background jobs: unfinished jobs per user, and jobs of one
+    # type running at once across all users. Locks and slots expire after
+    # JOB_LOCK_TTL seconds in case a worker dies without releasing them.
+    JOB_MAX_PER_USER = 3
+    JOB_TYPE_LIMITS = {"export_tasks": 4, "import_tasks": 2,
+                       "broadcast_message": 4, "delete_account": 2}
+    JOB_LOCK_TTL = 3600
+    # RQ queue for each priority class, the default class of each job, and
+    # the share of worker processes that take each queue first.
+    RQ_QUEUES = {"high": "microtasks-high", "default": "microtasks",
+                 "bulk": "microtasks-bulk"}
+    JOB_PRIORITIES = {"export_tasks": "bulk", "import_tasks": "bulk",
+                      "broadcast_message": "bulk", "delete_account": "bulk"}
+    WORKER_WEIGHTS = {"high": 5, "default": 3, "bulk": 2}
+    WORKER_PROCESSES = int(os.environ.get("WORKER_PROCESSES") or 4)
+    WORKER_SHUTDOWN_TIMEOUT = 60
+    WORKER_METRICS_INTERVAL = 60
+    # Bulk task imports: rows per insert/index batch, language detection
+    # processes (0 to detect in-process), and where uploads wait for a
+    # worker. The folder must be shared between web and worker processes.
+    IMPORT_CHUNK_SIZE = 5000
+    IMPORT_PROCESSES = os.cpu_count() or 1
+    IMPORT_FOLDER = os.environ.get("IMPORT_FOLDER") or \
+        os.path.join(basedir, "imports")
+    IMPORT_MAX_BYTES = int(os.environ.get("IMPORT_MAX_BYTES") or 50 * 1024 * 1024)
+    # Tasks older than this, or done and older than ARCHIVE_DONE_AFTER_DAYS,
+    # are moved to the archive table by the archive_tasks maintenance job.
+    ARCHIVE_AFTER_DAYS = 365
+    ARCHIVE_DONE_AFTER_DAYS = 30
+    # Per-process LRU cache, kept fresh by invalidation messages published
+    # on CACHE_BUS_CHANNEL after every commit that changes cached data.
+    LOCAL_CACHE_ENABLED = os.environ.get("LOCAL_CACHE_ENABLED", "1") != "0"
+    LOCAL_CACHE_SIZE = 10000
+    LOCAL_CACHE_TTL = 300
+    CACHE_BUS_CHANNEL = "cache-invalidate"
+    # Followers messaged per transaction by a broadcast.
+    BROADCAST_CHUNK_SIZE = 500
+    # Account deletion removes rows this many at a time, one transaction
+    # per chunk, with a pause between chunks.
+    ACCOUNT_DELETE_CHUNK_SIZE = 1000
+    ACCOUNT_DELETE_PAUSE = 0.05
+    # Deletions still unfinished this long after they were asked for are
+    # queued again by the resume_deletions maintenance task.
+    ACCOUNT_DELETE_RETRY_AFTER = 3600
+    # "Who to follow": suggestions stored per user, how many pages show,
+    # and users recomputed per batch by the refresh_suggestions task.
+    SUGGESTIONS_PER_USER = 20
+    SUGGESTIONS_SHOWN = 5
+    SUGGESTIONS_BATCH_SIZE = 1000
+    NOTIFICATION_RETENTION_DAYS = 30
+    JOB_RETENTION_DAYS = 7
+    # `flask maintenance schedule` runs each task every so many seconds.
+    # Deletes and updates go in batches, with a pause between batches.
+    MAINTENANCE_SCHEDULE = {"sweep_notifications": 3600, "sweep_jobs": 3600,
+                            "archive_tasks": 3600, "refresh_suggestions": 600,
+                            "reconcile_counts": 6 * 3600,
+                            "resume_deletions": 3600,
+                            "analyze": 86400, "vacuum": 7 * 86400}
+    MAINTENANCE_BATCH_SIZE = 500
+    MAINTENANCE_BATCH_PAUSE = 0.1
+    MAINTENANCE_VACUUM_FREE_RATIO = 0.2
+    # Token buckets per endpoint: `limit` requests per `period` seconds for
+    # each user, or each client address when logged out or with `by_ip`.
+    # `methods` restricts a limit to, e.g., form submissions.
+    RATELIMIT_ENABLED = os.environ.get("RATELIMIT_ENABLED", "1") != "0"
+    # While Redis is down the buckets are kept in each process, and Redis is
+    # tried again after this many seconds.
+    RATELIMIT_REDIS_RETRY_INTERVAL = 30
+    RATE_LIMITS = {
+        "main.translate_text": {"limit": 30, "period": 60},
+        "main.search": {"limit": 30, "period": 60},
+        "main.send_message": {"limit": 10, "period": 60, "methods": ["POST"]},
+        "main.broadcast": {"limit": 5, "period": 3600, "methods": ["POST"]},
+        "main.delete_account": {"limit": 5, "period": 300, "methods": ["POST"]},
+        "main.export_tasks": {"limit": 5, "period": 3600},
+        "auth.login": {"limit": 10, "period": 300, "methods": ["POST"],
+                       "by_ip": True},
+        "auth.reset_password_request": {"limit": 3, "period": 3600,
+                                        "methods": ["POST"], "by_ip": True},
+        "api.search": {"limit": 30, "period": 60},
+        "api.follows": {"limit": 30, "period": 60},
+        "api.import_tasks": {"limit": 5, "period": 3600},
+        "api.get_token": {"limit": 10, "period": 300, "by_ip": True},
+    }
+    # Profile this fraction of requests and jobs with cProfile; requests
+    # carrying a token from `flask profile token` in PROFILE_HEADER are
+    # always profiled. Only the newest PROFILE_MAX_FILES profiles are kept.
+    PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE") or 0)
+    PROFILE_HEADER = "X-Profile"
+    PROFILE_TOKEN_MAX_AGE = 3600
+    PROFILE_DIR = os.environ.get("PROFILE_DIR") or \
+        os.path.join(basedir, "profiles")
+    PROFILE_MAX_FILES = 500
+    # Statements slower than SLOW_QUERY_MS (0 turns the log off) are
+    # appended to SLOW_QUERY_LOG as JSON lines with their query plan;
+    # `flask slowlog summary` ranks them.
+    SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS") or 0)
+    SLOW_QUERY_LOG = os.environ.get("SLOW_QUERY_LOG") or \
+        os.path.join(basedir, "logs", "slow_queries.jsonl")
+    # Responses of these types are compressed, with brotli when it is
+    # installed and the client takes it, otherwise gzip. Streamed responses
+    # always are, others from COMPRESS_MIN_SIZE bytes.
+    COMPRESS_ENABLED = os.environ.get("COMPRESS_ENABLED", "1") != "0"
+    COMPRESS_MIMETYPES = {
+        "text/html", "text/css", "text/plain", "text/csv", "text/xml",
+        "text/javascript", "application/javascript", "application/json",
+        "application/xml", "application/atom+xml", "application/rss+xml",
+        "image/svg+xml"}
+    COMPRESS_MIN_SIZE = 500
+    COMPRESS_GZIP_LEVEL = 6
+    COMPRESS_BROTLI_QUALITY = 4
+    # `flask assets build` writes fingerprinted, precompressed copies of the
+    # static files to this subfolder of app/static, and url_for('static')
+    # points at them.
+    ASSETS_DIR = "dist"
+    INSTRUMENT_REQUESTS = os.environ.get("INSTRUMENT_REQUESTS", "1") != "0"
+    ROUTE_STATS_WINDOW = 1000
+    ROUTE_STATS_LOG_EVERY = 500
+    # Maximum SQL queries per request, by endpoint. Exceeding a budget logs a
+    # warning, or raises QueryBudgetExceeded when RAISE_ON_QUERY_BUDGET is set.
+    QUERY_BUDGETS = {}
+    QUERY_BUDGET_DEFAULT = None
+    RAISE_ON_QUERY_BUDGET = False
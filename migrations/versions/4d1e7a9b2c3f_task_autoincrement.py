@@ -0,0 +1,43 @@
+"""task autoincrement
+
+Revision ID: 4d1e7a9b2c3f
+Revises: cb66814c9920
+Create Date: 2026-10-19 22:41:08.512337
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4d1e7a9b2c3f'
+down_revision = 'cb66814c9920'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Only SQLite reuses ids; the other databases take them from a sequence.
+    bind = op.get_bind()
+    if bind.dialect.name != 'sqlite':
+        return
+    with op.batch_alter_table('task', recreate='always',
+                              table_kwargs={'sqlite_autoincrement': True}):
+        pass
+    # Start after every id handed out so far, archived ones included.
+    last = bind.execute(sa.text(
+        'SELECT max(id) FROM (SELECT id FROM task UNION ALL '
+        'SELECT id FROM archived_task)')).scalar()
+    if last is not None:
+        bind.execute(sa.text("DELETE FROM sqlite_sequence WHERE name = 'task'"))
+        bind.execute(sa.text("INSERT INTO sqlite_sequence (name, seq) "
+                             "VALUES ('task', :last)"), last=last)
+
+
+def downgrade():
+    bind = op.get_bind()
+    if bind.dialect.name != 'sqlite':
+        return
+    with op.batch_alter_table('task', recreate='always',
+                              table_kwargs={'sqlite_autoincrement': False}):
+        pass
@@ -1,15 +1,50 @@
+import base64
+import gzip
+import io
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import time
 import unittest
+from unittest import mock
 
 from datetime import datetime, timedelta
 
-from app import create_app, db
-from app.models import User, Task
+from flask import session, url_for
+
+import redis
+from sqlalchemy.exc import OperationalError
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+from app import accounts, assets, bench, broadcast, cache, cli, create_app, db, feeds, importer, jobs, job_status, \
+    logstats, maintenance, profiling, ratelimit, slowlog, suggestions, workers
+from app.instrumentation import InstrumentedRedis, QueryBudgetExceeded, \
+    count_queries
+from app.log import JSONFormatter, RequestContextFilter, ThrottledSMTPHandler
+from app.models import User, Task, ArchivedTask, Job, Conversation, \
+    FollowSuggestion, Notification, followers, load_user
+from app.queues import DuplicateJob, JobLimitExceeded, get_queue, release_job
 from config import Config
 
 
 class TestConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = "sqlite://"
+    WTF_CSRF_ENABLED = False
+    RAISE_ON_QUERY_BUDGET = True
+
+
+def fake_redis():
+    """An in-memory Redis that still reports its calls to instrumentation."""
+    return InstrumentedRedis(connection_pool=redis.ConnectionPool(
+        connection_class=fakeredis.FakeConnection, server=fakeredis.FakeServer()))
 
 class UserModelCase(unittest.TestCase):
     def setUp(self):
@@ -62,6 +97,43 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(u1.followed.count(), 0)
         self.assertEqual(u2.followers.count(), 0)
 
+    def test_follow_many(self):
+        users = [User(username=f"user{i}", email=f"user{i}@example.com")
+                 for i in range(4)]
+        db.session.add_all(users)
+        db.session.commit()
+        john, ids = users[0], [u.id for u in users]
+        john.follow(users[1])
+        john.suggestions_stale = False
+        db.session.commit()
+
+        db.session.refresh(john)
+        with count_queries() as timings:
+            added = john.follow_many(ids + [999])
+        self.assertEqual(timings.queries, 3)
+        self.assertEqual(added, ids[2:])
+        self.assertEqual(db.session.info["cache_invalidations"]["follows"],
+                         set(ids[:1] + ids[2:]))
+        db.session.commit()
+        self.assertEqual(john.followed.count(), 3)
+        self.assertTrue(john.suggestions_stale)
+        self.assertEqual(john.follow_many(ids), [])
+
+        self.assertEqual(john.unfollow_many([ids[1], ids[2], 999]), ids[1:3])
+        db.session.commit()
+        self.assertEqual([u.id for u in john.followed], ids[3:])
+
+    def test_only_cached_kinds_are_invalidated(self):
+        u1 = User(username="john", email="john@example.com")
+        u2 = User(username="susan", email="susan@example.com")
+        db.session.add_all([u1, u2, Task(body="hi", author=u1)])
+        db.session.flush()
+        self.assertNotIn("cache_invalidations", db.session.info)
+        u1.follow(u2)
+        db.session.flush()
+        self.assertEqual(set(db.session.info["cache_invalidations"]), {"follows"})
+        db.session.commit()
+
     def test_own_tasks(self):
         u1 = User(username="Andrei", email="andrei@example.com")
         db.session.add(u1)
@@ -116,5 +188,1439 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f4, [t4])
 
 
+class APICase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def get_token(self, username, password):
+        credentials = base64.b64encode(f"{username}:{password}".encode()).decode()
+        response = self.client.post("/api/tokens", headers={
+            "Authorization": f"Basic {credentials}"})
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.data)["token"]
+
+    def test_token_required(self):
+        self.assertEqual(self.client.get("/api/feed").status_code, 401)
+        self.assertEqual(self.client.get("/api/feed", headers={
+            "Authorization": "Bearer nope"}).status_code, 401)
+
+    def test_feed_cursor_pagination(self):
+        u1 = User(username="john", email="john@example.com")
+        u1.set_password("cat")
+        u2 = User(username="susan", email="susan@example.com")
+        db.session.add_all([u1, u2])
+        now = datetime.utcnow()
+        db.session.add_all([
+            Task(body=f"task-{i}", author=u1 if i % 2 else u2,
+                 timestamp=now + timedelta(seconds=i))
+            for i in range(5)
+        ])
+        u1.follow(u2)
+        db.session.commit()
+        headers = {"Authorization": f"Bearer {self.get_token('john', 'cat')}"}
+
+        seen = []
+        url = "/api/feed?limit=2&fields=body,author"
+        while url:
+            payload = json.loads(self.client.get(url, headers=headers).data)
+            self.assertLessEqual(len(payload["items"]), 2)
+            seen.extend(payload["items"])
+            url = payload["next_cursor"] and \
+                f"/api/feed?limit=2&fields=body,author&cursor={payload['next_cursor']}"
+        self.assertEqual([t["body"] for t in seen],
+                         [f"task-{i}" for i in range(4, -1, -1)])
+        self.assertEqual(seen[0], {"body": "task-4", "author": "susan"})
+
+    def test_unknown_field(self):
+        u = User(username="john", email="john@example.com")
+        u.set_password("cat")
+        db.session.add(u)
+        db.session.commit()
+        headers = {"Authorization": f"Bearer {self.get_token('john', 'cat')}"}
+        response = self.client.get("/api/explore?fields=password_hash",
+                                   headers=headers)
+        self.assertEqual(response.status_code, 400)
+
+    def test_empty_fields_use_default(self):
+        u = User(username="john", email="john@example.com")
+        u.set_password("cat")
+        db.session.add_all([u, Task(body="hello", author=u)])
+        db.session.commit()
+        headers = {"Authorization": f"Bearer {self.get_token('john', 'cat')}"}
+        response = self.client.get("/api/feed?fields=,", headers=headers)
+        self.assertEqual(response.status_code, 200)
+        item = json.loads(response.data)["items"][0]
+        self.assertEqual(set(item), {"id", "body", "done", "timestamp",
+                                     "language", "user_id", "author"})
+
+
+class InstrumentationCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+        u = User(username="john", email="john@example.com")
+        u.set_password("cat")
+        db.session.add(u)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def login(self):
+        self.client.post("/auth/login", data={"username": "john",
+                                              "password": "cat"})
+
+    def test_count_queries(self):
+        u = User.query.filter_by(username="john").first()
+        with count_queries() as timings:
+            u.followed_tasks().all()
+        self.assertEqual(timings.queries, 1)
+
+    def test_failed_statements_leave_no_timing_state(self):
+        with count_queries() as timings:
+            with self.assertRaises(OperationalError):
+                db.session.execute("SELECT * FROM nowhere")
+            db.session.rollback()
+            User.query.all()
+        self.assertEqual(timings.queries, 1)
+        self.assertNotIn("query_start_time", db.session.connection().info)
+
+    def test_server_timing_header(self):
+        self.login()
+        response = self.client.get("/user/john")
+        self.assertEqual(response.status_code, 200)
+        header = response.headers["Server-Timing"]
+        self.assertIn("db;desc=", header)
+        self.assertIn("tpl;desc=\"1 renders\"", header)
+
+    def test_query_budget(self):
+        self.login()
+        self.app.config["QUERY_BUDGETS"] = {"main.user": 1}
+        with self.assertRaises(QueryBudgetExceeded):
+            self.client.get("/user/john")
+
+
+class BenchCase(unittest.TestCase):
+    def setUp(self):
+        # The benchmark drives the app from several threads, which an
+        # in-memory SQLite database cannot be shared between.
+        self.db_fd, self.db_path = tempfile.mkstemp(suffix=".db")
+
+        class BenchConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = "sqlite:///" + self.db_path
+            RAISE_ON_QUERY_BUDGET = False
+
+        self.app = create_app(BenchConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        # Closing the pooled connections removes the WAL files.
+        db.engine.dispose()
+        self.app_context.pop()
+        os.close(self.db_fd)
+        os.unlink(self.db_path)
+
+    def test_seed(self):
+        counts = bench.seed(users=50, tasks_per_user=3, messages=20)
+        self.assertEqual(User.query.count(), 50)
+        self.assertEqual(Task.query.count(), 150)
+        self.assertEqual(counts["messages"], 20)
+        self.assertGreater(counts["follows"], 0)
+
+    def test_run(self):
+        bench.seed(users=10, tasks_per_user=2, messages=5)
+        report = bench.run(routes=["index", "explore", "send_message"],
+                           requests_per_route=4, concurrency=2)
+        self.assertEqual(report["total"]["count"], 12)
+        self.assertEqual(report["total"]["errors"], 0)
+        self.assertEqual(set(report["routes"]), {"index", "explore", "send_message"})
+
+    def test_run_is_not_rate_limited(self):
+        bench.seed(users=10, tasks_per_user=2, messages=5)
+        self.app.config["RATE_LIMITS"] = {"main.send_message": {"limit": 1, "period": 60}}
+        report = bench.run(routes=["send_message"], requests_per_route=4,
+                           concurrency=2)
+        self.assertEqual(report["total"]["count"], 4)
+        self.assertEqual(report["total"]["errors"], 0)
+        self.assertEqual(report["total"]["rate_limited"], 0)
+        self.assertTrue(self.app.config["RATELIMIT_ENABLED"])
+
+    def test_summarize_reports_rate_limits_apart(self):
+        summary = bench._summarize([("index", 0.01, 200), ("index", 0.0001, 429)], 1)
+        self.assertEqual(summary["count"], 1)
+        self.assertEqual(summary["errors"], 0)
+        self.assertEqual(summary["rate_limited"], 1)
+
+    def test_sqlite_pragmas_and_pool(self):
+        with db.engine.connect() as conn:
+            self.assertEqual(conn.execute("PRAGMA journal_mode").scalar(), "wal")
+            self.assertEqual(conn.execute("PRAGMA busy_timeout").scalar(), 5000)
+        self.assertEqual(db.engine.pool.size(), self.app.config["SQLITE_POOL_SIZE"])
+
+    def test_contention(self):
+        bench.seed(users=5, tasks_per_user=2, messages=0)
+        report = bench.contention(writers=1, readers=1, duration=0.2)
+        self.assertGreater(report["write"]["count"], 0)
+        self.assertEqual(report["write"]["errors"], 0)
+        self.assertGreater(report["read"]["count"], 0)
+
+
+class ReplicaRoutingCase(unittest.TestCase):
+    def setUp(self):
+        self.db_files = [tempfile.mkstemp(suffix=".db") for _ in range(2)]
+        primary, replica = (path for _, path in self.db_files)
+
+        class ReplicaConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = "sqlite:///" + primary
+            SQLALCHEMY_REPLICA_URIS = ["sqlite:///" + replica]
+
+        self.app = create_app(ReplicaConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        replica_engine = db.get_engine(self.app, bind="replica_0")
+        db.Model.metadata.create_all(replica_engine)
+        # Give each database a different user so reads reveal their source.
+        db.session.add(User(username="primary", email="primary@example.com"))
+        db.session.commit()
+        replica_engine.execute(User.__table__.insert(),
+                               username="replica", email="replica@example.com")
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        db.engine.dispose()
+        db.get_engine(self.app, bind="replica_0").dispose()
+        self.app_context.pop()
+        for fd, path in self.db_files:
+            os.close(fd)
+            os.unlink(path)
+
+    def read_username(self, method="GET"):
+        db.session.remove()
+        with self.app.test_request_context("/", method=method):
+            return User.query.first().username
+
+    def test_get_reads_from_replica(self):
+        self.assertEqual(self.read_username("GET"), "replica")
+
+    def test_writes_pin_to_primary(self):
+        self.assertEqual(self.read_username("POST"), "primary")
+        db.session.remove()
+        with self.app.test_request_context("/", method="GET"):
+            db.session.add(User(username="new", email="new@example.com"))
+            db.session.flush()
+            self.assertEqual(User.query.filter_by(username="new").count(), 1)
+
+    def test_sticky_after_write(self):
+        db.session.remove()
+        with self.app.test_request_context("/", method="POST"):
+            db.session.add(User(username="new", email="new@example.com"))
+            db.session.commit()
+            sticky_until = session["primary_until"]
+        db.session.remove()
+        with self.app.test_request_context("/", method="GET"):
+            session["primary_until"] = sticky_until
+            self.assertEqual(User.query.first().username, "primary")
+
+    def test_primary_block(self):
+        db.session.remove()
+        with self.app.test_request_context("/", method="GET"):
+            with db.session().primary():
+                self.assertEqual(User.query.first().username, "primary")
+            self.assertEqual(User.query.first().username, "replica")
+
+    def test_cache_loads_from_primary(self):
+        local = mock.Mock(**{"get.side_effect": lambda kind, key, load: load()})
+        self.app.extensions["local_cache"] = local
+        db.session.remove()
+        with self.app.test_request_context("/", method="GET"):
+            self.assertEqual(cache.cached(
+                "user", 1, lambda: User.query.first().username), "primary")
+
+
+class SearchUnavailableCase(unittest.TestCase):
+    def setUp(self):
+        class UnreachableSearchConfig(TestConfig):
+            ELASTICSEARCH_URL = "http://127.0.0.1:1"
+            ELASTICSEARCH_TIMEOUT = 0.1
+
+        self.app = create_app(UnreachableSearchConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_search_fails_soft(self):
+        u = User(username="john", email="john@example.com")
+        db.session.add_all([u, Task(body="buy milk", author=u)])
+        db.session.commit()
+        connection = self.app.extensions["elasticsearch"]
+        self.assertGreater(connection.down_until, 0)
+        tasks, total = Task.search("milk", 1, 10)
+        self.assertEqual(total, 0)
+
+
+class LoggingCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+
+    def make_record(self, msg, lineno=1):
+        return logging.LogRecord("app", logging.ERROR, "app/x.py", lineno,
+                                 msg, None, None)
+
+    def test_json_record_has_request_fields(self):
+        record = self.make_record("boom")
+        with self.app.test_request_context("/explore", headers={
+                "X-Request-ID": "abc"}):
+            self.app.preprocess_request()
+            RequestContextFilter().filter(record)
+        payload = json.loads(JSONFormatter().format(record))
+        self.assertEqual(payload["message"], "boom")
+        self.assertEqual(payload["request_id"], "abc")
+        self.assertEqual(payload["path"], "/explore")
+        self.assertIn("elapsed_ms", payload)
+
+    def test_error_emails_are_throttled(self):
+        sent = []
+
+        class Handler(ThrottledSMTPHandler):
+            def deliver(self, subject, body):
+                sent.append((subject, body))
+
+        handler = Handler(("localhost", 25), "from@example.com",
+                          ["to@example.com"], "Failure", interval=3600)
+        handler.handle(self.make_record("first"))
+        for _ in range(3):
+            handler.handle(self.make_record("again", lineno=2))
+        self.assertEqual(len(sent), 1)
+        handler.close()
+        self.assertEqual(len(sent), 2)
+        self.assertEqual(sent[1][0], "Failure (3 errors)")
+        self.assertIn("[3 times]", sent[1][1])
+
+
+@unittest.skipIf(fakeredis is None, "fakeredis is not installed")
+class ExploreFeedCase(unittest.TestCase):
+    def setUp(self):
+        class ExploreConfig(TestConfig):
+            TASKS_PER_PAGE = 2
+            EXPLORE_CACHE_SIZE = 4
+
+        self.app = create_app(ExploreConfig)
+        self.app.redis = fake_redis()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.user = User(username="john", email="john@example.com")
+        now = datetime.utcnow()
+        db.session.add_all([Task(body=f"task-{i}", author=self.user,
+                                 timestamp=now + timedelta(seconds=i))
+                            for i in range(5)])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def bodies(self, page):
+        tasks, has_next = feeds.explore_page(page, 2)
+        return [t.body for t in tasks], has_next
+
+    def test_pages_from_cache_and_db(self):
+        self.assertEqual(self.bodies(1), (["task-4", "task-3"], True))
+        self.assertEqual(self.app.redis.llen(feeds.EXPLORE_KEY), 4)
+        with count_queries() as timings:
+            self.assertEqual(self.bodies(2), (["task-2", "task-1"], True))
+        self.assertEqual(timings.queries, 1)
+        # Beyond the cached ids the page comes from the database.
+        self.assertEqual(self.bodies(3), (["task-0"], False))
+
+    def test_new_tasks_are_pushed(self):
+        self.bodies(1)
+        db.session.add(Task(body="newest", author=self.user,
+                            timestamp=datetime.utcnow() + timedelta(hours=1)))
+        db.session.commit()
+        self.assertEqual(self.bodies(1)[0], ["newest", "task-4"])
+        self.assertEqual(self.app.redis.llen(feeds.EXPLORE_KEY), 4)
+
+    def test_task_committed_during_rebuild_is_kept(self):
+        newest_ids = feeds._newest_ids
+        committed = []
+
+        def stale_ids():
+            # A task committed after the rebuild read the DB.
+            ids = newest_ids()
+            if not committed:
+                db.session.add(Task(body="newest", author=self.user,
+                                    timestamp=datetime.utcnow() + timedelta(hours=1)))
+                db.session.commit()
+                committed.append(True)
+            return ids
+
+        with mock.patch.object(feeds, "_newest_ids", stale_ids):
+            self.assertEqual(self.bodies(1)[0], ["newest", "task-4"])
+        self.assertEqual(self.app.redis.llen(feeds.EXPLORE_KEY), 4)
+        self.assertEqual(self.app.redis.keys(f"{feeds.EXPLORE_KEY}:*"), [])
+
+    def test_pages_below_one_show_the_first(self):
+        self.app.config["RATELIMIT_ENABLED"] = False
+        self.user.set_password("cat")
+        db.session.commit()
+        client = self.app.test_client()
+        client.post("/auth/login", data={"username": "john", "password": "cat"})
+        for url in ("/index", "/explore", "/user/john"):
+            for page in (0, -3):
+                response = client.get(f"{url}?page={page}")
+                self.assertEqual(response.status_code, 200)
+                self.assertIn(b"task-4", response.data)
+
+
+@unittest.skipIf(fakeredis is None, "fakeredis is not installed")
+class JobStatusCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.redis = fake_redis()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.user = User(username="john", email="john@example.com")
+        db.session.add(self.user)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def jobs(self):
+        self.user.id  # Load the user before counting.
+        # A fresh app context gives a fresh `g`, like a new request would.
+        with self.app.app_context(), self.app.test_request_context():
+            with count_queries() as timings:
+                jobs = job_status.jobs_in_progress(self.user)
+            return jobs, timings
+
+    def test_no_jobs_is_cached(self):
+        jobs, timings = self.jobs()
+        self.assertEqual((jobs, timings.queries), ([], 1))
+        jobs, timings = self.jobs()
+        self.assertEqual((jobs, timings.queries, timings.counts["redis"]),
+                         ([], 0, 1))
+
+    def test_progress_is_fetched_in_one_call(self):
+        self.jobs()
+        job = self.user.launch_job("export_tasks", "Exporting tasks...")
+        db.session.commit()
+        rq_job = job.get_rq_job()
+        rq_job.meta["progress"] = 40
+        rq_job.save_meta()
+        db.session.add(Job(id="gone", name="other", user=self.user))
+        db.session.commit()
+        jobs, timings = self.jobs()
+        self.assertEqual([(j.name, p) for j, p in jobs],
+                         [("export_tasks", 40), ("other", 100)])
+        self.assertEqual(timings.counts["redis"], 2)
+
+
+@unittest.skipIf(fakeredis is None, "fakeredis is not installed")
+class JobLaunchCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.redis = fake_redis()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.user = User(username="john", email="john@example.com")
+        db.session.add(self.user)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def launch(self, **kwargs):
+        job = self.user.launch_job("export_tasks", "Exporting tasks...", **kwargs)
+        db.session.commit()
+        return job
+
+    def test_duplicate_job_is_rejected(self):
+        job = self.launch(dedupe_key="export")
+        with self.assertRaises(DuplicateJob):
+            self.launch(dedupe_key="export")
+        release_job(job.id, job.get_rq_job().meta)
+        self.launch(dedupe_key="export")
+
+    def test_per_user_limit(self):
+        self.app.config["JOB_MAX_PER_USER"] = 2
+        self.launch()
+        self.launch()
+        with self.assertRaises(JobLimitExceeded):
+            self.launch()
+
+    def test_job_type_limit(self):
+        self.app.config["JOB_TYPE_LIMITS"] = {"export_tasks": 1}
+        self.launch()
+        with self.assertRaises(JobLimitExceeded):
+            self.launch()
+        self.assertEqual(self.app.redis.zcard("job-slots:export_tasks"), 1)
+
+    def test_leaked_slots_expire(self):
+        self.app.config["JOB_TYPE_LIMITS"] = {"export_tasks": 1}
+        self.app.config["JOB_LOCK_TTL"] = 60
+        self.launch()
+        # Later attempts don't keep the leaked slot alive.
+        with mock.patch("app.queues.time.time", return_value=time.time() + 30):
+            with self.assertRaises(JobLimitExceeded):
+                self.launch()
+        with mock.patch("app.queues.time.time", return_value=time.time() + 61):
+            self.launch()
+
+    def test_jobs_go_to_their_priority_queue(self):
+        self.app.config["JOB_PRIORITIES"] = {"export_tasks": "bulk"}
+        self.launch()
+        self.launch(priority="high")
+        self.assertEqual(get_queue("bulk").count, 1)
+        self.assertEqual(get_queue("high").count, 1)
+        metrics = workers.queue_metrics()
+        self.assertEqual(metrics["bulk"]["depth"], 1)
+        self.assertEqual(metrics["default"]["depth"], 0)
+        with self.assertRaises(ValueError):
+            self.launch(priority="urgent")
+
+    def test_worker_plan_follows_weights(self):
+        plan = workers.plan_workers(10, {"high": 5, "default": 3, "bulk": 2},
+                                    ["high", "default", "bulk"])
+        self.assertEqual([p[0] for p in plan].count("high"), 5)
+        self.assertEqual(plan[-1], ["bulk", "high", "default"])
+        plan = workers.plan_workers(3, {"high": 10, "default": 1, "bulk": 1},
+                                    ["high", "default", "bulk"])
+        self.assertEqual([p[0] for p in plan], ["high", "default", "bulk"])
+        plan = workers.plan_workers(3, {"high": 0, "default": 0},
+                                    ["high", "default", "bulk"])
+        self.assertEqual([p[0] for p in plan], ["high", "default", "bulk"])
+        with self.assertRaises(ValueError):
+            workers.plan_workers(3, {"high": 1, "bulk": -1}, ["high", "bulk"])
+
+    def test_supervisor_backs_off_from_crashing_workers(self):
+        supervisor = workers.Supervisor([["default"]], "redis://", {},
+                                        quick_exit=30, restart_delay=1,
+                                        max_quick_exits=3)
+        crashed = mock.Mock(returncode=1, **{"poll.return_value": 1})
+        spawns = []
+
+        def spawn(index):
+            spawns.append(now)
+            supervisor.processes[index] = crashed
+            supervisor.started_at[index] = now
+            supervisor.restart_at[index] = None
+
+        supervisor.spawn = spawn
+        supervisor.processes[0] = crashed
+        for now in range(0, 20):
+            supervisor.restart_exited(now)
+        # Restarted 1, 2 and 4 seconds after each exit is seen, then given
+        # up on.
+        self.assertEqual(spawns, [1, 4, 9])
+        self.assertEqual(supervisor.given_up, {0})
+
+
+@unittest.skipIf(fakeredis is None, "fakeredis is not installed")
+class MaintenanceCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.redis = fake_redis()
+        self.app.config["MAINTENANCE_BATCH_SIZE"] = 2
+        self.app.config["MAINTENANCE_BATCH_PAUSE"] = 0
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.user = User(username="john", email="john@example.com")
+        db.session.add(self.user)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_sweeps_delete_old_rows_in_batches(self):
+        old = time.time() - 40 * 86400
+        for i in range(5):
+            db.session.add(Notification(name="task_progress", user=self.user,
+                                        timestamp=old, payload_json="{}"))
+        db.session.add(Notification(name="unread_message_count", user=self.user,
+                                    timestamp=old, payload_json="0"))
+        db.session.add(Notification(name="task_progress", user=self.user,
+                                    payload_json="{}"))
+        db.session.add(Job(id="old", name="export_tasks", user=self.user,
+                           complete=True,
+                           timestamp=datetime.utcnow() - timedelta(days=30)))
+        db.session.add(Job(id="running", name="export_tasks", user=self.user,
+                           timestamp=datetime.utcnow() - timedelta(days=30)))
+        db.session.commit()
+        self.assertEqual(maintenance.sweep_notifications(), 5)
+        self.assertEqual(Notification.query.count(), 2)
+        self.assertEqual(maintenance.sweep_jobs(), 1)
+        self.assertEqual([j.id for j in Job.query], ["running"])
+
+    def test_reconcile_counts(self):
+        susan = User(username="susan", email="susan@example.com")
+        db.session.add(susan)
+        db.session.commit()
+        susan.send_message(self.user, "hi")
+        self.user.add_notification("unread_message_count", 5)
+        db.session.add(Job(id="lost", name="export_tasks", user=self.user))
+        db.session.commit()
+        # Launched, but the request that launched it hasn't committed yet.
+        get_queue().enqueue("app.jobs.export_tasks", self.user.id, job_id="pending")
+        self.app.redis.zadd("job-slots:export_tasks",
+                            {"lost": time.time() + 60, "gone": time.time() + 60,
+                             "pending": time.time() + 60})
+        result = maintenance.reconcile_counts()
+        self.assertEqual(result, {"unread_counts": 1, "jobs_closed": 1})
+        self.assertEqual(self.user.notifications.first().get_data(), 1)
+        self.assertTrue(Job.query.get("lost").complete)
+        self.assertEqual(self.app.redis.zrange("job-slots:export_tasks", 0, -1),
+                         [b"pending"])
+
+    def test_schedule_runs_each_task_once_per_interval(self):
+        self.app.config["MAINTENANCE_SCHEDULE"] = {"analyze": 3600, "vacuum": 3600}
+        maintenance.schedule(once=True)
+        self.assertIsNotNone(self.app.redis.get("maintenance:analyze"))
+        self.assertFalse(maintenance._claim("vacuum", 3600, {}))
+
+@unittest.skipIf(fakeredis is None, "fakeredis is not installed")
+class RateLimitCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        # fakeredis can't run Lua, so these tests cover the in-process
+        # buckets used while Redis is unreachable.
+        self.app.redis = fake_redis()
+        self.app.redis.connection_pool.connection_kwargs["server"].connected = False
+        self.app.config["RATE_LIMITS"] = {
+            "auth.login": {"limit": 2, "period": 60, "methods": ["POST"]},
+            "api.get_token": {"limit": 1, "period": 60},
+        }
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_limit_returns_429_with_retry_after(self):
+        data = {"username": "john", "password": "cat"}
+        for _ in range(2):
+            self.assertEqual(self.client.post("/auth/login", data=data).status_code, 302)
+        response = self.client.post("/auth/login", data=data)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers["Retry-After"], "30")
+        self.assertEqual(self.client.get("/auth/login").status_code, 200)
+
+    def test_redis_is_retried_after_an_interval(self):
+        data = {"username": "john", "password": "cat"}
+        with self.assertLogs(self.app.logger, "WARNING") as logs:
+            self.client.post("/auth/login", data=data)
+            self.client.post("/auth/login", data=data)
+        self.assertEqual(len([r for r in logs.output if "in-process" in r]), 1)
+
+    def test_limits_by_address_behind_a_proxy(self):
+        class ProxyConfig(TestConfig):
+            TRUSTED_PROXIES = 1
+
+        app = create_app(ProxyConfig)
+        app.redis = self.app.redis
+        app.config["RATE_LIMITS"] = self.app.config["RATE_LIMITS"]
+        with app.app_context():
+            db.create_all()
+        client = app.test_client()
+        data = {"username": "john", "password": "cat"}
+        for address in ("10.0.0.1", "10.0.0.1", "10.0.0.2"):
+            response = client.post("/auth/login", data=data,
+                                   headers={"X-Forwarded-For": address})
+            self.assertEqual(response.status_code, 302)
+        response = client.post("/auth/login", data=data,
+                               headers={"X-Forwarded-For": "10.0.0.1"})
+        self.assertEqual(response.status_code, 429)
+
+    def test_api_gets_json_error(self):
+        self.client.post("/api/tokens")
+        response = self.client.post("/api/tokens")
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(json.loads(response.data)["error"], "Too Many Requests")
+
+    def test_api_limits_count_per_token_user(self):
+        self.app.config["RATE_LIMITS"] = {"api.search": {"limit": 1, "period": 60}}
+        users = [User(username=name, email=f"{name}@example.com")
+                 for name in ("john", "susan")]
+        db.session.add_all(users)
+        tokens = [user.get_token() for user in users]
+        db.session.commit()
+
+        def search(token):
+            return self.client.get("/api/search?q=milk", headers={
+                "Authorization": f"Bearer {token}"}).status_code
+
+        self.assertEqual(search(tokens[0]), 200)
+        self.assertEqual(search(tokens[0]), 429)
+        # Same address, different user.
+        self.assertEqual(search(tokens[1]), 200)
+
+    def test_local_bucket_refills(self):
+        buckets = ratelimit.LocalBuckets()
+        self.assertEqual(buckets.take("k", 1, 0.5, now=100), 0)
+        self.assertEqual(buckets.take("k", 1, 0.5, now=101), 1.0)
+        self.assertEqual(buckets.take("k", 1, 0.5, now=102), 0)
+
+class SlowQueryCase(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+        class SlowConfig(TestConfig):
+            SLOW_QUERY_MS = 1e-6
+            SLOW_QUERY_LOG = os.path.join(self.folder, "slow.jsonl")
+
+        self.app = create_app(SlowConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        for handler in self.app.extensions["slow_query_listener"].handlers:
+            handler.close()
+        shutil.rmtree(self.folder)
+
+    def test_normalize(self):
+        self.assertEqual(
+            slowlog.normalize("SELECT *  FROM task\nWHERE id IN (?, ?, ?) "
+                              "AND body = 'it''s' AND done = 1"),
+            "SELECT * FROM task WHERE id IN (...) AND body = ? AND done = ?")
+
+    def test_logs_plan_and_summarizes(self):
+        User.query.filter(User.id.in_([1, 2])).all()
+        User.query.filter(User.id.in_([3, 4, 5])).all()
+        # Written by the listener thread.
+        self.app.extensions["slow_query_listener"].queue.join()
+        with open(self.app.config["SLOW_QUERY_LOG"]) as f:
+            lines = f.readlines()
+        entry = json.loads(lines[-1])
+        self.assertEqual(entry["source"], "<cli>")
+        self.assertIn("USING INTEGER PRIMARY KEY", entry["plan"])
+        summary = slowlog.summarize(lines)
+        selects = [s for s in summary if s["statement"].startswith("SELECT user")]
+        self.assertEqual(len(selects), 1)
+        self.assertEqual(selects[0]["count"], 2)
+
+    def test_summary_reads_rotated_logs(self):
+        path = self.app.config["SLOW_QUERY_LOG"]
+        entry = {"normalized": "SELECT 1", "elapsed_ms": 5.0, "source": "<cli>"}
+        for suffix in ("", ".1"):
+            with open(path + suffix, "w") as f:
+                f.write(json.dumps(entry) + "\n")
+        cli.register(self.app)
+        result = self.app.test_cli_runner().invoke(args=["slowlog", "summary"])
+        self.assertEqual(json.loads(result.output)[0]["count"], 2)
+
+
+class BroadcastCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.john = User(username="john", email="john@example.com")
+        self.followers = [User(username=f"fan{i}", email=f"fan{i}@example.com")
+                          for i in range(5)]
+        db.session.add_all([self.john] + self.followers)
+        db.session.commit()
+        for fan in self.followers:
+            fan.follow(self.john)
+        # An existing thread, which the broadcast must reuse.
+        self.followers[0].send_message(self.john, "hello")
+        self.john.send_message(self.followers[0], "hi there")
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_broadcast_in_chunks(self):
+        progress = []
+        with count_queries() as timings:
+            sent = broadcast.broadcast(self.john, "news", chunk_size=2,
+                                       progress=lambda *p: progress.append(p))
+        self.assertEqual(sent, 5)
+        self.assertEqual(progress, [(2, 5), (4, 5), (5, 5)])
+        # A fixed number of statements per chunk, whatever its size.
+        self.assertLess(timings.queries, 40)
+        self.assertEqual(Conversation.query.count(), 5)
+        for fan in self.followers:
+            conversation = Conversation.between(self.john, fan)
+            self.assertEqual(conversation.last_message.body, "news")
+            self.assertEqual(
+                fan.notifications.filter_by(name="unread_message_count")
+                .one().get_data(), fan.new_messages())
+        self.assertEqual(self.followers[0].new_messages(), 2)
+        self.assertEqual(self.followers[1].new_messages(), 1)
+        self.assertEqual(self.john.new_messages(), 1)
+
+    def test_broadcast_skips_deleted_followers(self):
+        self.followers[4].deleted_at = datetime.utcnow()
+        db.session.commit()
+        progress = []
+        sent = broadcast.broadcast(self.john, "news", chunk_size=2,
+                                   progress=lambda *p: progress.append(p))
+        self.assertEqual(sent, 4)
+        self.assertEqual(progress, [(2, 4), (4, 4)])
+        self.assertIsNone(Conversation.between(self.john, self.followers[4]))
+        self.assertEqual(self.followers[4].notifications.count(), 0)
+
+
+class AccountDeletionCase(unittest.TestCase):
+    def setUp(self):
+        class DeleteConfig(TestConfig):
+            ACCOUNT_DELETE_CHUNK_SIZE = 2
+            ACCOUNT_DELETE_PAUSE = 0
+
+        self.app = create_app(DeleteConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.john = User(username="john", email="john@example.com")
+        self.mary = User(username="mary", email="mary@example.com")
+        self.susan = User(username="susan", email="susan@example.com")
+        db.session.add_all([self.john, self.mary, self.susan])
+        db.session.commit()
+        self.john.follow(self.mary)
+        self.mary.follow(self.john)
+        db.session.add_all([Task(body=f"task {i}", author=self.john)
+                            for i in range(5)])
+        db.session.add(ArchivedTask(id=100, body="old", author=self.john))
+        db.session.add(FollowSuggestion(user_id=self.susan.id,
+                                        suggested_id=self.john.id, score=1))
+        self.john.send_message(self.mary, "hello")
+        self.john.send_message(self.susan, "hi")
+        self.susan.send_message(self.mary, "hey")
+        self.john.add_notification("unread_message_count", 0)
+        self.mary.add_notification("unread_message_count", 2)
+        db.session.commit()
+        self.mary.suggestions_stale = False
+        self.john.deleted_at = datetime.utcnow()
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_deletes_in_chunks(self):
+        self.assertIsNone(load_user(str(self.john.id)))
+        john_id = self.john.id
+        progress = []
+        with mock.patch("app.accounts.remove_many_from_index") as unindex:
+            counts = accounts.delete_account(
+                self.john, progress=lambda *p: progress.append(p))
+        self.assertEqual(counts, {"tasks": 5, "archived_tasks": 1, "messages": 2,
+                                  "conversations": 2, "suggestions": 1,
+                                  "followers": 1, "followed": 1})
+        self.assertEqual(progress[-1], (13, 13))
+        self.assertEqual(len(progress), 9)
+        self.assertEqual(sorted(i for call in unindex.call_args_list
+                                for i in call[0][1]), [1, 2, 3, 4, 5, 100])
+
+        self.assertEqual([u.username for u in User.query], ["mary", "susan"])
+        for model in (Task, ArchivedTask, FollowSuggestion, Notification):
+            self.assertEqual(model.query.filter_by(user_id=john_id).count(), 0)
+        self.assertEqual(Conversation.query.count(), 1)
+        self.assertEqual(self.mary.followers.count(), 0)
+        self.assertTrue(self.mary.suggestions_stale)
+        # The thread with john no longer counts towards mary's badge.
+        self.assertEqual(self.mary.notifications.filter_by(
+            name="unread_message_count").one().get_data(), 1)
+
+    def test_deleted_accounts_are_not_suggested(self):
+        self.assertEqual(self.susan.follow_suggestions(5), [])
+
+    def test_resume_deletions(self):
+        self.app.config["ACCOUNT_DELETE_RETRY_AFTER"] = 60
+        with mock.patch.object(User, "launch_job") as launch:
+            self.assertEqual(maintenance.resume_deletions(), 0)
+            self.john.deleted_at = datetime.utcnow() - timedelta(minutes=5)
+            db.session.commit()
+            self.assertEqual(maintenance.resume_deletions(), 1)
+        launch.assert_called_once_with("delete_account", "Deleting your account...",
+                                       dedupe_key="delete_account")
+
+
+class LogStatsCase(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def write(self, name, lines):
+        path = os.path.join(self.folder, name)
+        opener = gzip.open if name.endswith(".gz") else open
+        with opener(path, "wt") as f:
+            f.write("\n".join(lines) + "\n")
+        return path
+
+    def test_summarize_mixed_logs(self):
+        paths = [
+            self.write("microblog.log", [
+                "2024-01-01 10:00:00,001 INFO: GET /user/7?page=2 200 12.50ms "
+                "[in /app/log.py:10]",
+                "2024-01-01 10:00:01,001 ERROR: Exception on /index [GET]",
+                "Traceback (most recent call last):",
+            ]),
+            self.write("microblog.log.1.gz", [
+                json.dumps({"time": "2024-01-01 09:00:00,000", "path": "/index",
+                            "endpoint": "main.index", "status": 500,
+                            "elapsed_ms": 700.0, "message": "GET /index 500"}),
+                json.dumps({"time": "2024-01-01 09:00:00,000", "path": "/index",
+                            "message": "Search unavailable"}),
+            ]),
+            self.write("access.log", [
+                '10.0.0.1 - - [01/Jan/2024:10:00:00 +0000] "GET /user/8 HTTP/1.1" '
+                '200 512 "-" "curl/7.0" 3000',
+                '10.0.0.1 - - [01/Jan/2024:10:00:00 +0000] "GET /user/9 HTTP/1.1" '
+                '404 512 "-" "curl/7.0"',
+            ]),
+        ]
+        for processes in (0, 2):
+            summary = {row["route"]: row for row in
+                       logstats.summarize(paths, processes=processes)}
+            self.assertEqual(set(summary), {"/user/<int>", "main.index"})
+            user = summary["/user/<int>"]
+            self.assertEqual(user["count"], 3)
+            self.assertEqual(user["status"], {"2xx": 2, "4xx": 1})
+            self.assertEqual(user["mean_ms"], 7.75)
+            self.assertEqual(user["p95_ms"], 12.5)
+            self.assertEqual(summary["main.index"]["histogram"]["<=1000"], 1)
+
+        out = io.StringIO()
+        logstats.write_csv(list(summary.values()), out)
+        self.assertIn("main.index,1,0,0,0,1,700.0", out.getvalue())
+
+    def test_paths_group_by_endpoint(self):
+        app = create_app(TestConfig)
+        paths = [
+            self.write("microblog.log", [
+                "2024-01-01 10:00:00,001 INFO: GET /user/alice 200 10.00ms "
+                "main.user [in /app/log.py:10]",
+                "2024-01-01 10:00:00,001 INFO: GET /nowhere/7 404 1.00ms - "
+                "[in /app/log.py:10]",
+            ]),
+            self.write("access.log", [
+                '10.0.0.1 - - [01/Jan/2024:10:00:00 +0000] "GET /user/bob HTTP/1.1" '
+                '200 512 "-" "curl/7.0" 3000',
+                '10.0.0.1 - - [01/Jan/2024:10:00:00 +0000] '
+                '"POST /send_message/susan HTTP/1.1" 302 512 "-" "curl/7.0"',
+                '10.0.0.1 - - [01/Jan/2024:10:00:00 +0000] "GET /nowhere/8 HTTP/1.1" '
+                '404 512 "-" "curl/7.0"',
+            ]),
+        ]
+        for processes in (0, 2):
+            summary = {row["route"]: row["count"] for row in logstats.summarize(
+                paths, processes=processes, rules=logstats.url_rules(app))}
+            self.assertEqual(summary, {"main.user": 2, "main.send_message": 1,
+                                       "/nowhere/<int>": 2})
+
+
+class CompressionCase(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.app = create_app(TestConfig)
+        self.app.add_url_rule("/stream", "stream", lambda: self.app.response_class(
+            (line for line in ["a" * 100] * 3), mimetype="text/plain"))
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_compresses_pages_and_streams(self):
+        plain = self.client.get("/auth/login")
+        self.assertNotIn("Content-Encoding", plain.headers)
+        self.assertIn("Accept-Encoding", plain.headers["Vary"])
+        page = self.client.get("/auth/login", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(page.headers["Content-Encoding"], "gzip")
+        self.assertEqual(gzip.decompress(page.data), plain.data)
+        self.assertLess(len(page.data), len(plain.data))
+
+        stream = self.client.get("/stream", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(stream.headers["Content-Encoding"], "gzip")
+        self.assertEqual(gzip.decompress(stream.data), b"a" * 300)
+
+    def test_fingerprinted_static_files(self):
+        with open(os.path.join(self.folder, "app.js"), "w") as f:
+            f.write("console.log('microblog');\n" * 50)
+        with open(os.path.join(self.folder, "loading.gif"), "wb") as f:
+            f.write(b"GIF89a")
+        stats = assets.build(self.folder, "dist",
+                             self.app.config["COMPRESS_MIMETYPES"], min_size=100)
+        self.assertEqual((stats["files"], stats["written"]), (2, 2))
+        self.assertEqual(assets.build(self.folder, "dist", set())["written"], 0)
+        self.app.static_folder = self.folder
+        assets.load_manifest(self.app)
+        with self.app.test_request_context():
+            url = url_for("static", filename="app.js")
+            self.assertRegex(url, r"^/static/dist/app\.[0-9a-f]{12}\.js$")
+            self.assertEqual(url_for("static", filename="missing.css"),
+                             "/static/missing.css")
+
+        response = self.client.get(url, headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        self.assertIn("immutable", response.headers["Cache-Control"])
+        self.assertTrue(response.mimetype.endswith("/javascript"))
+        self.assertEqual(gzip.decompress(response.data),
+                         b"console.log('microblog');\n" * 50)
+        response.close()
+        response = self.client.get(url)
+        self.assertNotIn("Content-Encoding", response.headers)
+        response.close()
+
+
+class CacheBusCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        server = fakeredis.FakeServer()
+        self.app.redis, other_client = [
+            InstrumentedRedis(connection_pool=redis.ConnectionPool(
+                connection_class=fakeredis.FakeConnection, server=server))
+            for _ in range(2)]
+        self.local = self.app.extensions["local_cache"] = \
+            cache.LocalCache(self.app.redis, "invalidate")
+        # Stands in for the cache of another process.
+        self.other = cache.LocalCache(other_client, "invalidate")
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.john = User(username="john", email="john@example.com")
+        self.susan = User(username="susan", email="susan@example.com")
+        db.session.add_all([self.john, self.susan])
+        db.session.commit()
+
+    def tearDown(self):
+        # Stops the subscriber threads.
+        self.local.pid = self.other.pid = None
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def wait_for(self, condition):
+        deadline = time.monotonic() + 5
+        while not condition():
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+    def test_commit_evicts_other_processes(self):
+        for c in (self.local, self.other):
+            c.get("follows", 0, lambda: None)
+            self.wait_for(lambda: c.connected)
+        self.assertEqual(self.susan.follow_counts(), (0, 0))
+        self.assertEqual(self.other.get("follows", self.susan.id, lambda: (0, 0)),
+                         (0, 0))
+        self.assertIn(("follows", self.susan.id), self.other.entries)
+
+        self.john.follow(self.susan)
+        db.session.commit()
+        self.assertEqual(self.susan.follow_counts(), (1, 0))
+        self.wait_for(lambda: ("follows", self.susan.id) not in self.other.entries)
+
+    def test_missed_messages_drop_the_kind(self):
+        self.other.get("task", 0, lambda: None)
+        self.wait_for(lambda: self.other.connected)
+        self.other.get("task", 1, lambda: "cached")
+        self.other.versions["task"] = -5
+        cache.publish({"task": {2}})
+        self.wait_for(lambda: not self.other.entries)
+        self.assertEqual(self.other.versions["task"], 1)
+
+
+class SuggestionsCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.users = [User(username=name, email=f"{name}@example.com")
+                      for name in ("john", "susan", "mary", "david", "anna")]
+        db.session.add_all(self.users)
+        db.session.commit()
+        john, susan, mary, david, anna = self.users
+        john.follow(susan)
+        john.follow(mary)
+        susan.follow(david)
+        mary.follow(david)
+        mary.follow(anna)
+        mary.follow(john)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_two_hop_paths_agree(self):
+        graph = suggestions.load_graph()
+        ids = [u.id for u in self.users]
+        expected = {ids[0]: [(ids[3], 2), (ids[4], 1)], ids[1]: [],
+                    ids[2]: [(ids[1], 1)], ids[3]: [], ids[4]: []}
+        if suggestions.sparse is not None:
+            self.assertEqual(suggestions.two_hop(graph, ids, 5), expected)
+        with mock.patch.object(suggestions, "sparse", None):
+            self.assertEqual(suggestions.two_hop(graph, ids, 5), expected)
+
+    def test_incremental_refresh(self):
+        john, susan, mary, david, anna = self.users
+        self.assertEqual(suggestions.refresh(), 3)
+        self.assertEqual(john.follow_suggestions(5), [david, anna])
+        self.assertEqual(suggestions.refresh(), 0)
+
+        # Following a suggestion drops it at once. The next refresh covers
+        # john and susan, and mary, who follows john.
+        john.follow(david)
+        susan.follow(anna)
+        db.session.commit()
+        self.assertEqual(john.follow_suggestions(5), [anna])
+        self.assertEqual(suggestions.refresh(), 3)
+        self.assertEqual(john.follow_suggestions(5), [anna])
+        self.assertEqual(FollowSuggestion.query.get((john.id, anna.id)).score, 2)
+
+    def test_graph_takes_in_users_who_joined_while_it_was_read(self):
+        john = self.users[0]
+        # As if user 99 signed up, and followed john, after the graph was
+        # sized.
+        db.session.execute(followers.insert(), [
+            {"follower_id": 99, "followed_id": john.id},
+            {"follower_id": john.id, "followed_id": 98}])
+        graph = suggestions.load_graph()
+        self.assertEqual(len(graph.indptr), 101)
+        self.assertEqual(list(graph.indices[graph.indptr[99]:graph.indptr[100]]),
+                         [john.id])
+        self.assertEqual(suggestions.two_hop(graph, [99], 5)[99],
+                         [(self.users[1].id, 1), (self.users[2].id, 1), (98, 1)])
+
+    def test_failed_refresh_leaves_users_stale(self):
+        with mock.patch.object(suggestions, "two_hop", side_effect=MemoryError):
+            with self.assertRaises(MemoryError):
+                suggestions.refresh()
+        self.assertEqual(User.query.filter_by(suggestions_stale=True).count(), 3)
+        self.assertEqual(suggestions.refresh(), 3)
+
+
+class ProfilingCase(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+        class ProfileConfig(TestConfig):
+            PROFILE_DIR = self.folder
+            PROFILE_MAX_FILES = 2
+
+        self.app = create_app(ProfileConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        self.app_context.pop()
+        shutil.rmtree(self.folder)
+
+    def test_signed_header_profiles_request(self):
+        self.client.get("/auth/login", headers={"X-Profile": "forged"})
+        self.assertEqual(os.listdir(self.folder), [])
+        token = profiling.make_token(self.app)
+        for _ in range(3):
+            self.client.get("/auth/login", headers={"X-Profile": token})
+        self.assertEqual(len(os.listdir(self.folder)), 2)
+        result = profiling.report(self.folder, top=5)
+        self.assertEqual(list(result), ["request:auth.login"])
+        self.assertEqual(result["request:auth.login"]["samples"], 2)
+        self.assertEqual(len(result["request:auth.login"]["functions"]), 5)
+
+    def test_sampled_job(self):
+        self.app.config["PROFILE_SAMPLE_RATE"] = 1.0
+        with profiling.profiled("job", "export_tasks"):
+            sum(range(1000))
+        self.assertIn("job:export_tasks", profiling.report(self.folder))
+
+
+class ConversationCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.config["TASKS_PER_PAGE"] = 3
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.john = User(username="john", email="john@example.com")
+        self.john.set_password("cat")
+        db.session.add(self.john)
+        db.session.commit()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def add_users(self, n):
+        users = [User(username=f"user{i}", email=f"user{i}@example.com")
+                 for i in range(n)]
+        db.session.add_all(users)
+        db.session.commit()
+        return users
+
+    def login(self):
+        self.client.post("/auth/login", data={"username": "john", "password": "cat"})
+
+    def test_send_message_threads_and_counts(self):
+        susan, = self.add_users(1)
+        susan.send_message(self.john, "hi")
+        self.john.send_message(susan, "hello")
+        susan.send_message(self.john, "how are you?")
+        db.session.commit()
+        self.assertEqual(Conversation.query.count(), 1)
+        conversation = Conversation.between(susan, self.john)
+        self.assertEqual(conversation.last_message.body, "how are you?")
+        self.assertEqual(self.john.new_messages(), 2)
+        self.assertEqual(susan.new_messages(), 1)
+
+        self.login()
+        response = self.client.get(f"/messages/{susan.username}")
+        self.assertIn(b"how are you?", response.data)
+        self.assertEqual(self.john.new_messages(), 0)
+        self.assertEqual(susan.new_messages(), 1)
+
+    def test_inbox_pages_by_recency(self):
+        users = self.add_users(7)
+        for user in users:
+            user.send_message(self.john, f"from {user.username}")
+            db.session.commit()
+        self.login()
+        self.client.get("/messages")  # Updates last_seen.
+        with count_queries() as first:
+            response = self.client.get("/messages").get_data(as_text=True)
+        self.assertIn("from user6", response)
+        self.assertNotIn("from user3", response)
+        cursor = re.search(r'href="/messages\?cursor=([^"]+)"', response).group(1)
+        response = self.client.get(f"/messages?cursor={cursor}").get_data(as_text=True)
+        self.assertIn("from user3", response)
+        self.assertNotIn("from user6", response)
+
+        self.app.config["TASKS_PER_PAGE"] = 7
+        with count_queries() as full:
+            self.client.get("/messages")
+        self.assertEqual(first.queries, full.queries)
+        self.assertIsNone(User.query.get(self.john.id).last_message_read_time)
+
+        response = self.client.get("/messages?cursor=bad")
+        self.assertEqual(response.status_code, 400)
+        self.assertTrue(response.mimetype.startswith("text/html"))
+
+class ImportCase(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+        class ImportConfig(TestConfig):
+            IMPORT_PROCESSES = 0
+            IMPORT_FOLDER = self.folder
+
+        self.app = create_app(ImportConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.user = User(username="john", email="john@example.com")
+        db.session.add(self.user)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        os.rmdir(self.folder)
+
+    def test_import_jsonl_in_chunks(self):
+        lines = [json.dumps({"body": f"task {i}", "done": i % 2 == 0})
+                 for i in range(5)]
+        progress = []
+        stream = io.BytesIO("\n".join(lines).encode())
+        total = importer.import_tasks(self.user, stream, "jsonl", chunk_size=2,
+                                      progress=progress.append)
+        self.assertEqual(total, 5)
+        self.assertEqual(progress, [2, 4, 5])
+        self.assertEqual(self.user.tasks.filter_by(done=True).count(), 3)
+
+    def test_import_csv_with_process_pool(self):
+        stream = io.BytesIO(b"body,done,timestamp\n"
+                            b"Buy milk,yes,2021-01-01T10:00:00\n"
+                            b"Comprar leche y pan para la casa,no,\n")
+        self.assertEqual(importer.import_tasks(self.user, stream, "csv",
+                                               processes=2), 2)
+        task = self.user.tasks.filter_by(done=True).one()
+        self.assertEqual(task.timestamp, datetime(2021, 1, 1, 10))
+        self.assertEqual(self.user.tasks.filter_by(done=False).one().language, "es")
+
+    def test_timestamps_are_stored_as_naive_utc(self):
+        stream = io.BytesIO(b'{"body": "a", "timestamp": "2021-01-01T12:00:00+02:00"}\n')
+        importer.import_tasks(self.user, stream, "jsonl")
+        self.assertEqual(self.user.tasks.one().timestamp, datetime(2021, 1, 1, 10))
+
+    def test_oversized_upload_is_refused(self):
+        self.app.config["IMPORT_MAX_BYTES"] = 10
+        self.app.config["RATELIMIT_ENABLED"] = False
+        token = self.user.get_token()
+        db.session.commit()
+        client = self.app.test_client()
+        headers = {"Authorization": f"Bearer {token}"}
+        response = client.post("/api/tasks/import", headers=headers,
+                               data=b'{"body": "too long"}\n')
+        self.assertEqual(response.status_code, 413)
+        # A chunked body, with no Content-Length.
+        response = client.post(
+            "/api/tasks/import", headers=headers,
+            input_stream=io.BytesIO(b'{"body": "too long"}\n'),
+            environ_overrides={"CONTENT_LENGTH": "", "wsgi.input_terminated": True})
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(os.listdir(self.folder), [])
+
+    def test_invalid_row(self):
+        stream = io.BytesIO(b'{"body": "ok"}\n{"body": ""}\n')
+        with self.assertRaisesRegex(importer.InvalidImport, "Line 2"):
+            importer.import_tasks(self.user, stream, "jsonl")
+
+    def test_import_job(self):
+        path = os.path.join(self.folder, "tasks.jsonl")
+        with open(path, "w") as f:
+            f.write('{"body": "one"}\n{"body": "two"}\n')
+        jobs.import_tasks(self.user.id, path, "jsonl")
+        self.assertEqual(self.user.tasks.count(), 2)
+        self.assertFalse(os.path.exists(path))
+        notification = self.user.notifications.filter_by(
+            name="tasks_imported").one()
+        self.assertEqual(notification.get_data(), {"count": 2})
+
+    def test_import_follows(self):
+        db.session.add_all([User(username=name, email=f"{name}@example.com")
+                            for name in ("susan", "mary")])
+        db.session.commit()
+        stream = io.BytesIO(b"follower,followed\n"
+                            b"john,susan\njohn,mary\nsusan,mary\n"
+                            b"john,susan\nmary,nobody\n")
+        progress = []
+        result = importer.import_follows(stream, "csv", chunk_size=2,
+                                         progress=progress.append)
+        self.assertEqual(result, {"records": 5, "followed": 3, "unknown": 1})
+        self.assertEqual(progress, [2, 4, 5])
+        self.assertEqual(sorted(u.username for u in self.user.followed),
+                         ["mary", "susan"])
+        stream = io.BytesIO(b'{"follower": 2, "followed": 1}\n')
+        result = importer.import_follows(stream, "jsonl", key="id")
+        self.assertEqual(result["followed"], 1)
+        self.assertEqual(self.user.followers.one().username, "susan")
+
+@unittest.skipIf(fakeredis is None, "fakeredis is not installed")
+class ArchiveCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.redis = fake_redis()
+        self.app.config["MAINTENANCE_BATCH_SIZE"] = 2
+        self.app.config["MAINTENANCE_BATCH_PAUSE"] = 0
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.user = User(username="john", email="john@example.com")
+        db.session.add(self.user)
+        now = datetime.utcnow()
+        # Oldest first, so the newest task gets the highest id: two tasks
+        # past the age cutoff, a done task past the done cutoff, and two
+        # current tasks.
+        self.tasks = [
+            Task(body="older", author=self.user, timestamp=now - timedelta(days=500)),
+            Task(body="old", author=self.user, timestamp=now - timedelta(days=400)),
+            Task(body="done", author=self.user, done=True,
+                 timestamp=now - timedelta(days=60)),
+            Task(body="last week", author=self.user, done=False,
+                 timestamp=now - timedelta(days=7)),
+            Task(body="today", author=self.user, timestamp=now),
+        ]
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_archive_and_page_across(self):
+        self.assertEqual(maintenance.archive_tasks(), 3)
+        self.assertEqual([t.body for t in Task.query.order_by(Task.id)],
+                         ["last week", "today"])
+        self.assertEqual(ArchivedTask.query.count(), 3)
+        self.assertIsNotNone(ArchivedTask.query.first().archived_at)
+
+        pages = [self.user.tasks_page(page, 2) for page in (1, 2, 3)]
+        self.assertEqual([[t.body for t in tasks] for tasks, _ in pages],
+                         [["today", "last week"], ["done", "old"], ["older"]])
+        self.assertEqual([has_next for _, has_next in pages], [True, True, False])
+        self.assertEqual(self.user.tasks_page(0, 2), pages[0])
+
+    def test_task_ids_are_not_reused(self):
+        newest = self.tasks[4].id
+        Task.query.filter(Task.id >= self.tasks[3].id).delete()
+        db.session.commit()
+        task = Task(body="new", author=self.user)
+        db.session.add(task)
+        db.session.commit()
+        self.assertGreater(task.id, newest)
+
+    def test_archive_the_newest_task(self):
+        newest = self.tasks[4].id
+        self.app.config["ARCHIVE_AFTER_DAYS"] = -1
+        self.assertEqual(maintenance.archive_tasks(), 5)
+        task = Task(body="new", author=self.user)
+        db.session.add(task)
+        db.session.commit()
+        self.assertGreater(task.id, newest)
+
+    def test_search_finds_archived_tasks(self):
+        ids = [self.tasks[4].id, self.tasks[1].id]
+        maintenance.archive_tasks()
+        with mock.patch("app.models.query_index", return_value=(ids, 2)):
+            tasks, total = Task.search("o", 1, 10)
+        self.assertEqual([t.body for t in tasks], ["today", "old"])
+        self.assertIsInstance(tasks[1], ArchivedTask)
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)